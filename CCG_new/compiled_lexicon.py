@@ -0,0 +1,198 @@
+"""
+    Compiled version of the CCG lexicon used by parse_tokens.
+
+    NLTK's lexicon.fromstring re-parses every line of a grammar each time it is called, which used to
+    happen once per CYK layer per explanation. A CompiledLexicon parses the grammar once, compiles
+    individual entries on demand (caching them by their category and semantics strings), and can be
+    pickled to disk so the work carries over between runs.
+
+    Rules that only matter to a single explanation (those of its quoted words) don't need to be part of
+    the compiled grammar, they can be added to a LexiconScope of it instead.
+"""
+import functools
+import hashlib
+import os
+import pickle
+from nltk.ccg import lexicon
+from nltk.sem.logic import Expression
+
+def grammar_signature(grammar_string):
+    """
+        Stable identifier for a grammar string, used to check that a saved lexicon belongs to a grammar
+
+        Arguments:
+            grammar_string (str) : string representation of a grammar
+
+        Returns:
+            str : hex digest of the grammar
+    """
+    return hashlib.sha1(grammar_string.encode("utf-8")).hexdigest()
+
+class CompiledLexicon():
+    """
+        A CCG lexicon that is compiled once from a grammar string and can then be extended entry by entry.
+
+        Entries are compiled exactly the way lexicon.fromstring compiles a line of the grammar, so a parse
+        run against a CompiledLexicon is identical to one run against the re-parsed grammar string.
+
+        Attributes:
+            signature         (str) : grammar_signature of the grammar this lexicon was compiled from
+            primitives        (arr) : primitive categories of the grammar
+            families         (dict) : category families of the grammar (ex: Det :: NP/N)
+            entries          (dict) : key - word, value - list of nltk Token objects
+            compiled_entries (dict) : key - (category string, semantics string),
+                                      value - (category, semantics) compiled nltk objects
+    """
+    def __init__(self, grammar_string):
+        base_lexicon = lexicon.fromstring(grammar_string, True)
+        self.signature = grammar_signature(grammar_string)
+        self.start_category = base_lexicon.start()
+        self.primitives = base_lexicon._primitives
+        self.families = base_lexicon._families
+        self.entries = dict(base_lexicon._entries)
+        self.compiled_entries = {}
+
+    def categories(self, word):
+        return self.entries.get(word, [])
+
+    def start(self):
+        return self.start_category
+
+    def compile_entry(self, categ_string, semantics_string):
+        """
+            Compiles the category and semantics of a single lexicon entry, mirroring the per-line logic
+            of lexicon.fromstring. Results are cached, as the same entries show up across explanations.
+
+            Arguments:
+                categ_string     (str) : string representation of a CCG category
+                semantics_string (str) : string representation of the entry's semantics
+
+            Returns:
+                tuple : (category, semantics) nltk objects
+        """
+        key = (categ_string, semantics_string)
+        if key not in self.compiled_entries:
+            line = "$Entry => " + categ_string + " {" + semantics_string + "}"
+            line = lexicon.COMMENTS_RE.match(line).groups()[0].strip()
+            _, _, rhs = lexicon.LEX_RE.match(line).groups()
+            catstr, semantics_str = lexicon.RHS_RE.match(rhs).groups()
+            categ, _ = lexicon.augParseCategory(catstr, self.primitives, self.families)
+            semantics = Expression.fromstring(lexicon.SEMANTICS_RE.match(semantics_str).groups()[0])
+            self.compiled_entries[key] = (categ, semantics)
+
+        return self.compiled_entries[key]
+
+    def add_entry(self, word, categ_string, semantics_string):
+        """
+            Permanently adds an entry to the lexicon, the equivalent of appending a line to the grammar
+        """
+        categ, semantics = self.compile_entry(categ_string, semantics_string)
+        self.entries.setdefault(word, []).append(lexicon.Token(word, categ, semantics))
+
+    def scope(self):
+        """
+            Returns a LexiconScope, a view of this lexicon that entries can be added to without
+            modifying the lexicon itself. Used to hold the entries created while parsing one sentence.
+        """
+        return LexiconScope(self)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    @classmethod
+    def load_or_compile(cls, grammar_string, path):
+        """
+            Loads a previously saved lexicon if it was compiled from the same grammar, else compiles
+            the grammar and saves the result to path.
+
+            Arguments:
+                grammar_string (str) : string representation of a grammar
+                path           (str) : file to load the lexicon from / save the lexicon to
+
+            Returns:
+                CompiledLexicon : lexicon for the grammar
+        """
+        if os.path.exists(path):
+            compiled = cls.load(path)
+            if compiled.signature == grammar_signature(grammar_string):
+                return compiled
+
+        compiled = cls(grammar_string)
+        compiled.save(path)
+        return compiled
+
+def _rule_lines(rules_string):
+    """
+        Splits word definitions written in grammar syntax (ex: "born" => NP {"born"}) into their parts,
+        the same way lexicon.fromstring reads them
+
+        Returns:
+            arr : list of (word, category string, semantics string) tuples
+    """
+    rules = []
+    for line in rules_string.splitlines():
+        line = lexicon.COMMENTS_RE.match(line).groups()[0].strip()
+        if line == "":
+            continue
+        match = lexicon.LEX_RE.match(line)
+        if line.startswith(":-") or match is None or match.groups()[1] == "::":
+            raise ValueError("Only word definitions can be added to a compiled lexicon: " + line)
+        word, _, rhs = match.groups()
+        catstr, semantics_str = lexicon.RHS_RE.match(rhs).groups()
+        rules.append((word, catstr.strip(), lexicon.SEMANTICS_RE.match(semantics_str).groups()[0]))
+    return rules
+
+class LexiconScope():
+    """
+        A view of a CompiledLexicon (or of another scope) with some extra entries added on top of it.
+        Implements the parts of nltk's CCGLexicon interface that CCGChartParser relies on.
+
+        Attributes:
+            lexicon (CompiledLexicon) : lexicon this scope extends
+            entries            (dict) : key - word, value - list of nltk Token objects only found in this scope
+    """
+    def __init__(self, compiled_lexicon):
+        self.lexicon = compiled_lexicon
+        self.entries = {}
+
+    def categories(self, word):
+        if word in self.entries:
+            return self.entries[word]
+        return self.lexicon.categories(word)
+
+    def start(self):
+        return self.lexicon.start()
+
+    def compile_entry(self, categ_string, semantics_string):
+        return self.lexicon.compile_entry(categ_string, semantics_string)
+
+    def add_entry(self, word, categ_string, semantics_string):
+        categ, semantics = self.lexicon.compile_entry(categ_string, semantics_string)
+        if word not in self.entries:
+            # entries of a scope extend the ones the word already has
+            self.entries[word] = list(self.lexicon.categories(word))
+        self.entries[word].append(lexicon.Token(word, categ, semantics))
+
+    def add_rules(self, rules_string):
+        """
+            Adds word definitions written in grammar syntax, the equivalent of appending rules_string
+            to the grammar (ex: output of utils.add_rules_to_grammar(tokens, ""))
+        """
+        for word, categ_string, semantics_string in _rule_lines(rules_string):
+            self.add_entry(word, categ_string, semantics_string)
+
+    def scope(self):
+        return LexiconScope(self)
+
+@functools.lru_cache(maxsize=8)
+def compile_lexicon(grammar_string):
+    """
+        Compiles a grammar string, re-using the compiled lexicon if the same grammar was seen before
+    """
+    return CompiledLexicon(grammar_string)
@@ -1,11 +1,15 @@
 from CCG_new import strict_grammar_functions as gram_f
 from CCG_new import soft_grammar_functions as soft_gram_f
+from CCG_new import vector_grammar_functions as vec_gram_f
 import torch
 
 SPACE = "SPACE"
 PUNCT = "PUNCT"
 PHRASE = "PHRASE"
 
+# spaCy pipeline components whose output generate_phrases never reads (only token text and NER types are used)
+UNUSED_SPACY_COMPONENTS = ["parser", "lemmatizer", "tagger"]
+
 if torch.cuda.is_available():
     device = torch.device("cuda")
 else:
@@ -404,37 +408,74 @@ STRICT_MATCHING_OPS = {
     "@EndsWith"   : lambda x,y: lambda c: c.with_(x[-1],'ends',y),
 }
 
+# Same ops as STRICT_MATCHING_OPS, but the functions take a PhraseCorpus and return one boolean per sentence
+VECTORIZED_MATCHING_OPS = {
+    ".root"       : lambda xs: lambda c: vec_gram_f._all([x(c) for x in xs], c) if type(xs) == tuple else xs(c),
+    "@Word"       : lambda x: x,
+    "@Is"         : lambda ws,p: lambda c: vec_gram_f.IsFunc(ws,p,c),
+    "@between"    : lambda a: lambda w,option=None: lambda c: vec_gram_f.at_between(w,c,option,a),
+    "@In0"        : lambda arg: lambda w: lambda c: vec_gram_f.at_In0(arg,w,c),
+    "@In1"        : lambda arg,w: lambda c: vec_gram_f.at_In0(arg,w,c),
+    "@And"        : lambda x,y: gram_f.merge(x,y),
+    "@Num"        : lambda x,y: {'attr':y,'num':int(x)},
+    "@LessThan"   : lambda funcx,nouny: lambda w: lambda c: gram_f.at_lessthan(funcx,nouny,w,c),
+    "@AtMost"     : lambda funcx,nouny: lambda w: lambda c: gram_f.at_atmost(funcx,nouny,w,c),
+    "@AtLeast"    : lambda funcx,nouny: lambda w: lambda c: gram_f.at_atleast(funcx,nouny,w,c),
+    "@MoreThan"   : lambda funcx,nouny: lambda w: lambda c: gram_f.at_morethan(funcx,nouny,w,c),
+    "@WordCount"  : lambda nounNum,nouny,F: lambda useless: lambda c: vec_gram_f.at_WordCount(nounNum,nouny,F,c),
+
+    "@NumberOf"   : lambda x,f: [x,f],
+    "@LessThan1"  : lambda nounynum: lambda x: lambda c: gram_f.at_lessthan(x[1],{'attr':x[0],"num":int(nounynum)},'There',c),
+    "@AtMost1"    : lambda nounynum: lambda x: lambda c: gram_f.at_atmost(x[1],{'attr':x[0],"num":int(nounynum)},'There',c),
+    "@AtLeast1"   : lambda nounynum: lambda x: lambda c: gram_f.at_atleast(x[1],{'attr':x[0],"num":int(nounynum)},'There',c),
+    "@MoreThan1"  : lambda nounynum: lambda x: lambda c: gram_f.at_morethan(x[1],{'attr':x[0],"num":int(nounynum)},'There',c),
+
+    "@By"         : lambda x,f,z: lambda c: f(x,{'attr': z['attr'], 'range': z['num'], 'numAppear': 1, 'cmp': 'nlt','onlyCount': False})(c),
+
+    "@Left0"      : lambda arg: lambda w,option=None: lambda c: vec_gram_f.at_POSI_0('Left',arg,w,c,option),
+    "@Right0"     : lambda arg: lambda w,option=None: lambda c: vec_gram_f.at_POSI_0('Right',arg,w,c,option),
+    "@Range0"     : lambda arg: lambda w,option=None: lambda c: vec_gram_f.at_POSI_0('Range',arg,w,c,option),
+
+    "@Left"       : lambda arg,ws,option=None: lambda c: vec_gram_f.at_POSI('Left',ws,arg,c,option),
+    "@Right"      : lambda arg,ws,option=None: lambda c: vec_gram_f.at_POSI('Right',ws,arg,c,option),
+
+    "@Direct"     : lambda func: lambda w: lambda c: func(w,'Direct')(c),
+
+    "@StartsWith" : lambda x,y: lambda c: c.with_(x[-1],'starts',y),
+    "@EndsWith"   : lambda x,y: lambda c: c.with_(x[-1],'ends',y),
+}
+
 SOFT_MATCHING_OPS = {
-    ".root": lambda xs: lambda label_mat,keyword_dict,mask_mat:lambda c: torch.max(torch.tensor(sum([x(label_mat,keyword_dict,mask_mat)(c) for x in xs])-len(xs)+1).to(device),torch.tensor(0.0).to(device)) if type(xs) == tuple else xs(label_mat,keyword_dict,mask_mat)(c),
+    ".root": lambda xs: lambda ctx: torch.max(torch.tensor(sum([x(ctx) for x in xs])-len(xs)+1).to(device),torch.tensor(0.0).to(device)) if type(xs) == tuple else xs(ctx),
     "@Word": lambda x: x,
-    "@Is": lambda ws, p: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.IsFunc_soft(ws, p,label_mat,keyword_dict,mask_mat, c),
-    "@between": lambda a: lambda w, option=None: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_between_soft(w, label_mat,keyword_dict,mask_mat,c, option),
+    "@Is": lambda ws, p: lambda ctx: soft_gram_f.IsFunc_soft(ws, p,ctx),
+    "@between": lambda a: lambda w, option=None: lambda ctx: soft_gram_f.at_between_soft(w, ctx, option),
     "@And": lambda x, y: soft_gram_f.merge_soft(x, y),
     "@Num": lambda x, y: {'attr': y, "num": int(x)},
-    "@LessThan": lambda funcx, nouny: lambda w: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_lessthan_soft(funcx, nouny, w, label_mat,keyword_dict,mask_mat,c),
-    "@AtMost": lambda funcx, nouny: lambda w: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_atmost_soft(funcx, nouny, w, label_mat,keyword_dict,mask_mat,c),
-    "@AtLeast": lambda funcx, nouny: lambda w: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_atleast_soft(funcx, nouny, w, label_mat,keyword_dict,mask_mat,c),
-    "@MoreThan": lambda funcx, nouny: lambda w: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_morethan_soft(funcx, nouny, w, label_mat,keyword_dict,mask_mat,c),
-    "@WordCount": lambda nounNum, nouny, F:lambda useless: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_WordCount_soft(nounNum,nouny,F,label_mat,keyword_dict,mask_mat,c),
+    "@LessThan": lambda funcx, nouny: lambda w: lambda ctx: soft_gram_f.at_lessthan_soft(funcx, nouny, w, ctx),
+    "@AtMost": lambda funcx, nouny: lambda w: lambda ctx: soft_gram_f.at_atmost_soft(funcx, nouny, w, ctx),
+    "@AtLeast": lambda funcx, nouny: lambda w: lambda ctx: soft_gram_f.at_atleast_soft(funcx, nouny, w, ctx),
+    "@MoreThan": lambda funcx, nouny: lambda w: lambda ctx: soft_gram_f.at_morethan_soft(funcx, nouny, w, ctx),
+    "@WordCount": lambda nounNum, nouny, F:lambda useless: lambda ctx: soft_gram_f.at_WordCount_soft(nounNum,nouny,F,ctx),
 
     "@NumberOf": lambda x, f: [x, f],
-    "@LessThan1": lambda nounynum: lambda x: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_lessthan_soft(x[1], {'attr': x[0], "num": int(nounynum)}, 'There',label_mat,keyword_dict,mask_mat,c),
-    "@AtMost1": lambda nounynum: lambda x: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_atmost_soft(x[1], {'attr': x[0], "num": int(nounynum)}, 'There', label_mat,keyword_dict,mask_mat,c),
-    "@AtLeast1": lambda nounynum: lambda x: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_atleast_soft(x[1], {'attr': x[0], "num": int(nounynum)}, 'There',label_mat,keyword_dict,mask_mat,c),
-    "@MoreThan1": lambda nounynum: lambda x: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_morethan_soft(x[1], {'attr': x[0], "num": int(nounynum)}, 'There',label_mat,keyword_dict,mask_mat,c),
+    "@LessThan1": lambda nounynum: lambda x: lambda ctx: soft_gram_f.at_lessthan_soft(x[1], {'attr': x[0], "num": int(nounynum)}, 'There',ctx),
+    "@AtMost1": lambda nounynum: lambda x: lambda ctx: soft_gram_f.at_atmost_soft(x[1], {'attr': x[0], "num": int(nounynum)}, 'There', ctx),
+    "@AtLeast1": lambda nounynum: lambda x: lambda ctx: soft_gram_f.at_atleast_soft(x[1], {'attr': x[0], "num": int(nounynum)}, 'There',ctx),
+    "@MoreThan1": lambda nounynum: lambda x: lambda ctx: soft_gram_f.at_morethan_soft(x[1], {'attr': x[0], "num": int(nounynum)}, 'There',ctx),
 
-    "@In0": lambda arg: lambda w: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_In0_soft(arg, w, label_mat,keyword_dict,mask_mat,c),
-    "@In1": lambda arg,w: lambda label_mat,keyword_dict,mask_mat: lambda c: soft_gram_f.at_In0_soft(arg, w, label_mat,keyword_dict,mask_mat,c),
-    "@By": lambda x, f, z: lambda label_mat,keyword_dict,mask_mat:lambda c: f(x, {'attr': z['attr'], 'range': z['num'], 'numAppear': 1, 'cmp': 'nlt','onlyCount': False})(label_mat,keyword_dict,mask_mat)(c),
+    "@In0": lambda arg: lambda w: lambda ctx: soft_gram_f.at_In0_soft(arg, w, ctx),
+    "@In1": lambda arg,w: lambda ctx: soft_gram_f.at_In0_soft(arg, w, ctx),
+    "@By": lambda x, f, z: lambda ctx: f(x, {'attr': z['attr'], 'range': z['num'], 'numAppear': 1, 'cmp': 'nlt','onlyCount': False})(ctx),
 
-    "@Left0": lambda arg: lambda w, option=None: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_POSI_0_soft('Left', arg, w, label_mat,keyword_dict,mask_mat,c, option),
+    "@Left0": lambda arg: lambda w, option=None: lambda ctx: soft_gram_f.at_POSI_0_soft('Left', arg, w, ctx, option),
 
-    "@Right0": lambda arg: lambda w, option=None: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_POSI_0_soft('Right', arg, w, label_mat,keyword_dict,mask_mat,c, option),
+    "@Right0": lambda arg: lambda w, option=None: lambda ctx: soft_gram_f.at_POSI_0_soft('Right', arg, w, ctx, option),
 
-    "@Range0": lambda arg: lambda w, option=None: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_POSI_0_soft('Range', arg, w, label_mat,keyword_dict,mask_mat,c, option),
+    "@Range0": lambda arg: lambda w, option=None: lambda ctx: soft_gram_f.at_POSI_0_soft('Range', arg, w, ctx, option),
 
-    "@Left": lambda arg, ws, option=None: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_POSI_soft('Left', ws, arg, label_mat,keyword_dict,mask_mat,c, option),
-    "@Right": lambda arg, ws, option=None: lambda label_mat,keyword_dict,mask_mat:lambda c: soft_gram_f.at_POSI_soft('Right', ws, arg, label_mat,keyword_dict,mask_mat,c, option),
+    "@Left": lambda arg, ws, option=None: lambda ctx: soft_gram_f.at_POSI_soft('Left', ws, arg, ctx, option),
+    "@Right": lambda arg, ws, option=None: lambda ctx: soft_gram_f.at_POSI_soft('Right', ws, arg, ctx, option),
 
-    "@Direct": lambda func: lambda w: lambda label_mat,keyword_dict,mask_mat:lambda c: func(w, 'Direct')(label_mat,keyword_dict,mask_mat)(c)
+    "@Direct": lambda func: lambda w: lambda ctx: func(w, 'Direct')(ctx)
 }
\ No newline at end of file
@@ -0,0 +1,442 @@
+"""
+    Native CYK engine for parsing token sequences with our CCG grammar.
+
+    utils.parse_tokens builds an NLTK chart for every pair of words it tries to combine. The CYKEngine
+    instead applies NLTK's combinators directly to the (category, semantics) entries in each cell of the
+    chart, and remembers the result of every pair it has combined. Entries are interned by their string
+    forms, which is also how parse_tokens identifies them, so the output is the same as parse_tokens.
+
+    The engine can also parse a token lattice, every alternative tokenization of an explanation at once.
+    Readings (tokenizations) are numbered in the order TrainedCCGParser.tokenize_explanations lists them,
+    and every entry in the chart carries a bitset of the readings it can be derived in.
+
+    A ParseBudget bounds the work spent on a single explanation. Cells that grow past the budget are cut
+    down to a beam of their best entries, and the cut-offs are recorded so they can be reported.
+"""
+import itertools
+import time
+from nltk.ccg import chart
+from nltk.ccg.combinator import BackwardCombinator, UndirectedFunctionApplication, UndirectedComposition,\
+                                UndirectedSubstitution
+from nltk.ccg.logic import compute_function_semantics, compute_composition_semantics,\
+                           compute_substitution_semantics, compute_type_raised_semantics
+from nltk.sem.logic import LogicalExpressionException
+from CCG_new import compiled_lexicon
+
+class ChartEntry():
+    """
+        An interned (category, semantics) pair living in a cell of the CYK chart
+
+        Attributes:
+            key              (tuple) : (category string, semantics string), what the entry is interned by
+            sem_key            (str) : semantics_string + '_' + category_string, used to de-duplicate cells
+            semantics_string   (str) : string version of the semantics, what the parser outputs
+            tokens           (tuple) : ((category, semantics),) compiled nltk objects, set when needed
+    """
+    __slots__ = ("key", "sem_key", "semantics_string", "tokens")
+
+    def __init__(self, categ_string, semantics_string):
+        self.key = (categ_string, semantics_string)
+        self.sem_key = semantics_string + "_" + categ_string
+        self.semantics_string = semantics_string
+        self.tokens = None
+
+class ParseBudget():
+    """
+        Per-explanation limits on parsing, limits set to None aren't enforced. Call start() when beginning
+        to parse an explanation to get the ParseLimits to parse it with.
+
+        Attributes:
+            max_tokenizations (int) : maximum number of tokenizations an explanation is expanded into
+            max_cell_entries  (int) : maximum number of entries kept in a cell of the CYK chart
+            time_budget     (float) : seconds an explanation can take before its cells are cut to beam_width
+            beam_width        (int) : number of entries kept per cell once the time budget is spent
+    """
+    def __init__(self, max_tokenizations=None, max_cell_entries=None, time_budget=None, beam_width=8):
+        self.max_tokenizations = max_tokenizations
+        self.max_cell_entries = max_cell_entries
+        self.time_budget = time_budget
+        self.beam_width = beam_width
+
+    def signature(self):
+        """
+            The deterministic limits, parses cut by the same limits are the same
+        """
+        return "max_cell_entries=" + str(self.max_cell_entries)
+
+    def start(self):
+        return ParseLimits(self)
+
+class ParseLimits():
+    """
+        The limits of a ParseBudget applied to one explanation
+
+        Attributes:
+            budget (ParseBudget) : limits to apply
+            deadline     (float) : time after which cells are cut to budget.beam_width, None if no time budget
+            cutoffs       (dict) : key - name of the limit that was hit, value - number of cells it cut
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.deadline = None
+        if budget.time_budget is not None:
+            self.deadline = time.time() + budget.time_budget
+        self.cutoffs = {}
+
+    def cut(self, cell, rank):
+        """
+            Cuts a cell down to the number of entries currently allowed, keeping the entries with the
+            lowest rank (ties broken by derivation order). Kept entries stay in derivation order.
+
+            Arguments:
+                cell  (arr) : cell of the chart
+                rank (func) : function giving the rank of an item of the cell
+
+            Returns:
+                arr : the cell, or the beam of it that was kept
+        """
+        width = self.budget.max_cell_entries
+        limit = "max_cell_entries"
+        if self.deadline is not None and time.time() > self.deadline:
+            if width is None or self.budget.beam_width < width:
+                width = self.budget.beam_width
+                limit = "time_budget"
+        if width is None or len(cell) <= width:
+            return cell
+
+        self.cutoffs[limit] = self.cutoffs.get(limit, 0) + 1
+        kept = sorted(range(len(cell)), key=lambda j: (rank(cell[j]), j))[:width]
+        return [cell[j] for j in sorted(kept)]
+
+def _entry_rank(entry):
+    # entries with fewer unfilled arguments are closer to being a complete parse
+    categ_string = entry.key[0]
+    return categ_string.count("/") + categ_string.count("\\")
+
+def _lattice_entry_rank(item):
+    # amongst equally complete entries, prefer those found in more tokenizations
+    entry, mask = item
+    return (_entry_rank(entry), -bin(mask).count("1"))
+
+class _Edge():
+    """
+        Minimal stand-in for the edges of an NLTK CCGChart over two words
+    """
+    __slots__ = ("categ", "rule", "child_lists", "semantics")
+
+    def __init__(self, categ, rule, semantics=None):
+        self.categ = categ
+        self.rule = rule
+        self.child_lists = []
+        self.semantics = semantics
+
+class CYKEngine():
+    """
+        CYK parser over interned chart entries. Combining two cell entries replicates what NLTK's
+        CCGChartParser does for a two word sentence with the same rule set, and the outcome is cached,
+        so each distinct pair of entries is only ever combined once per engine.
+
+        Sentences can be parsed against a LexiconScope of the engine's lexicon, holding the rules of words
+        only found in that sentence (ex: quoted words). Results are cached by word, so a word must have the
+        same categories in every scope it appears in, which holds for quoted words.
+
+        Attributes:
+            lexicon (CompiledLexicon) : compiled lexicon of the grammar
+            rules              (arr) : NLTK chart rules to apply, defaults to chart.DefaultRuleSet
+            max_cached_pairs   (int) : once this many pair combinations are cached the cache is reset
+    """
+    def __init__(self, lexicon, rules=chart.DefaultRuleSet, max_cached_pairs=500000):
+        if isinstance(lexicon, str):
+            lexicon = compiled_lexicon.compile_lexicon(lexicon)
+        self.lexicon = lexicon
+        self.rules = rules
+        self.max_cached_pairs = max_cached_pairs
+        self._entries = {}
+        self._terminals = {}
+        self._combinations = {}
+
+    def intern(self, categ_string, semantics_string):
+        key = (categ_string, semantics_string)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = ChartEntry(categ_string, semantics_string)
+            self._entries[key] = entry
+        return entry
+
+    def _entry_tokens(self, entry):
+        if entry.tokens is None:
+            entry.tokens = (self.lexicon.compile_entry(*entry.key),)
+        return entry.tokens
+
+    def _terminal_tokens(self, word, lexicon=None):
+        if word in self._terminals:
+            return self._terminals[word]
+        lexicon = lexicon if lexicon is not None else self.lexicon
+        tokens = tuple((token.categ(), token.semantics()) for token in lexicon.categories(word))
+        # unknown words aren't cached, another scope may define them
+        if tokens:
+            self._terminals[word] = tokens
+        return tokens
+
+    def _leaf_edges(self, tokens):
+        # leaf edges are compared by (position, category, word), so repeated categories collapse
+        edges = []
+        seen = set()
+        for categ, semantics in tokens:
+            if categ not in seen:
+                seen.add(categ)
+                edges.append(_Edge(categ, None, semantics))
+        return edges
+
+    def _insert(self, edges, index, key, categ, rule, children):
+        edge = index.get(key)
+        if edge is None:
+            edge = _Edge(categ, rule)
+            index[key] = edge
+            edges.append(edge)
+        if children not in edge.child_lists:
+            edge.child_lists.append(children)
+
+    def _trees(self, edge, memo):
+        """
+            Semantics of every derivation of edge, in the order NLTK's CCGChart would build the trees
+        """
+        if edge.rule is None:
+            return [edge.semantics]
+        if id(edge) in memo:
+            return memo[id(edge)]
+
+        trees = []
+        for children in edge.child_lists:
+            child_choices = [self._trees(child, memo) for child in children]
+            for child_semantics in itertools.product(*child_choices):
+                if child_semantics[0] is None:
+                    trees.append(None)
+                elif len(child_semantics) == 2:
+                    if isinstance(edge.rule, BackwardCombinator):
+                        child_semantics = (child_semantics[1], child_semantics[0])
+                    combinator = edge.rule._combinator
+                    function, argument = child_semantics
+                    if isinstance(combinator, UndirectedFunctionApplication):
+                        trees.append(compute_function_semantics(function, argument))
+                    elif isinstance(combinator, UndirectedComposition):
+                        trees.append(compute_composition_semantics(function, argument))
+                    elif isinstance(combinator, UndirectedSubstitution):
+                        trees.append(compute_substitution_semantics(function, argument))
+                    else:
+                        raise AssertionError("Unsupported combinator '" + str(combinator) + "'")
+                else:
+                    trees.append(compute_type_raised_semantics(child_semantics[0]))
+        memo[id(edge)] = trees
+        return trees
+
+    def _combine_tokens(self, left_tokens, right_tokens):
+        """
+            Every (category string, semantics string) derivable by combining a word with categories
+            left_tokens and a word with categories right_tokens. A failure part way through keeps the
+            results that came before it, as parse_tokens does.
+        """
+        results = []
+        left_edges = self._leaf_edges(left_tokens)
+        right_edges = self._leaf_edges(right_tokens)
+        full_edges = []
+        index = {}
+        try:
+            # lists are extended while being iterated over, type-raised edges get combined as well
+            for left in left_edges:
+                for right in right_edges:
+                    for rule in self.rules:
+                        combinator = rule._combinator
+                        if isinstance(rule, chart.ForwardTypeRaiseRule):
+                            for res in combinator.combine(left.categ, right.categ):
+                                self._insert(left_edges, index, (0, res, combinator), res, combinator, (left,))
+                        elif isinstance(rule, chart.BackwardTypeRaiseRule):
+                            for res in combinator.combine(left.categ, right.categ):
+                                self._insert(right_edges, index, (1, res, combinator), res, combinator, (right,))
+                        elif combinator.can_combine(left.categ, right.categ):
+                            for res in combinator.combine(left.categ, right.categ):
+                                self._insert(full_edges, index, (2, res, combinator), res, combinator, (left, right))
+
+            for edge in full_edges:
+                trees = self._trees(edge, {})
+                categ_string = str(edge.categ)
+                for semantics in trees:
+                    results.append((categ_string, str(semantics)))
+        except (AssertionError, LogicalExpressionException):
+            # NLTK asserts when the semantics of two categories that combine can't be composed
+            pass
+        return results
+
+    def combine(self, left, right, lexicon=None):
+        """
+            Combines two cell items, each either a terminal (str) or a ChartEntry
+
+            Arguments:
+                left    (str|ChartEntry) : left item
+                right   (str|ChartEntry) : right item
+                lexicon   (LexiconScope) : scope to look terminals up in, defaults to the engine's lexicon
+
+            Returns:
+                tuple : ChartEntry objects for every derivation, in derivation order (may repeat)
+        """
+        left_key = left if isinstance(left, str) else left.key
+        right_key = right if isinstance(right, str) else right.key
+        pair = (left_key, right_key)
+        if pair in self._combinations:
+            return self._combinations[pair]
+
+        left_tokens = self._terminal_tokens(left, lexicon) if isinstance(left, str) else self._entry_tokens(left)
+        right_tokens = self._terminal_tokens(right, lexicon) if isinstance(right, str) else self._entry_tokens(right)
+        if not left_tokens or not right_tokens:
+            return ()
+        combined = tuple(self.intern(categ_string, semantics_string)
+                         for categ_string, semantics_string in self._combine_tokens(left_tokens, right_tokens))
+
+        if len(self._combinations) >= self.max_cached_pairs:
+            self._combinations = {}
+        self._combinations[pair] = combined
+        return combined
+
+    def parse(self, one_sent_tokenize, limits=None, lexicon=None):
+        """
+            Same as utils.parse_tokens, the semantics strings of every parse spanning the whole sentence
+
+            Arguments:
+                one_sent_tokenize   (arr) : array of string tokens representing a sentence
+                limits      (ParseLimits) : if set, cells are cut down to the limits' beam
+                lexicon    (LexiconScope) : if set, terminals are looked up in this scope of the engine's lexicon
+
+            Returns:
+                arr : list of possible parses (semantics strings)
+        """
+        length = len(one_sent_tokenize)
+        # a token that isn't a word (ex: [] for ",") combines with nothing
+        chart_cells = [[[token] if _is_terminal(token) else [] for token in one_sent_tokenize]]
+        for layer in range(1, length):
+            layer_cells = []
+            for col in range(0, length - layer):
+                cell = []
+                seen = set()
+                st = col
+                ed = st + layer
+                for splt in range(st, ed):
+                    for left in chart_cells[splt-st][st]:
+                        for right in chart_cells[ed-splt-1][splt+1]:
+                            for entry in self.combine(left, right, lexicon):
+                                if entry.sem_key not in seen:
+                                    seen.add(entry.sem_key)
+                                    cell.append(entry)
+                if limits is not None:
+                    cell = limits.cut(cell, _entry_rank)
+                # a layer entry that can't be compiled breaks every later layer of parse_tokens
+                if layer < length - 1:
+                    for entry in cell:
+                        try:
+                            self._entry_tokens(entry)
+                        except (AssertionError, LogicalExpressionException):
+                            return []
+                layer_cells.append(cell)
+            chart_cells.append(layer_cells)
+        if length < 2:
+            return []
+        return [entry.semantics_string for entry in chart_cells[-1][0]]
+
+    def parse_lattice(self, token_lattice, limits=None, lexicon=None):
+        """
+            Parses all tokenizations described by a token lattice in a single chart. A token lattice has
+            one list of possible terminals per position, its tokenizations are the cartesian product of
+            those lists.
+
+            Returns each final (semantics, category) entry once, with the number of tokenizations it is
+            a parse of. Entries are ordered by the first tokenization that produces them, so counting
+            these is the same as counting the concatenated parse() output of every tokenization.
+
+            Arguments:
+                token_lattice       (arr) : array of arrays of string tokens, one array per position
+                limits      (ParseLimits) : if set, cells are cut down to the limits' beam
+                lexicon    (LexiconScope) : if set, terminals are looked up in this scope of the engine's lexicon
+
+            Returns:
+                arr : list of (semantics string, number of tokenizations) tuples
+        """
+        length = len(token_lattice)
+        if length < 2:
+            return []
+        radices = [len(terminals) for terminals in token_lattice]
+        reading_count = 1
+        for radix in radices:
+            reading_count *= radix
+        if reading_count == 0:
+            return []
+
+        chart_cells = [[]]
+        stride = reading_count
+        for position, terminals in enumerate(token_lattice):
+            stride //= radices[position]
+            cell = {}
+            for choice, terminal in enumerate(terminals):
+                # readings through a placeholder have no parses, as in parse()
+                if not _is_terminal(terminal):
+                    continue
+                mask = _reading_mask(choice, radices[position], stride, reading_count)
+                cell[terminal] = cell.get(terminal, 0) | mask
+            chart_cells[0].append(list(cell.items()))
+
+        failed_readings = 0
+        for layer in range(1, length):
+            layer_cells = []
+            for col in range(0, length - layer):
+                cell = {}
+                st = col
+                ed = st + layer
+                for splt in range(st, ed):
+                    for left, left_mask in chart_cells[splt-st][st]:
+                        for right, right_mask in chart_cells[ed-splt-1][splt+1]:
+                            mask = left_mask & right_mask
+                            if not mask:
+                                continue
+                            for entry in self.combine(left, right, lexicon):
+                                if entry.sem_key in cell:
+                                    cell[entry.sem_key][1] |= mask
+                                else:
+                                    cell[entry.sem_key] = [entry, mask]
+                cell = list(cell.values())
+                if limits is not None:
+                    cell = limits.cut(cell, _lattice_entry_rank)
+                # same as parse(), readings with an entry that can't be compiled have no parses
+                if layer < length - 1:
+                    for entry, mask in cell:
+                        try:
+                            self._entry_tokens(entry)
+                        except (AssertionError, LogicalExpressionException):
+                            failed_readings |= mask
+                layer_cells.append(cell)
+            chart_cells.append(layer_cells)
+
+        final_entries = []
+        for i, (entry, mask) in enumerate(chart_cells[-1][0]):
+            mask &= ~failed_readings
+            if mask:
+                first_reading = (mask & -mask).bit_length()
+                final_entries.append((first_reading, i, entry.semantics_string, bin(mask).count("1")))
+        final_entries.sort()
+
+        return [(semantics_string, count) for _, _, semantics_string, count in final_entries]
+
+def _is_terminal(token):
+    """
+        Whether a token is a word that can be looked up in the lexicon, tokenizations can also hold
+        placeholders for chunks without terminals (ex: [] for ",")
+    """
+    return isinstance(token, str) and len(token) > 0
+
+def _reading_mask(choice, radix, stride, reading_count):
+    """
+        Bitset of the readings that pick `choice` at a position. Readings are numbered like a mixed radix
+        number, the position's digit has weight `stride`, so the mask is a block of `stride` set bits
+        repeating every radix * stride readings.
+    """
+    block = ((1 << stride) - 1) << (choice * stride)
+    period = radix * stride
+    repeats = reading_count // period
+    return block * (((1 << (period * repeats)) - 1) // ((1 << period) - 1))
@@ -0,0 +1,452 @@
+"""
+    Sparse matrix of which strict labeling functions fire on which sentences.
+
+    Applying labeling functions to a corpus is the expensive part of both TrainedCCGParser.matrix_filter and
+    training.train_util_functions.match_training_data. A FiringMatrix is built in a single pass over the
+    labeling functions (with the NER type check of relation extraction built in, a function is only
+    evaluated on the sentences whose NER types it can fire on) and saved, filtering,
+    deduplication, first-match labeling and coverage statistics are all read off of it afterwards, so no
+    labeling function is called twice on the same sentence.
+
+    Rows are keyed by (semantic_repr, ner_types), so a saved matrix can be re-used for the same labeling
+    functions on the same corpus, even by a different TrainedCCGParser.
+"""
+import ast
+import hashlib
+import multiprocessing
+import os
+import numpy as np
+from statistics import NormalDist
+from scipy import sparse
+from CCG_new import utils
+from CCG_new.semantic_dag import SemanticDAG
+from CCG_new.labeling_functions import LabelingFunction
+
+def corpus_signature(corpus):
+    """
+        Stable identifier for everything labeling functions look at in a PhraseCorpus: tokens, NER types
+        and the positions of SUBJ and OBJ
+    """
+    hasher = hashlib.sha1(corpus.signature().encode("utf-8"))
+    ners = sorted(corpus.ner_vocab, key=corpus.ner_vocab.get)
+    hasher.update("\0".join(ners).encode("utf-8"))
+    hasher.update(corpus.ner_ids.tobytes())
+    hasher.update(corpus.subj_posi.tobytes())
+    hasher.update(corpus.obj_posi.tobytes())
+    return hasher.hexdigest()
+
+class FiringMatrix():
+    """
+        Boolean CSR matrix, rows - labeling functions, columns - sentences of a PhraseCorpus
+
+        Attributes:
+            matrix (sparse.csr_matrix) : matrix[i, j] is True if function i applies to sentence j
+            keys                 (arr) : (semantic_repr, ner_types) of each row, ner_types is None if the NER
+                                         types of SUBJ and OBJ weren't checked
+            signature            (str) : corpus_signature of the corpus the matrix was built from
+            dag          (SemanticDAG) : DAG the matrix was built with, None if it was loaded
+    """
+    def __init__(self, matrix, keys, signature):
+        self.matrix = matrix
+        self.keys = keys
+        self.signature = signature
+        self.dag = None
+
+    @classmethod
+    def build(cls, labeling_functions, semantic_reps, corpus, index=None, ner_types=None, workers=1, dag=None):
+        """
+            Applies every labeling function to every sentence of corpus, one NER type bucket at a time, so only
+            the sentences a function fires on are kept around
+
+            Functions are grouped by NER types, and each group is only evaluated on the sentences whose SUBJ
+            and OBJ have its NER types. Within a group, the predicates functions share are evaluated once
+            (see semantic_dag), and functions with the same semantic_repr and NER types are evaluated once. With
+            more than one worker, groups are sharded over a pool of processes, each
+            with its own copy of corpus and index. Workers rebuild each function from its semantic_repr, functions
+            without one are sent to workers if they are LabelingFunctions, else (closures can't be pickled)
+            applied in this process.
+
+            Arguments:
+                labeling_functions (arr) : strict labeling functions
+                semantic_reps      (arr) : semantic_repr each function was created from, None if unknown
+                corpus  (PhraseCorpus) : sentences to label
+                index     (TokenIndex) : if given, used to skip sentences a function can't apply to
+                ner_types          (arr) : if given, (subj_type, obj_type) of each function, a function only
+                                           fires on sentences whose SUBJ and OBJ have these (lowercased) NER
+                                           types. None entries - the function fires on no sentence
+                workers            (int) : number of processes to apply functions with
+                dag        (SemanticDAG) : DAG to evaluate predicates with, a new one if None. Stored in
+                                           the dag attribute of the result, for its per-node hit counts
+
+            Returns:
+                FiringMatrix : firing matrix of the functions over corpus
+        """
+        if dag is None:
+            dag = SemanticDAG()
+        function_ner_types = _function_ner_types(labeling_functions, ner_types)
+        rows = [None] * len(labeling_functions)
+        first_of = {}
+        duplicate_of = {}
+        for i, semantic_repr in enumerate(semantic_reps):
+            if semantic_repr is not None:
+                duplicate_of[i] = first_of.setdefault((semantic_repr, function_ner_types[i]), i)
+        duplicate_of = {i : first for i, first in duplicate_of.items() if i != first}
+
+        pool = None
+        shards = []
+        if workers > 1:
+            buckets = {}
+            for i, semantic_repr in enumerate(semantic_reps):
+                if i in duplicate_of:
+                    continue
+                if semantic_repr is not None or isinstance(labeling_functions[i], LabelingFunction):
+                    buckets.setdefault(function_ner_types[i], []).append(i)
+            sharded = [i for bucket in buckets.values() for i in bucket]
+            shard_size = max(1, -(-len(sharded) // (workers * 4)))
+            shards = [[(i, semantic_reps[i], function_ner_types[i], labeling_functions[i] if semantic_reps[i] is None else None)
+                       for i in sharded[start:start+shard_size]] for start in range(0, len(sharded), shard_size)]
+        try:
+            if len(shards) > 1:
+                pool = multiprocessing.Pool(workers, initializer=_init_firing_worker, initargs=(corpus, index))
+                for shard, profile in pool.imap_unordered(_fire_rows_in_worker, shards):
+                    for i, fired in shard:
+                        rows[i] = fired
+                    dag.add_profile(profile)
+            remaining = [i for i in range(len(labeling_functions)) if rows[i] is None and i not in duplicate_of]
+            fired = _fire_rows([labeling_functions[i] for i in remaining], [semantic_reps[i] for i in remaining], corpus,
+                               index, [function_ner_types[i] for i in remaining], dag)
+            for i, hits in zip(remaining, fired):
+                rows[i] = hits
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        for i, first in duplicate_of.items():
+            rows[i] = rows[first]
+
+        indptr = np.zeros(len(labeling_functions) + 1, dtype=np.int64)
+        np.cumsum([len(fired) for fired in rows], out=indptr[1:])
+        indices = np.concatenate(rows) if len(rows) else np.zeros(0, dtype=np.int32)
+        matrix = sparse.csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr),
+                                   shape=(len(labeling_functions), len(corpus)))
+        if ner_types is None:
+            keys = [(semantic_repr, None) for semantic_repr in semantic_reps]
+        else:
+            keys = list(zip(semantic_reps, ner_types))
+        firing_matrix = cls(matrix, keys, corpus_signature(corpus))
+        firing_matrix.dag = dag
+        return firing_matrix
+
+    def save(self, path):
+        np.savez(path, indptr=self.matrix.indptr, indices=self.matrix.indices, shape=np.array(self.matrix.shape),
+                 keys=np.array([repr(key) for key in self.keys], dtype=str), signature=np.array(self.signature))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            shape = tuple(arrays["shape"].tolist())
+            indices = arrays["indices"]
+            matrix = sparse.csr_matrix((np.ones(len(indices), dtype=bool), indices, arrays["indptr"]), shape=shape)
+            keys = [ast.literal_eval(key) for key in arrays["keys"].tolist()]
+            return cls(matrix, keys, str(arrays["signature"]))
+
+    @classmethod
+    def load_or_build(cls, path, labeling_functions, semantic_reps, corpus, index=None, ner_types=None, workers=1):
+        """
+            Loads a previously saved matrix if it was built from the same corpus and has a row for every
+            function, else builds the matrix (see build) and saves it to path.
+
+            Arguments:
+                path (str) : file to load the matrix from / save the matrix to (.npz)
+                the rest   : see build
+
+            Returns:
+                FiringMatrix : firing matrix of the functions over corpus, rows in the order of labeling_functions
+        """
+        if ner_types is None:
+            keys = [(semantic_repr, None) for semantic_repr in semantic_reps]
+        else:
+            keys = list(zip(semantic_reps, ner_types))
+        if os.path.exists(path):
+            firing_matrix = cls.load(path).select(keys, corpus)
+            if firing_matrix is not None:
+                return firing_matrix
+
+        firing_matrix = cls.build(labeling_functions, semantic_reps, corpus, index, ner_types, workers)
+        firing_matrix.save(path)
+        return firing_matrix
+
+    def select(self, keys, corpus=None):
+        """
+            Matrix of the rows with the given keys, in the given order
+
+            Arguments:
+                keys              (arr) : (semantic_repr, ner_types) tuples
+                corpus (PhraseCorpus) : if given, the matrix also has to have been built from this corpus
+
+            Returns:
+                FiringMatrix | None : None if some key has no row (or has an unknown semantic_repr), or if
+                                      the matrix was built from another corpus
+        """
+        if corpus is not None and corpus_signature(corpus) != self.signature:
+            return None
+        rows = {}
+        for i, key in enumerate(self.keys):
+            if key[0] is not None:
+                rows.setdefault(key, i)
+        if any(key[0] is None or key not in rows for key in keys):
+            return None
+        return FiringMatrix(self.matrix[[rows[key] for key in keys]], list(keys), self.signature)
+
+    def hit_counts(self):
+        """
+            Returns:
+                np.array : number of sentences each function fires on
+        """
+        return np.diff(self.matrix.indptr)
+
+    def count_filter(self, low_end_filter_count, high_end_filter_pct):
+        """
+            Rows of the functions that fire on at least low_end_filter_count sentences and on at most
+            high_end_filter_pct of all sentences
+        """
+        hit_counts = self.hit_counts()
+        keep = (hit_counts / self.matrix.shape[1] <= high_end_filter_pct) & (hit_counts >= low_end_filter_count)
+        return np.flatnonzero(keep)
+
+    def row_digest(self, i):
+        """
+            blake2b digest of row i packed into bits, equal for rows that fire on the same sentences
+        """
+        return _packed_digest(self.matrix.indices[self.matrix.indptr[i]:self.matrix.indptr[i+1]], self.matrix.shape[1])
+
+    def unique_rows(self, rows=None):
+        """
+            Drops functions that fire on exactly the same sentences as an earlier function
+
+            Arguments:
+                rows (arr) : rows to consider, in order, defaults to every row
+
+            Returns:
+                arr : the rows that fire on a set of sentences no earlier row fires on
+        """
+        if rows is None:
+            rows = range(self.matrix.shape[0])
+        seen = set()
+        unique = []
+        for i in rows:
+            digest = self.row_digest(i)
+            if digest not in seen:
+                seen.add(digest)
+                unique.append(i)
+        return unique
+
+    def first_match(self):
+        """
+            Returns:
+                np.array : for each sentence, the first row that fires on it, -1 if no row does
+        """
+        num_rows, num_columns = self.matrix.shape
+        rows = np.repeat(np.arange(num_rows), self.hit_counts())
+        first = np.full(num_columns, num_rows, dtype=np.int64)
+        np.minimum.at(first, self.matrix.indices, rows)
+        first[first == num_rows] = -1
+        return first
+
+    def coverage(self):
+        """
+            Returns:
+                dict : sentences - number of sentences, covered - sentences at least one function fires on,
+                       overlapping - sentences more than one function fires on, coverage - covered / sentences,
+                       hits - number of (function, sentence) pairs that fire
+        """
+        num_columns = self.matrix.shape[1]
+        column_counts = np.bincount(self.matrix.indices, minlength=num_columns)
+        covered = int(np.sum(column_counts > 0))
+        return {"sentences" : num_columns,
+                "covered" : covered,
+                "overlapping" : int(np.sum(column_counts > 1)),
+                "coverage" : covered / num_columns if num_columns else 0.0,
+                "hits" : int(self.matrix.nnz)}
+
+def approximate_filter(labeling_functions, semantic_reps, corpus, low_end_filter_count, high_end_filter_pct, index=None,
+                       ner_types=None, error_rate=0.01, sample_size=1000, seed=0):
+    """
+        Approximate version of FiringMatrix.build followed by count_filter and unique_rows, for large corpora.
+
+        Functions are evaluated on growing random samples of corpus (sample_size sentences, then twice as
+        many, ...), until a confidence interval around the fraction of sentences a function fires on settles
+        whether it passes the count filter. Hit counts that settle it on their own (more than
+        high_end_filter_pct of all sentences, or at least low_end_filter_count sentences) are used as is.
+        A function that is still undecided once the sample is the whole corpus is decided exactly.
+
+        Two functions can only fire on the same sentences if they fire on the same sentences of the first
+        sample, so only functions that collide there are evaluated on the whole corpus to be deduplicated.
+
+        Arguments:
+            labeling_functions, semantic_reps, corpus, index, ner_types : see FiringMatrix.build
+            low_end_filter_count (int) : see TrainedCCGParser
+            high_end_filter_pct (float) : see TrainedCCGParser
+            error_rate          (float) : probability that the decision made for a function from samples differs
+                                          from the exact one (per function), below 1. With 0 every function is
+                                          decided exactly, the same as FiringMatrix.build
+            sample_size           (int) : number of sentences in the first sample
+            seed                  (int) : seed of the random order sentences are sampled in
+
+        Returns:
+            arr : the rows that pass the count filter and fire on a set of sentences no earlier row fires on
+    """
+    if error_rate >= 1:
+        raise ValueError("error_rate must be below 1, got {}".format(error_rate))
+    if error_rate <= 0:
+        firing_matrix = FiringMatrix.build(labeling_functions, semantic_reps, corpus, index, ner_types)
+        return firing_matrix.unique_rows(firing_matrix.count_filter(low_end_filter_count, high_end_filter_pct))
+
+    total = len(corpus)
+    sizes = [min(sample_size, total)]
+    while sizes[-1] < total:
+        sizes.append(min(sizes[-1] * 2, total))
+    # every sample a function is tested on is another chance of a wrong decision
+    z = NormalDist().inv_cdf(1 - error_rate / (2 * len(sizes)))
+    order = np.random.RandomState(seed).permutation(total)
+    function_ner_types = _function_ner_types(labeling_functions, ner_types)
+    dag = SemanticDAG()
+
+    fired = [[] for _ in labeling_functions]
+    counts = np.zeros(len(labeling_functions), dtype=np.int64)
+    evaluated = np.zeros(len(labeling_functions), dtype=np.int64)
+    decisions = np.zeros(len(labeling_functions), dtype=np.int64)
+    undecided = list(range(len(labeling_functions)))
+    previous = 0
+    for size in sizes:
+        rows = np.sort(order[previous:size])
+        sample_fired = _fire_rows([labeling_functions[i] for i in undecided], [semantic_reps[i] for i in undecided], corpus,
+                                  index, [function_ner_types[i] for i in undecided], dag, rows)
+        for i, hits in zip(undecided, sample_fired):
+            fired[i].append(hits)
+            counts[i] += len(hits)
+            evaluated[i] = size
+            decisions[i] = _filter_decision(counts[i], size, total, low_end_filter_count, high_end_filter_pct, z)
+        undecided = [i for i in undecided if decisions[i] == 0]
+        previous = size
+        if len(undecided) == 0:
+            break
+
+    kept = [i for i in range(len(labeling_functions)) if decisions[i] > 0]
+    in_first_sample = np.zeros(total, dtype=bool)
+    in_first_sample[order[:sizes[0]]] = True
+    first_sample_digests = {}
+    collisions = {}
+    for i in kept:
+        hits = np.concatenate(fired[i])
+        first_sample_digests[i] = _packed_digest(hits[in_first_sample[hits]], total)
+        collisions[first_sample_digests[i]] = collisions.get(first_sample_digests[i], 0) + 1
+
+    seen = set()
+    unique = []
+    for i in kept:
+        if collisions[first_sample_digests[i]] > 1:
+            hits = np.concatenate(fired[i])
+            if evaluated[i] < total:
+                rest = _fire_rows([labeling_functions[i]], [semantic_reps[i]], corpus, index, [function_ner_types[i]], dag,
+                                  np.sort(order[evaluated[i]:]))
+                hits = np.concatenate([hits] + rest)
+            digest = _packed_digest(hits, total)
+            if digest in seen:
+                continue
+            seen.add(digest)
+        unique.append(i)
+    return unique
+
+def _wilson_interval(hits, sampled, z):
+    p = hits / sampled
+    denominator = 1 + z * z / sampled
+    center = (p + z * z / (2 * sampled)) / denominator
+    half_width = z * np.sqrt(p * (1 - p) / sampled + z * z / (4 * sampled * sampled)) / denominator
+    return center - half_width, center + half_width
+
+def _filter_decision(hits, sampled, total, low_end_filter_count, high_end_filter_pct, z):
+    """
+        1 if a function that fires on hits of sampled sentences (of total) passes the count filter, -1 if it
+        doesn't, 0 if the sample is too small to tell
+    """
+    if hits / total > high_end_filter_pct:
+        return -1
+    if sampled == total:
+        return 1 if hits >= low_end_filter_count else -1
+    lower, upper = _wilson_interval(hits, sampled, z)
+    if lower > high_end_filter_pct or upper * total < low_end_filter_count:
+        return -1
+    if upper <= high_end_filter_pct and (hits >= low_end_filter_count or lower * total >= low_end_filter_count):
+        return 1
+    return 0
+
+def _packed_digest(fired, num_columns):
+    packed = np.zeros(-(-num_columns // 8), dtype=np.uint8)
+    # same bit order as np.packbits, without building the dense row
+    np.bitwise_or.at(packed, fired >> 3, (0x80 >> (fired & 7)).astype(np.uint8))
+    return hashlib.blake2b(packed.tobytes(), digest_size=16).digest()
+
+def _function_ner_types(labeling_functions, ner_types):
+    # None - NER types aren't checked, False - the function fires on no sentence
+    if ner_types is None:
+        return [None] * len(labeling_functions)
+    return [ner_type if ner_type is not None else False for ner_type in ner_types]
+
+def _fire_rows(labeling_functions, semantic_reps, corpus, index, ner_types, dag, rows=None):
+    """
+        Sentences each labeling function fires on. If rows is given, only those sentences are looked at.
+
+        Functions are bucketed by ner_types (see _function_ner_types), a bucket is only evaluated on the
+        sentences whose SUBJ and OBJ have its NER types. Within a bucket each predicate of dag is evaluated
+        once, and a function fires where all of its predicates apply.
+    """
+    fired = [None] * len(labeling_functions)
+    buckets = {}
+    for i, ner_type in enumerate(ner_types):
+        buckets.setdefault(ner_type, []).append(i)
+    for ner_type, bucket in buckets.items():
+        bucket_rows = rows
+        if ner_type is False:
+            bucket_rows = np.zeros(0, dtype=np.int64)
+        elif ner_type is not None:
+            bucket_rows = corpus.ner_type_rows(ner_type[0], ner_type[1])
+            if rows is not None:
+                bucket_rows = np.intersect1d(rows, bucket_rows, assume_unique=True)
+        if bucket_rows is not None and len(bucket_rows) == 0:
+            for i in bucket:
+                fired[i] = np.zeros(0, dtype=np.int32)
+            continue
+
+        node_hits = {}
+        for i in bucket:
+            if semantic_reps[i] is None:
+                row = utils.apply_labeling_function(labeling_functions[i], None, corpus, None, bucket_rows)
+                fired[i] = np.flatnonzero(row).astype(np.int32)
+                continue
+            hits = None
+            for node in dag.add(semantic_reps[i]):
+                if node not in node_hits:
+                    node_hits[node] = dag.evaluate(node, corpus, index, bucket_rows)
+                hits = node_hits[node] if hits is None else np.intersect1d(hits, node_hits[node], assume_unique=True)
+                if len(hits) == 0:
+                    break
+            fired[i] = hits
+    return fired
+
+_worker_corpus = None
+_worker_index = None
+
+def _init_firing_worker(corpus, index):
+    """
+        Sets up the corpus a FiringMatrix.build worker process applies labeling functions to
+    """
+    global _worker_corpus, _worker_index
+    _worker_corpus = corpus
+    _worker_index = index
+
+def _fire_rows_in_worker(shard):
+    dag = SemanticDAG()
+    fired = _fire_rows([function for _, _, _, function in shard], [semantic_repr for _, semantic_repr, _, _ in shard],
+                       _worker_corpus, _worker_index, [ner_types for _, _, ner_types, _ in shard], dag)
+    return [(i, hits) for (i, _, _, _), hits in zip(shard, fired)], dag.profile()
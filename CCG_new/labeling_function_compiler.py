@@ -0,0 +1,364 @@
+"""
+    Compiles semantic representations of strict labeling functions into flat Python functions.
+
+    utils.create_labeling_function builds a labeling function out of the curried closures of
+    constants.STRICT_MATCHING_OPS, so every call goes through several lambda frames, rebuilds option dicts
+    and re-splits and lowercases quoted words. The compiler runs those closures once, at compile time,
+    with the Phrase left symbolic: everything that doesn't depend on the Phrase (quoted words, options,
+    comparisons) is folded into straight-line Python source, which is compiled with compile().
+
+    Compiled functions apply to the same Phrases as the closures they replace (a closure that raises an
+    exception doesn't apply). Semantic representations the compiler doesn't handle fall back to the closure.
+"""
+from CCG_new import constants
+from CCG_new import utils
+from CCG_new.strict_grammar_functions import merge, count_sublist, sub_span, posi_window, Selection
+
+COMPARE_OPERATORS = {'eq' : '==', 'mt' : '>', 'lt' : '<', 'nmt' : '<=', 'nlt' : '>='}
+COUNT_COMPARES = {'@LessThan' : 'lt', '@AtMost' : 'nmt', '@AtLeast' : 'nlt', '@MoreThan' : 'mt'}
+DEFAULT_OPTION = {'attr': 'word', 'range': -1, 'numAppear': 1, 'cmp': 'nlt', 'onlyCount': False}
+
+class CompiledLabelingFunction():
+    """
+        Strict labeling function compiled from Python source, pickled as its source
+
+        Attributes:
+            source (str) : source of a function named labeling_function that takes in a Phrase
+    """
+    def __init__(self, source):
+        self.source = source
+        namespace = {'_count_sublist' : count_sublist, '_sub_span' : sub_span, '_posi_window' : posi_window}
+        exec(compile(source, "<labeling function>", "exec"), namespace)
+        self.function = namespace['labeling_function']
+
+    def __call__(self, phrase):
+        return self.function(phrase)
+
+    def __getstate__(self):
+        return {'source' : self.source}
+
+    def __setstate__(self, state):
+        self.__init__(state['source'])
+
+    def __repr__(self):
+        return "CompiledLabelingFunction({!r})".format(self.source)
+
+class _Unsupported(Exception):
+    pass
+
+class _Predicate():
+    """
+        Compile time stand-in for the `lambda c: ...` a strict op returns, code is a Python expression over c
+    """
+    def __init__(self, code):
+        self.code = code
+
+class _Words():
+    """
+        Compile time stand-in for the words of the SUBJ or OBJ of a Phrase, var holds their lowercased split
+    """
+    def __init__(self, var):
+        self.var = var
+
+def _literal(value):
+    if isinstance(value, (str, int)) or value is None:
+        return repr(value)
+    if isinstance(value, (tuple, list)):
+        literals = [_literal(v) for v in value]
+        if isinstance(value, tuple):
+            return "({}{})".format(", ".join(literals), "," if len(literals) == 1 else "")
+        return "[{}]".format(", ".join(literals))
+    raise _Unsupported("not a literal: {!r}".format(value))
+
+def _all(predicates):
+    for predicate in predicates:
+        if not isinstance(predicate, _Predicate):
+            raise _Unsupported("not a predicate: {!r}".format(predicate))
+    if len(predicates) == 0:
+        return _Predicate("True")
+    if len(predicates) == 1:
+        return predicates[0]
+    return _Predicate("({})".format(" and ".join(predicate.code for predicate in predicates)))
+
+def _call(function, *args):
+    if not callable(function) or isinstance(function, _Predicate):
+        raise _Unsupported("not callable: {!r}".format(function))
+    predicate = function(*args)
+    if not isinstance(predicate, _Predicate):
+        raise _Unsupported("not a predicate: {!r}".format(predicate))
+    return predicate
+
+class _Compiler():
+    """
+        Mirrors constants.STRICT_MATCHING_OPS and strict_grammar_functions, generating code instead of
+        evaluating a Phrase. Views of the Phrase a function needs (ex: the lowercased tokens between SUBJ
+        and OBJ) are computed once at the top of the function.
+    """
+    def __init__(self):
+        self.preamble = {}
+        self.ops = {
+            ".root"       : self.root,
+            "@Word"       : lambda x: x,
+            "@Is"         : lambda ws, p: self.is_func(ws, p),
+            "@between"    : lambda a: lambda w, option=None: self.at_between(w, option),
+            "@In0"        : lambda arg: lambda w: self.at_In0(arg, w),
+            "@In1"        : lambda arg, w: self.at_In0(arg, w),
+            "@And"        : lambda x, y: merge(x, y),
+            "@Num"        : lambda x, y: {'attr': y, 'num': int(x)},
+            "@WordCount"  : lambda nounNum, nouny, F: lambda useless: self.at_WordCount(nouny, F),
+            "@NumberOf"   : lambda x, f: [x, f],
+            "@By"         : lambda x, f, z: _call(f, x, {'attr': z['attr'], 'range': z['num'], 'numAppear': 1, 'cmp': 'nlt', 'onlyCount': False}),
+            "@Left0"      : lambda arg: lambda w, option=None: self.at_POSI_0('Left', arg, w, option),
+            "@Right0"     : lambda arg: lambda w, option=None: self.at_POSI_0('Right', arg, w, option),
+            "@Range0"     : lambda arg: lambda w, option=None: self.at_POSI_0('Range', arg, w, option),
+            "@Left"       : lambda arg, ws: self.at_POSI('Left', ws, arg),
+            "@Right"      : lambda arg, ws: self.at_POSI('Right', ws, arg),
+            "@Direct"     : lambda func: lambda w: _call(func, w, 'Direct'),
+            "@StartsWith" : lambda x, y: _Predicate("c.with_({}, 'starts', {})".format(_literal(x[-1]), _literal(y))),
+            "@EndsWith"   : lambda x, y: _Predicate("c.with_({}, 'ends', {})".format(_literal(x[-1]), _literal(y))),
+        }
+        for op, cmp in COUNT_COMPARES.items():
+            self.ops[op] = self._count_op(cmp)
+            self.ops[op + "1"] = self._count_op_1(cmp)
+
+    def _count_op(self, cmp):
+        return lambda funcx, nouny: lambda w: self.at_count(cmp, funcx, nouny, w)
+
+    def _count_op_1(self, cmp):
+        return lambda nounynum: lambda x: self.at_count(cmp, x[1], {'attr': x[0], 'num': int(nounynum)}, 'There')
+
+    def value(self, semantic_repr):
+        if isinstance(semantic_repr, tuple):
+            if semantic_repr[0] not in self.ops or len(semantic_repr) == 1:
+                raise _Unsupported("op: {!r}".format(semantic_repr))
+            op = self.ops[semantic_repr[0]]
+            return op(*[self.value(arg) for arg in semantic_repr[1:]])
+        return constants.NER_TERMINAL_TO_EXECUTION_TUPLE.get(semantic_repr, semantic_repr)
+
+    def source(self, semantic_repr):
+        predicate = self.value(semantic_repr)
+        if not isinstance(predicate, _Predicate):
+            raise _Unsupported("not a labeling function: {!r}".format(semantic_repr))
+        lines = ["def labeling_function(c):"]
+        lines.extend("    {} = {}".format(var, code) for var, code in self.preamble.values())
+        lines.append("    return {}".format(predicate.code))
+        return "\n".join(lines) + "\n"
+
+    # views of the Phrase
+
+    def _view(self, key, var, code):
+        if key not in self.preamble:
+            self.preamble[key] = (var, code)
+        return self.preamble[key][0]
+
+    def mid(self):
+        return self._view(('mid',), "_mid", "c.get_mid_span()")
+
+    def span(self, POSI, XoY, range_=-1):
+        span = self._view(('span', POSI, XoY), "_{}_{}".format(POSI.lower(), XoY.lower()),
+                          "c.get_other_posi_span({!r}, {!r})".format(POSI, XoY))
+        if range_ == -1:
+            return span
+        if not isinstance(range_, int):
+            raise _Unsupported("range: {!r}".format(range_))
+        return self._view(('span', POSI, XoY, range_), "{}_{}".format(span, range_).replace("-", "m"),
+                          "_sub_span({0}, *_posi_window(c, {1!r}, {2!r}, {0}[1] - {0}[0], {3}))".format(span, POSI, XoY, range_))
+
+    def window(self, POSI, XoY, attr='tokens'):
+        if not isinstance(attr, str) or not attr.isidentifier():
+            raise _Unsupported("attr: {!r}".format(attr))
+        return self._view(('window', POSI, XoY, attr), "_{}_{}_{}".format(POSI.lower(), XoY.lower(), attr.lower()),
+                          "c.get_lower_other_posi({!r}, {!r}, {!r})".format(POSI, XoY, attr))
+
+    def range_posi(self, XoY):
+        return self._view(('range_posi', XoY), "_range_{}_posi".format(XoY.lower()),
+                          "c.get_other_posi('Range', {!r})['POSI']".format(XoY))
+
+    def arg_words(self, w):
+        # ArgX and ArgY stand for the SUBJ and OBJ word of the Phrase
+        if w == 'ArgY':
+            return _Words(self._view(('words', 'Y'), "_y_words", "c.obj.lower().split()"))
+        elif w == 'ArgX':
+            return _Words(self._view(('words', 'X'), "_x_words", "c.subj.lower().split()"))
+        return w
+
+    @staticmethod
+    def _XoY(arg):
+        XoY = arg[-1]
+        if not isinstance(XoY, str) or XoY not in ['X', 'Y']:
+            raise _Unsupported("arg: {!r}".format(arg))
+        return XoY
+
+    def _count_ngram(self, span, w_split):
+        ngram = "tuple({})".format(w_split.var) if isinstance(w_split, _Words) else _literal(tuple(w_split))
+        if span is None:
+            return "c.count_ngram({})".format(ngram)
+        return "c.count_ngram({0}, {1}[0], {1}[1])".format(ngram, span)
+
+    def _count_code(self, info, w_split):
+        if isinstance(w_split, _Words):
+            return "_count_sublist({}, {})".format(info, w_split.var)
+        if len(w_split) == 0:
+            # every offset, including the one past the end, matches an empty list
+            return "(len({}) + 1)".format(info)
+        if len(w_split) == 1:
+            return "{}.count({!r})".format(info, w_split[0])
+        return "_count_sublist({}, {})".format(info, _literal(w_split))
+
+    def _compare(self, code, option):
+        return _Predicate("({} {} {})".format(code, COMPARE_OPERATORS[option['cmp']], _literal(option['numAppear'])))
+
+    # ops
+
+    def root(self, xs):
+        if type(xs) == tuple:
+            return _all(list(xs))
+        if not isinstance(xs, _Predicate):
+            raise _Unsupported("not a predicate: {!r}".format(xs))
+        return xs
+
+    def is_func(self, ws, ps):
+        if isinstance(ps, tuple):
+            predicates = []
+            for p in ps:
+                if isinstance(ws, tuple):
+                    if ws[0] in Selection:
+                        predicates.append(_call(p, ws))
+                    else:
+                        predicates.append(_all([_call(p, w) for w in ws]))
+                else:
+                    predicates.append(_call(p, ws))
+            return _all(predicates)
+
+        if isinstance(ws, tuple):
+            if ws[0] in Selection:
+                return _call(ps, ws)
+            else:
+                return _all([_call(ps, w) for w in ws])
+        else:
+            return _call(ps, ws)
+
+    def at_POSI(self, POSI, ws, arg):
+        if isinstance(ws, tuple):
+            if ws[0] in Selection:
+                return _Predicate("({} in c.get_other_posi({!r}, {!r})[{}])".format(_literal(ws[1]), POSI, self._XoY(arg), _literal(ws[0])))
+            else:
+                return _all([self.at_POSI_0(POSI, arg, w, None) for w in ws])
+        else:
+            return self.at_POSI_0(POSI, arg, ws, None)
+
+    def at_POSI_0(self, POSI, arg, w, option):
+        if arg not in ['ArgX', 'ArgY']:
+            w, arg = arg, w
+            if POSI == 'Left':
+                POSI = 'Right'
+            elif POSI == 'Right':
+                POSI = 'Left'
+
+        if isinstance(w, tuple) and w[0] not in Selection:
+            return _all([self.at_POSI_0(POSI, arg, ww, option) for ww in w])
+
+        w = self.arg_words(w)
+        if option is None:
+            option = DEFAULT_OPTION
+        XoY = self._XoY(arg)
+        if isinstance(w, tuple):
+            return _Predicate("({} in c.get_other_posi({!r}, {!r})[{}])".format(_literal(w[1]), POSI, XoY, _literal(w[0])))
+
+        w_split = w if isinstance(w, _Words) else w.lower().split()
+        if option == 'Direct':
+            if POSI not in ['Left', 'Right']:
+                raise _Unsupported("Direct {}".format(POSI))
+            info = self.window(POSI, XoY)
+            words = w_split.var if isinstance(w_split, _Words) else _literal(w_split)
+            range_ = "len({})".format(w_split.var) if isinstance(w_split, _Words) else str(len(w_split))
+            if POSI == 'Left':
+                return _Predicate("({0}[max(0, len({0}) - {1}):] == {2})".format(info, range_, words))
+            return _Predicate("({0}[:min(len({0}) - 1, {1} - 1) + 1] == {2})".format(info, range_, words))
+
+        if option['range'] == -1 or option['attr'] == 'tokens':
+            span = self.span(POSI, XoY, option['range'])
+            if option['onlyCount']:
+                return self._compare("({0}[1] - {0}[0])".format(span), option)
+            return self._compare(self._count_ngram(span, w_split), option)
+        else:
+            window = self.window(POSI, XoY, option['attr'])
+            if not isinstance(option['range'], int):
+                raise _Unsupported("range: {!r}".format(option['range']))
+            range_ = _literal(option['range'])
+            if POSI == 'Left':
+                info = "{0}[max(0, len({0}) - {1}):]".format(window, range_)
+            elif POSI == 'Right':
+                info = "{0}[:min(len({0}) - 1, {1} - 1) + 1]".format(window, range_)
+            else:
+                count_posi = self.range_posi(XoY)
+                info = "{0}[max(0, {1} - {2}):min(len({0}), {1} + 1 + {2}) + 1]".format(window, count_posi, range_)
+        if option['onlyCount']:
+            return self._compare("len({})".format(info), option)
+        return self._compare(self._count_code(info, w_split), option)
+
+    def at_between(self, w, option):
+        w = self.arg_words(w)
+        if option is None:
+            option = {'attr': 'word', 'numAppear': 1, 'cmp': 'nlt', 'onlyCount': False}
+        if isinstance(w, tuple):
+            return _Predicate("({} in c.get_mid()[{}])".format(_literal(w[1]), _literal(w[0])))
+        w_split = w if isinstance(w, _Words) else w.lower().split()
+        span = self.mid()
+        if option['onlyCount']:
+            return self._compare("({0}[1] - {0}[0])".format(span), option)
+        return self._compare(self._count_ngram(span, w_split), option)
+
+    def at_count(self, cmp, funcx, nouny, w):
+        if w == 'There':
+            return _call(funcx, w, {'attr': nouny['attr'], 'range': -1, 'numAppear': nouny['num'], 'cmp': cmp, 'onlyCount': True})
+        return _call(funcx, w, {'attr': nouny['attr'], 'range': nouny['num'], 'numAppear': 1, 'cmp': 'nlt', 'onlyCount': False})
+
+    def at_In0(self, arg, w):
+        if arg != 'Sentence':
+            raise _Unsupported("In0 {!r}".format(arg))
+        if isinstance(w, tuple):
+            return _Predicate("({} in c.ner)".format(_literal(w)))
+        return _Predicate("({} > 0)".format(self._count_ngram(None, w.lower().split())))
+
+    def at_WordCount(self, nouny, F):
+        word_option = {'attr': 'word', 'range': -1, 'numAppear': 1, 'cmp': 'nlt', 'onlyCount': False}
+        if isinstance(nouny, tuple):
+            count_option = {'attr': 'tokens', 'range': -1, 'numAppear': sum([len(noun.split()) for noun in nouny]), 'cmp': 'eq', 'onlyCount': True}
+            return _all([_all([_call(F, noun, word_option) for noun in nouny]), _call(F, nouny[0], count_option)])
+        count_option = {'attr': 'tokens', 'range': -1, 'numAppear': len(nouny.split()), 'cmp': 'eq', 'onlyCount': True}
+        return _all([_call(F, nouny, word_option), _call(F, nouny, count_option)])
+
+def labeling_function_source(semantic_repr):
+    """
+        Arguments:
+            semantic_repr (tuple) : hierarchical tuple representation
+
+        Returns:
+            str | None : source of the compiled labeling function, None if the compiler doesn't support
+                         semantic_repr
+    """
+    try:
+        return _Compiler().source(semantic_repr)
+    except Exception:
+        return None
+
+def compile_labeling_function(semantic_repr):
+    """
+        Compiled version of utils.create_labeling_function
+
+        Arguments:
+            semantic_repr (tuple) : hierarchical tuple representation
+
+        Returns:
+            CompiledLabelingFunction | function | false : the compiled function, the closure built by
+                                                          create_labeling_function if semantic_repr can't be
+                                                          compiled, false if no function is creatable
+    """
+    labeling_function = utils.create_labeling_function(semantic_repr)
+    if not labeling_function:
+        return labeling_function
+    source = labeling_function_source(semantic_repr)
+    if source is None:
+        return labeling_function
+    return CompiledLabelingFunction(source)
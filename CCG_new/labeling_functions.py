@@ -0,0 +1,142 @@
+"""
+    Labeling functions as immutable (op, args) nodes of their semantic representation.
+
+    utils.create_labeling_function and utils.create_soft_labeling_function return nested closures, which
+    only dill can pickle, and two closures built from the same semantic representation aren't equal, so they
+    can't be used as dict keys across processes. A LabelingFunction node is built from a semantic
+    representation, compares, hashes and pickles as it, and builds the function it evaluates the first time
+    it's called (strict functions are compiled, see labeling_function_compiler).
+"""
+from CCG_new import utils
+from CCG_new.labeling_function_compiler import compile_labeling_function
+
+class LabelingFunction():
+    """
+        Strict labeling function, called with a Phrase
+
+        Attributes:
+            op             (str) : op of the node, ex: '.root' or '@Is'
+            args         (tuple) : arguments of the op, LabelingFunction nodes or terminals (ex: 'ArgX')
+            semantic_repr (tuple) : hierarchical tuple representation the node was built from
+    """
+    __slots__ = ['op', 'args', 'semantic_repr', '_hash', '_function']
+
+    def __init__(self, op, args):
+        args = tuple(args)
+        semantic_repr = (op,) + tuple(arg.semantic_repr if isinstance(arg, LabelingFunction) else arg for arg in args)
+        object.__setattr__(self, 'op', op)
+        object.__setattr__(self, 'args', args)
+        object.__setattr__(self, 'semantic_repr', semantic_repr)
+        object.__setattr__(self, '_hash', hash((type(self).__name__, semantic_repr)))
+        object.__setattr__(self, '_function', None)
+
+    @classmethod
+    def from_semantic_repr(cls, semantic_repr):
+        """
+            Arguments:
+                semantic_repr (tuple) : hierarchical tuple representation
+
+            Returns:
+                LabelingFunction : root node of semantic_repr
+        """
+        args = [cls.from_semantic_repr(arg) if isinstance(arg, tuple) and len(arg) else arg for arg in semantic_repr[1:]]
+        return cls(semantic_repr[0], args)
+
+    @classmethod
+    def create(cls, semantic_repr):
+        """
+            Same as utils.create_labeling_function, but returns a LabelingFunction
+
+            Returns:
+                LabelingFunction | false : if a function is creatable via the tuple, it is created, else false
+        """
+        labeling_function = cls.from_semantic_repr(semantic_repr)
+        if not labeling_function.function:
+            return False
+        return labeling_function
+
+    def _build(self):
+        return compile_labeling_function(self.semantic_repr)
+
+    @property
+    def function(self):
+        """
+            Function the node evaluates to, false if it isn't creatable
+        """
+        if self._function is None:
+            object.__setattr__(self, '_function', self._build())
+        return self._function
+
+    def __call__(self, *args):
+        return self.function(*args)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._hash == other._hash and self.semantic_repr == other.semantic_repr
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return (type(self), (self.op, self.args))
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.semantic_repr)
+
+class SoftLabelingFunction(LabelingFunction):
+    """
+        Soft labeling function, called with a soft_grammar_functions.SoftBatchContext, returns a 1 x B tensor
+        of scores (see constants.SOFT_MATCHING_OPS)
+    """
+    __slots__ = []
+
+    def _build(self):
+        return utils.create_soft_labeling_function(self.semantic_repr)
+
+class LabeledFunction():
+    """
+        Strict labeling function of an explanation, along with the explanation's label and NER types, called
+        with a Phrase
+
+        Explanations with the same (canonical) semantic representation share one LabelingFunction, even if
+        their labels or NER types differ, so LabelingFunctions can't key the label and NER type maps of
+        TrainedCCGParser. LabeledFunctions compare and hash as (semantic_repr, label, ner_types) instead.
+
+        Attributes:
+            labeling_function (LabelingFunction | function) : strict labeling function the explanation parsed to
+            semantic_repr                           (tuple) : semantic representation the explanation parsed to
+            label                                     (str) : label of the explanation
+            ner_types                        (tuple | None) : NER types of SUBJ and OBJ in the sentence the
+                                                              explanation was written about, None if not "re"
+    """
+    __slots__ = ['labeling_function', 'semantic_repr', 'label', 'ner_types', '_hash']
+
+    def __init__(self, labeling_function, semantic_repr, label, ner_types=None):
+        object.__setattr__(self, 'labeling_function', labeling_function)
+        object.__setattr__(self, 'semantic_repr', semantic_repr)
+        object.__setattr__(self, 'label', label)
+        object.__setattr__(self, 'ner_types', ner_types)
+        object.__setattr__(self, '_hash', hash((type(self).__name__, semantic_repr, label, ner_types)))
+
+    def __call__(self, *args):
+        return self.labeling_function(*args)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def _key(self):
+        return (self.semantic_repr, self.label, self.ner_types)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._hash == other._hash and self._key() == other._key()
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return (type(self), (self.labeling_function, self.semantic_repr, self.label, self.ner_types))
+
+    def __repr__(self):
+        return "{}({!r}, {!r}, {!r})".format(type(self).__name__, self.semantic_repr, self.label, self.ner_types)
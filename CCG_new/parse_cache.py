@@ -0,0 +1,130 @@
+"""
+    Content-addressed on-disk cache of parse results.
+
+    Parsing a token sequence only depends on the sequence itself, the base grammar and the rules of the
+    quoted words in the sequence, so a hash of those three things identifies a parse result. The hash also
+    includes FORMAT_VERSION, which is bumped whenever the code producing cached results (the CYK engine,
+    utils.create_semantic_repr) changes what it returns, so results of older code are never served. Results are
+    stored one pickle file per hash, which lets re-runs on an unchanged (or slightly edited) explanation
+    file skip parsing every explanation that was seen before.
+
+    The cache is bounded in size, once it grows past max_size_bytes the least recently used files are
+    removed.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+
+FORMAT_VERSION = "2"
+
+class ParseCache():
+    """
+        Directory of pickled parse results, named by the hash of what produced them
+
+        Attributes:
+            directory      (str) : directory the cache files live in
+            max_size_bytes (int) : once the cache is larger than this, least recently used files are evicted
+            size           (int) : current size of the cache in bytes
+            hits           (int) : number of successful lookups since the cache was opened
+            misses         (int) : number of failed lookups since the cache was opened
+    """
+    def __init__(self, directory, max_size_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(os.path.getsize(path) for path in self._files())
+
+    @staticmethod
+    def key(tokens, grammar_version, quoted_rules, mode="tokens"):
+        """
+            Hash identifying a parse result
+
+            Arguments:
+                tokens          (arr) : token sequence that was parsed, or token lattice (array of arrays)
+                grammar_version (str) : signature of the base grammar
+                quoted_rules    (arr) : grammar rules of the quoted words found in tokens
+                mode            (str) : what kind of parse the result comes from (ex: "tokens", "lattice")
+
+            Returns:
+                str : hex digest
+        """
+        hasher = hashlib.sha1()
+        for part in (FORMAT_VERSION, mode, grammar_version, repr(tokens), repr(sorted(quoted_rules))):
+            hasher.update(part.encode("utf-8"))
+            hasher.update(b"\0")
+        return hasher.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".p")
+
+    def _files(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".p"):
+                    yield os.path.join(root, name)
+
+    def get(self, key):
+        """
+            Returns the value stored for key, None if there is none
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path) # marks the file as recently used
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+            Stores value under key, evicting old entries if the cache grows too large
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+        # written to a temporary file first so readers never see a partially written entry
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(value, f)
+        os.replace(temp_path, path)
+        self.size += os.path.getsize(path) - previous_size
+        if self.size > self.max_size_bytes:
+            self.evict()
+
+    def evict(self, target_fraction=0.8):
+        """
+            Removes least recently used entries until the cache is under target_fraction of max_size_bytes
+        """
+        entries = []
+        for path in self._files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, path, stat.st_size))
+        entries.sort()
+
+        self.size = sum(entry[2] for entry in entries)
+        target = self.max_size_bytes * target_fraction
+        for _, path, file_size in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+                self.size -= file_size
+            except OSError:
+                continue
+
+    def clear(self):
+        for path in list(self._files()):
+            os.remove(path)
+        self.size = 0
@@ -5,10 +5,10 @@
 
     TrainedCCGParser has these useful attributes on it:
         semantic_reps - semantic_rep version of labeling function
-        labeling_functions - strict labeling functions
+        labeling_functions - strict labeling functions (LabeledFunction) and their labels
         soft_labeling_functions - soft labeling functions
         filtered_raw_explanations - the actual raw explanation text that made it through
-        soft_label_function_to_semantic_map - map from soft_label_function back to semantic_rep of the function
+        soft_label_function_to_semantic_map - map from (soft_label_function, label) back to semantic_rep of the function
 
 """
 import numpy as np
@@ -16,18 +16,27 @@ import json
 from CCG_new import constants
 from CCG_new import utils
 from CCG_new import util_classes as classes
+from CCG_new import compiled_lexicon
+from CCG_new.compiled_lexicon import CompiledLexicon
+from CCG_new.parse_cache import ParseCache
+from CCG_new.phrase_cache import PhraseCache
+from CCG_new.token_index import TokenIndex
+from CCG_new.firing_matrix import FiringMatrix, approximate_filter
+from CCG_new.labeling_functions import LabelingFunction, SoftLabelingFunction, LabeledFunction
+from CCG_new.cyk_engine import CYKEngine
 import os
 import pickle
+import multiprocessing
 import torch.nn as nn
 import torch
 import copy
 from collections import namedtuple
 from nltk.ccg import chart, lexicon
+from nltk.sem.logic import LogicalExpressionException
 import spacy
 import random
 import numpy as np
 import pdb
-import dill
 
 nlp = spacy.load("en_core_web_sm")
 
@@ -39,26 +48,65 @@ class TrainedCCGParser():
     def __init__(self, low_end_filter_count=3, high_end_filter_pct=0.2):
         self.loaded_data = None
         self.grammar = None
+        self.init_grammar = None
+        self.lexicon_path = None
+        self.lexicon = None
+        self.cyk_engine = None
+        self.grammar_version = None
+        self.parse_cache = None
+        self.parse_budget = None
         self.semantic_reps = None
         self.labeling_functions = None
         self.soft_labeling_functions = None
         self.filtered_raw_explanations = None
         self.ner_types = None
+        self.firing_matrix = None
         self.soft_label_function_to_semantic_map = None
         self.low_end_filter_count = low_end_filter_count
         self.high_end_filter_pct = high_end_filter_pct
 
+    def __getstate__(self):
+        """
+            The compiled lexicon and the CYK engine's caches take up megabytes and can be rebuilt from
+            init_grammar, so they aren't pickled. Neither is the parse cache, its directory may not exist
+            where the parser is unpickled. The lexicon and CYK engine are rebuilt the next time the parser
+            parses explanations.
+        """
+        state = self.__dict__.copy()
+        state["lexicon"] = None
+        state["cyk_engine"] = None
+        state["parse_cache"] = None
+        return state
+
     def load_data(self, data):
         self.loaded_data = data
+
+    def set_parse_cache(self, parse_cache):
+        """
+            Sets the ParseCache that build_labeling_rules looks parses up in, None disables caching
+        """
+        self.parse_cache = parse_cache
+
+    def set_parse_budget(self, parse_budget):
+        """
+            Sets the ParseBudget limiting the work spent on each explanation, None removes all limits
+        """
+        self.parse_budget = parse_budget
     
-    def create_and_set_grammar(self, init_grammar=constants.RAW_GRAMMAR):
+    def create_and_set_grammar(self, init_grammar=constants.RAW_GRAMMAR, lexicon_path=None):
         """
             Function that takes initial fixed grammar and adds some loaded_data specific rules to the grammar
             Rules associated with words found in explanations from loaded_data are added to the grammar
             After rules are added the class property grammar is set.
 
+            Only the initial grammar is compiled, into the class property lexicon which the class property
+            cyk_engine parses with. Each explanation is parsed against a scope of this lexicon holding just
+            the rules of its own quoted words (see explanation_lexicon), so parsing an explanation doesn't get
+            slower as more explanations are loaded.
+
             Arguments:
                 init_grammar (str) : initial grammar to use
+                lexicon_path (str) : if set, the compiled lexicon is loaded from/saved to this path
         """
         quote_words = {}
         for i, triple in enumerate(self.loaded_data):
@@ -73,14 +121,38 @@ class TrainedCCGParser():
                             quote_words[terminals[0]] = 1
         
         self.grammar = utils.add_rules_to_grammar(quote_words, init_grammar)
+        self.grammar_version = compiled_lexicon.grammar_signature(init_grammar)
+        self.init_grammar = init_grammar
+        self.lexicon_path = lexicon_path
+        self.lexicon = None
+        self.cyk_engine = None
+        self._load_lexicon()
+
+    def _load_lexicon(self):
+        """
+            Compiles init_grammar into the lexicon and creates the CYK engine, unless they already exist
+            (they are left out when the parser is pickled)
+        """
+        if self.lexicon is None:
+            if self.lexicon_path:
+                self.lexicon = CompiledLexicon.load_or_compile(self.init_grammar, self.lexicon_path)
+            else:
+                self.lexicon = compiled_lexicon.compile_lexicon(self.init_grammar)
+        if self.cyk_engine is None:
+            self.cyk_engine = CYKEngine(self.lexicon)
 
     def tokenize_explanations(self):
         """
             Assuming data has been loaded, and grammar and parser have been created, we start the process of
             parsing explanations into Labeling Functions. Steps performed by this function are:
                 1. Explanation gets chunked (if needed)
-                2. Explanations get tokenized
+                2. Explanations get tokenized, both as a list of token sequences and as a token lattice
+
+            If the parser has a parse_budget with max_tokenizations set, ambiguous chunks that would take an
+            explanation over the limit only keep their first possible tokens. This is recorded in the
+            datapoint's parse_cutoffs.
         """
+        max_tokenizations = self.parse_budget.max_tokenizations if self.parse_budget else None
         for i, datapoint in enumerate(self.loaded_data):
             if len(datapoint.raw_explanation):
                 if datapoint.chunked_explanation:
@@ -90,11 +162,17 @@ class TrainedCCGParser():
                     chunks = utils.clean_and_chunk(explanation, nlp)
                     self.loaded_data[i].chunked_explanation = chunks
                 tokenizations = [[]]
+                token_lattice = []
+                parse_cutoffs = {}
                 for chunk in chunks:
                     predicates = utils.convert_chunk_to_terminal(chunk)
                     if predicates:
                         if predicates[0].startswith("\"") and predicates[0].endswith("\""):
                             predicates[0] = utils.prepare_token_for_rule_addition(predicates[0])
+                        if max_tokenizations and len(tokenizations) * len(predicates) > max_tokenizations:
+                            predicates = predicates[:max(1, max_tokenizations // len(tokenizations))]
+                            parse_cutoffs["max_tokenizations"] = parse_cutoffs.get("max_tokenizations", 0) + 1
+                        token_lattice.append(list(predicates))
                         if len(predicates) == 1:
                             for tokenization in tokenizations:
                                 tokenization.append(predicates[0])
@@ -108,9 +186,11 @@ class TrainedCCGParser():
                             tokenizations = temp_tokenizations
 
                 self.loaded_data[i].tokenized_explanations = tokenizations
+                self.loaded_data[i].token_lattice = token_lattice
+                self.loaded_data[i].parse_cutoffs = parse_cutoffs
 
         
-    def build_labeling_rules(self, verbose=True):
+    def build_labeling_rules(self, verbose=True, native_cyk=True, lattice=False, workers=1):
         """
             Assuming explanations have already been tokenized, and beam=False, we convert token sequences
             into labeling functions. Several token sequences are often mapped to the same labeling function,
@@ -119,28 +199,58 @@ class TrainedCCGParser():
                 1. Token Sequences -> Parse Trees
                 2. Parse Trees -> Semantic Representation
                 3. Semantic Representation -> Labeling Function
+
+            Semantic representations are canonicalized (see utils.canonical_semantic_repr) before step 3, so parses
+            that only differ in @And argument order or @Word wrappers share one labeling function.
+
+            Steps 1 and 2 can be spread over a pool of processes, each with its own copy of the compiled
+            grammar. Results are consumed in input order, so the output doesn't depend on the number of workers.
+
+            If the parser has a parse_budget, CYK cells that exceed it are cut down to a beam, and the
+            limits hit are added to each datapoint's parse_cutoffs.
+
+            Arguments:
+                verbose    (bool) : whether to print progress
+                native_cyk (bool) : parse with the CYKEngine, else with utils.parse_tokens (NLTK chart per pair)
+                lattice    (bool) : parse the token lattice of each explanation in one chart with the CYKEngine,
+                                    instead of parsing every tokenization on its own. Produces the same
+                                    semantic representations and counts.
+                workers     (int) : number of processes to parse explanations with
         """
-        cut_off = int(len(self.loaded_data) * 0.2)
-        for i, datapoint in enumerate(self.loaded_data):
-            if len(datapoint.raw_explanation):
-                tokenizations = self.loaded_data[i].tokenized_explanations
-                logic_forms = []
-                for tokenization in tokenizations:
-                    try:
-                        parses = list(utils.parse_tokens(tokenization, self.grammar))
-                        logic_forms += parses
-                    except:
-                        continue
+        self._load_lexicon()
+        explanation_indices = [i for i, datapoint in enumerate(self.loaded_data) if len(datapoint.raw_explanation)]
+        jobs = [(self.loaded_data[i].tokenized_explanations, self.loaded_data[i].token_lattice)
+                for i in explanation_indices]
+        report_every = max(1, len(jobs) // 10)
+        canonical_functions = {}
+
+        pool = None
+        if workers > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(workers, initializer=_init_parse_worker,
+                                        initargs=(self.lexicon, self.grammar_version, self.parse_cache,
+                                                  self.parse_budget, native_cyk, lattice))
+            chunksize = max(1, len(jobs) // (workers * 8))
+            parsed_explanations = pool.imap(_parse_explanation_in_worker, jobs, chunksize)
+        else:
+            parsed_explanations = (self._parse_explanation(tokenizations, token_lattice, native_cyk, lattice)
+                                   for tokenizations, token_lattice in jobs)
+
+        try:
+            for done, (i, (logic_forms, parse_cutoffs)) in enumerate(zip(explanation_indices, parsed_explanations)):
+                datapoint = self.loaded_data[i]
+                if datapoint.parse_cutoffs is None:
+                    datapoint.parse_cutoffs = {}
+                for limit, count in parse_cutoffs.items():
+                    datapoint.parse_cutoffs[limit] = datapoint.parse_cutoffs.get(limit, 0) + count
                 semantic_counts = {}
                 if len(logic_forms):
                     semantic_counts = {}
-                    for parse in logic_forms:
-                        semantic_repr = utils.create_semantic_repr(parse)
+                    for parse, count, semantic_repr in logic_forms:
                         if semantic_repr:
                             if semantic_repr in semantic_counts:
-                                semantic_counts[semantic_repr] += 1
+                                semantic_counts[semantic_repr] += count
                             else:
-                                semantic_counts[semantic_repr] = 1
+                                semantic_counts[semantic_repr] = count
                     
                     if len(semantic_counts) > 1:
                         semantic_counts = utils.check_clauses_in_parse_filter(semantic_counts)
@@ -150,7 +260,11 @@ class TrainedCCGParser():
                 labeling_functions = {}
                 if len(semantic_counts):
                     for key in semantic_counts:
-                        labeling_function = utils.create_labeling_function(key)
+                        # parses with the same canonical form share one labeling function
+                        canonical_key = utils.canonical_semantic_repr(key)
+                        if canonical_key not in canonical_functions:
+                            canonical_functions[canonical_key] = LabelingFunction.create(canonical_key)
+                        labeling_function = canonical_functions[canonical_key]
                         if labeling_function:
                             try:
                                 if labeling_function(datapoint.sentence): # filtering out labeling functions that don't even apply on their own datapoint
@@ -160,17 +274,120 @@ class TrainedCCGParser():
 
                 self.loaded_data[i].labeling_functions = labeling_functions
 
-            if verbose:
-                if i > 0 and i % cut_off == 0:
-                    print("Parser: 20% more explanations parsed")
+                if verbose and ((done + 1) % report_every == 0 or done + 1 == len(jobs)):
+                    print("Parser: {}/{} explanations parsed".format(done + 1, len(jobs)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
         
         with open("loaded_data.p", "wb") as f:
-            dill.dump(self.loaded_data, f)
+            pickle.dump(self.loaded_data, f)
         
         # with open("loaded_data.p", "rb") as f:
-        #     self.loaded_data = dill.load(f)
+        #     self.loaded_data = pickle.load(f)
         
-    def matrix_filter(self, unlabeled_data, task="re"):
+    def _quoted_rules(self, tokens, lexicon):
+        """
+            Lexicon rules of the quoted words in a token sequence (or token lattice)
+        """
+        words = set()
+        for token in tokens:
+            for word in (token if isinstance(token, list) else [token]):
+                if isinstance(word, str) and word.startswith("\""):
+                    words.add(word)
+        return [word + " => " + str(token) for word in sorted(words) for token in lexicon.categories(word)]
+
+    def _parse_explanation(self, tokenizations, token_lattice, native_cyk=True, lattice=False):
+        """
+            Parses all tokenizations of one explanation, within the parser's parse_budget if it has one
+
+            Returns:
+                arr  : list of (parse, count, semantic representation) tuples
+                dict : key - name of a parse budget limit that was hit, value - number of cells it cut
+        """
+        limits = self.parse_budget.start() if self.parse_budget else None
+        explanation_lexicon = self.explanation_lexicon(token_lattice if lattice else tokenizations)
+        if lattice:
+            logic_forms = self._parse_and_represent(token_lattice, explanation_lexicon, native_cyk, lattice, limits)
+        else:
+            logic_forms = []
+            for tokenization in tokenizations:
+                logic_forms += self._parse_and_represent(tokenization, explanation_lexicon, native_cyk, lattice, limits)
+        return logic_forms, (limits.cutoffs if limits else {})
+
+    def explanation_lexicon(self, tokenizations):
+        """
+            Builds the lexicon an explanation is parsed against: a scope of the compiled base grammar with
+            the rules of the explanation's quoted words added to it. Words the base lexicon already knows
+            aren't added again.
+
+            Arguments:
+                tokenizations (arr) : tokenizations (or token lattice) of the explanation
+
+            Returns:
+                LexiconScope : lexicon for the explanation
+        """
+        self._load_lexicon()
+        quote_words = {}
+        for tokenization in tokenizations:
+            for token in tokenization:
+                # tokens aren't always words, e.g. "," maps to ['$Separator', []]
+                if not isinstance(token, str) or not token:
+                    continue
+                if token.startswith("\"") and token.endswith("\"") and not self.lexicon.categories(token):
+                    quote_words[token] = 1
+
+        explanation_lexicon = self.lexicon.scope()
+        explanation_lexicon.add_rules(utils.add_rules_to_grammar(quote_words, ""))
+        return explanation_lexicon
+
+    def _parse_and_represent(self, tokens, lexicon, native_cyk=True, lattice=False, limits=None):
+        """
+            Parses a token sequence (or token lattice if lattice=True) and converts each parse into its
+            semantic representation. If the parser has a parse_cache, results are looked up in / saved to it.
+            Parses that had cells cut by the limits aren't saved, as the wall-clock limit makes them depend on
+            timing. Neither are explanations whose semantics NLTK fails to compose, which have no parses. Any
+            other error propagates. The limits aren't applied when parsing with utils.parse_tokens.
+
+            Arguments:
+                tokens             (arr) : token sequence, or token lattice if lattice=True
+                lexicon   (LexiconScope) : lexicon of the explanation, see explanation_lexicon
+                native_cyk        (bool) : parse with the CYKEngine, else with utils.parse_tokens
+                lattice           (bool) : whether tokens is a token lattice
+                limits     (ParseLimits) : limits to parse within, None for no limits
+
+            Returns:
+                arr : list of (parse, count, semantic representation) tuples
+        """
+        if self.parse_cache is not None:
+            mode = "lattice" if lattice else "tokens"
+            if limits is not None:
+                mode += "_" + limits.budget.signature()
+            key = self.parse_cache.key(tokens, self.grammar_version, self._quoted_rules(tokens, lexicon), mode)
+            logic_forms = self.parse_cache.get(key)
+            if logic_forms is not None:
+                return logic_forms
+
+        cutoff_count = sum(limits.cutoffs.values()) if limits else 0
+        try:
+            if lattice:
+                parses = self.cyk_engine.parse_lattice(tokens, limits, lexicon)
+            elif native_cyk:
+                parses = [(parse, 1) for parse in self.cyk_engine.parse(tokens, limits, lexicon)]
+            else:
+                parses = [(parse, 1) for parse in utils.parse_tokens(tokens, lexicon)]
+        except (AssertionError, LogicalExpressionException):
+            # the explanation has no parses, but this isn't saved to the cache in case the error is fixed
+            return []
+        logic_forms = [(parse, count, utils.create_semantic_repr(parse)) for parse, count in parses]
+
+        if self.parse_cache is not None and (limits is None or sum(limits.cutoffs.values()) == cutoff_count):
+            self.parse_cache.put(key, logic_forms)
+        return logic_forms
+
+    def matrix_filter(self, unlabeled_data, task="re", token_index_path=None, firing_matrix_path=None, workers=1,
+                      approximate=False, error_rate=0.01):
         """
             Version of BabbleLabbel's filter bank concept. Label Functions that don't apply to the original
             sentence that the explanation was written about have already been filtered out in build_labeling_rules.
@@ -182,106 +399,94 @@ class TrainedCCGParser():
             the rest.
 
             The remaining functions are then stored alongside their labels.
+
+            Functions are only evaluated on the datapoints that contain the words their semantic representation
+            requires, found with a TokenIndex of unlabeled_data. If token_index_path is given the index is saved
+            there, and re-used by later calls on the same data.
+
+            Which function applies to which datapoint is stored as a FiringMatrix in self.firing_matrix, both
+            filters are read off of it. If firing_matrix_path is given the matrix is saved there, and re-used by
+            later calls with the same functions on the same data. Functions are applied by a pool of
+            processes if workers > 1 (see FiringMatrix.build). Functions with the same canonical semantic
+            representation, ex: from different explanations, are evaluated once.
+
+            If approximate is True, functions are instead filtered on growing random samples of unlabeled_data,
+            and each function's filter decision may differ from the exact one with probability error_rate
+            (see firing_matrix.approximate_filter). No FiringMatrix is built in this case.
         """
         labeling_functions = []
+        labeled_functions = []
         semantic_reps = []
         raw_explanations = []
-        function_label_map = {}
 
+        ner_types = None
         if task == "re":
             ner_types = []
 
         for i, datapoint in enumerate(self.loaded_data):
             labeling_functions_dict = datapoint.labeling_functions
             for key in labeling_functions_dict:
-                function = labeling_functions_dict[key]
+                labeled_function = self._labeled_function(datapoint, key, task)
                 labeling_functions.append(labeling_functions_dict[key])
+                labeled_functions.append(labeled_function)
                 semantic_reps.append(key)
                 raw_explanations.append(datapoint.raw_explanation)
-                function_label_map[function] = datapoint.label
 
                 if task == "re":
-                    original_phrase = datapoint.sentence
-                    subj_type = original_phrase.ners[original_phrase.subj_posi].lower()
-                    obj_type = original_phrase.ners[original_phrase.obj_posi].lower()
-                    ner_types.append((subj_type, obj_type))
+                    ner_types.append(labeled_function.ner_types)
 
         
-        matrix = [[] for i in range(len(labeling_functions))]
-
-        for i, function in enumerate(labeling_functions):
-            for entry in unlabeled_data:
-                try:
-                    if function(entry):
-                        if task == "re":
-                            subj_type = entry.ners[entry.subj_posi].lower()
-                            obj_type = entry.ners[entry.obj_posi].lower()
-                            if ner_types[i][0] == subj_type and ner_types[i][1] == obj_type:
-                                matrix[i].append(1)
-                            else:
-                                matrix[i].append(0)
-                        else:
-                            matrix[i].append(1)
-                    else:
-                        matrix[i].append(0)
-                except:
-                    matrix[i].append(0)
-        
-        matrix = np.array(matrix, dtype=np.int32)
-
-        row_sums = np.sum(matrix, axis=1)
+        # canonical semantic representations, from the functions themselves
+        function_reps = [function.semantic_repr for function in labeling_functions]
+        corpus = classes.PhraseCorpus(unlabeled_data)
+        if token_index_path:
+            index = TokenIndex.load_or_build(corpus, token_index_path)
+        else:
+            index = TokenIndex.from_corpus(corpus)
+        if approximate:
+            self.firing_matrix = None
+            kept = approximate_filter(labeling_functions, function_reps, corpus, self.low_end_filter_count,
+                                      self.high_end_filter_pct, index, ner_types, error_rate)
+        else:
+            if firing_matrix_path:
+                firing_matrix = FiringMatrix.load_or_build(firing_matrix_path, labeling_functions, function_reps, corpus, index, ner_types,
+                                                          workers)
+            else:
+                firing_matrix = FiringMatrix.build(labeling_functions, function_reps, corpus, index, ner_types, workers)
+            self.firing_matrix = firing_matrix
 
-        total_data_points = len(unlabeled_data)
+            # print("Total Hits {}".format(firing_matrix.matrix.nnz))
 
-        functions_to_delete = []
-        for i, r_sum in enumerate(row_sums):
-            if r_sum/total_data_points > self.high_end_filter_pct or r_sum < self.low_end_filter_count:
-                functions_to_delete.append(i)
-        
-        # print("Total Hits {}".format(sum(row_sums)))
-        
-        # print("Count Filter {}".format(functions_to_delete))
-
-        matrix = np.delete(matrix, functions_to_delete, 0)
-        functions_to_delete.sort(reverse=True)
-        for index in functions_to_delete:
-            del labeling_functions[index]
-            del semantic_reps[index]
-            del raw_explanations[index]
-            if task == "re":
-                del ner_types[index]
-        
-        hashes = {}
-        functions_to_delete = []
-        for i, row in enumerate(matrix):
-            row_hash = hash(str(list(row))) # same as babble-labbel
-            if row_hash in hashes:
-                functions_to_delete.append(i)
-                # print("{} conflicted with {}".format(i, hashes[row_hash]))
-            else:
-                hashes[row_hash] = i
-
-        # print("Hash Filter {}".format(functions_to_delete))
-        functions_to_delete.sort(reverse=True)
-        for index in functions_to_delete:
-            del labeling_functions[index]
-            del semantic_reps[index]
-            del raw_explanations[index]
-            if task == "re":
-                del ner_types[index]
+            kept = firing_matrix.unique_rows(firing_matrix.count_filter(self.low_end_filter_count, self.high_end_filter_pct))
 
         self.labeling_functions = {}
         self.semantic_reps = {}
         self.filtered_raw_explanations = {}
         if task == "re":
             self.ner_types = {}
-        for i, function in enumerate(labeling_functions):
-            self.labeling_functions[function] = function_label_map[function]
+        for i in kept:
+            function = labeled_functions[i]
+            self.labeling_functions[function] = function.label
             self.semantic_reps[semantic_reps[i]] = function
             self.filtered_raw_explanations[semantic_reps[i]] = raw_explanations[i]
             
             if task == "re":
-                self.ner_types[function] = ner_types[i]
+                self.ner_types[function] = function.ner_types
+
+    @staticmethod
+    def _labeled_function(datapoint, key, task):
+        """
+            Returns:
+                LabeledFunction : labeling function of datapoint's explanation parsed to key, with its label and
+                                  NER types, functions shared by explanations with other labels stay apart
+        """
+        ner_types = None
+        if task == "re":
+            original_phrase = datapoint.sentence
+            subj_type = original_phrase.ners[original_phrase.subj_posi].lower()
+            obj_type = original_phrase.ners[original_phrase.obj_posi].lower()
+            ner_types = (subj_type, obj_type)
+        return LabeledFunction(datapoint.labeling_functions[key], key, datapoint.label, ner_types)
         
     def set_final_datastructures(self, task="re"):
         self.labeling_functions = {}
@@ -292,31 +497,51 @@ class TrainedCCGParser():
         for i, datapoint in enumerate(self.loaded_data):
             labeling_functions_dict = datapoint.labeling_functions
             for key in labeling_functions_dict:
-                function = labeling_functions_dict[key]
-                self.labeling_functions[function] = datapoint.label
+                function = self._labeled_function(datapoint, key, task)
+                self.labeling_functions[function] = function.label
                 self.semantic_reps[key] = function
                 self.filtered_raw_explanations[key] = datapoint.raw_explanation
 
                 if task == "re":
-                    original_phrase = datapoint.sentence
-                    subj_type = original_phrase.ners[original_phrase.subj_posi].lower()
-                    obj_type = original_phrase.ners[original_phrase.obj_posi].lower()
-                    self.ner_types[function] = (subj_type, obj_type)
+                    self.ner_types[function] = function.ner_types
 
 
     def build_soft_labeling_functions(self):
         self.soft_labeling_functions = []
         self.soft_label_function_to_semantic_map = {}
         soft_filtered_raw_explanations = {}
-        for key in self.semantic_reps:
-            soft_labeling_function = utils.create_soft_labeling_function(key)
-            if soft_labeling_function:
-                self.soft_labeling_functions.append((soft_labeling_function, self.labeling_functions[self.semantic_reps[key]]))
-                self.soft_label_function_to_semantic_map[soft_labeling_function] = key
-                soft_filtered_raw_explanations[key] = self.filtered_raw_explanations[key]
+        for function, label in self.labeling_functions.items():
+            # explanations with the same canonical semantic representation and label share a soft function
+            semantic_repr = getattr(function.labeling_function, 'semantic_repr', function.semantic_repr)
+            soft_labeling_function = SoftLabelingFunction.create(semantic_repr)
+            if soft_labeling_function and (soft_labeling_function, label) not in self.soft_label_function_to_semantic_map:
+                self.soft_labeling_functions.append((soft_labeling_function, label))
+                self.soft_label_function_to_semantic_map[(soft_labeling_function, label)] = function.semantic_repr
+                if function.semantic_repr in self.filtered_raw_explanations:
+                    soft_filtered_raw_explanations[function.semantic_repr] = self.filtered_raw_explanations[function.semantic_repr]
         
         self.filtered_raw_explanations = soft_filtered_raw_explanations
 
+_worker_parser = None
+_worker_options = None
+
+def _init_parse_worker(lexicon, grammar_version, parse_cache, parse_budget, native_cyk, lattice):
+    """
+        Sets up the TrainedCCGParser a build_labeling_rules worker process parses with
+    """
+    global _worker_parser, _worker_options
+    _worker_parser = TrainedCCGParser()
+    _worker_parser.lexicon = lexicon
+    _worker_parser.cyk_engine = CYKEngine(lexicon)
+    _worker_parser.grammar_version = grammar_version
+    _worker_parser.parse_cache = parse_cache
+    _worker_parser.parse_budget = parse_budget
+    _worker_options = (native_cyk, lattice)
+
+def _parse_explanation_in_worker(job):
+    tokenizations, token_lattice = job
+    return _worker_parser._parse_explanation(tokenizations, token_lattice, *_worker_options)
+
 class CCGParserTrainer():
     """
         Wrapper object to train a TrainedCCGParser object
@@ -338,6 +563,7 @@ class CCGParserTrainer():
         self.parser = TrainedCCGParser()
         self.unlabeled_data = unlabeled_data if unlabeled_data != None else []
         self.explanation_data = explanation_data
+        self.phrase_cache = None
     
     def load_data(self, path):
         if len(path):
@@ -347,10 +573,9 @@ class CCGParserTrainer():
             data = self.explanation_data
         
         processed_data = []
-        for dic in data:
-            text = dic[self.text_key]
+        phrases = utils.generate_phrases([dic[self.text_key] for dic in data], nlp, phrase_cache=self.phrase_cache)
+        for dic, phrase_for_text in zip(data, phrases):
             explanation = dic[self.exp_key]
-            phrase_for_text = utils.generate_phrase(text, nlp)
             label = dic[self.label_key]
             data_point = classes.DataPoint(phrase_for_text, label, explanation)
             processed_data.append(data_point)
@@ -364,9 +589,7 @@ class CCGParserTrainer():
         else:
             data = self.unlabeled_data
             self.unlabeled_data = []
-        for entry in data:
-            phrase_for_text = utils.generate_phrase(entry, nlp)
-            self.unlabeled_data.append(phrase_for_text)
+        self.unlabeled_data.extend(utils.generate_phrases(data, nlp, phrase_cache=self.phrase_cache))
         
         if cache:
             with open("training_phrases.p", "wb") as f:
@@ -374,24 +597,32 @@ class CCGParserTrainer():
         # with open("training_phrases.p", "rb") as f:
         #     self.unlabeled_data = pickle.load(f)
 
-    def train(self, matrix_filter=False, build_soft_functions=True, verbose=True):
+    def train(self, matrix_filter=False, build_soft_functions=True, verbose=True, lexicon_path=None, lattice=False,
+              parse_cache_dir=None, workers=1, parse_budget=None, phrase_cache_path=None, token_index_path=None,
+              firing_matrix_path=None, approximate_filter=False):
+        if phrase_cache_path:
+            self.phrase_cache = PhraseCache(phrase_cache_path)
         self.load_data(self.params["explanation_file"])
+        if parse_cache_dir:
+            self.parser.set_parse_cache(ParseCache(parse_cache_dir))
+        self.parser.set_parse_budget(parse_budget)
         if verbose:
             print("Parser: Loaded explanation data")
-        self.parser.create_and_set_grammar()
+        self.parser.create_and_set_grammar(lexicon_path=lexicon_path)
         if verbose:
             print("Parser: Created and Set Grammar")
         self.parser.tokenize_explanations()
         if verbose:
             print("Parser: Tokenized Explanations")
-        self.parser.build_labeling_rules()
+        self.parser.build_labeling_rules(verbose=verbose, lattice=lattice, workers=workers)
         if verbose:
             print("Parser: Built Labeling Rules")
         if matrix_filter:
             self.prepare_unlabeled_data(self.params["unlabeled_data_file"])
             if verbose:
                 print("Parser: Prepared unlabeled data")
-            self.parser.matrix_filter(self.unlabeled_data, self.params["task"])
+            self.parser.matrix_filter(self.unlabeled_data, self.params["task"], token_index_path, firing_matrix_path, workers,
+                                      approximate_filter)
             if verbose:
                 print("Parser: Filtered out bad explanations")
         else:
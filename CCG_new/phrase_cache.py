@@ -0,0 +1,129 @@
+"""
+    Persistent sqlite3 cache of Phrase objects.
+
+    Building a Phrase means running a sentence through spaCy, which dominates the time it takes to
+    (re)build datasets. The Phrase of a sentence only depends on the sentence and on the spaCy model that
+    processed it, so rows are keyed by a hash of the sentence and a version string of the model. A warm
+    rebuild over the same data can then skip NER entirely.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+from CCG_new import util_classes
+
+class PhraseCache():
+    """
+        sqlite3 table of the values a Phrase is built from, keyed by (sentence_hash, model)
+
+        Attributes:
+            path   (str) : path of the sqlite3 database file
+            hits   (int) : number of sentences found in the cache since it was opened
+            misses (int) : number of sentences not found in the cache since it was opened
+    """
+    # sqlite limits the number of variables bound in a single statement
+    MAX_QUERY_SIZE = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS phrases ("
+                                "sentence_hash TEXT NOT NULL, "
+                                "model TEXT NOT NULL, "
+                                "tokens TEXT NOT NULL, "
+                                "ners TEXT NOT NULL, "
+                                "subj_posi INTEGER NOT NULL, "
+                                "obj_posi INTEGER NOT NULL, "
+                                "PRIMARY KEY (sentence_hash, model))")
+        self.connection.commit()
+
+    def __getstate__(self):
+        # connections can't be pickled, a copy re-opens the database instead
+        return {"path" : self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    @staticmethod
+    def sentence_hash(sentence):
+        return hashlib.sha1(sentence.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def model_version(nlp):
+        """
+            String identifying a spaCy model, Phrases built by different models are cached separately
+
+            Arguments:
+                nlp (spaCy model) : pre-loaded spaCy model
+
+            Returns:
+                str : ex: en_core_web_sm-3.7.1
+        """
+        meta = nlp.meta
+        return "{}_{}-{}".format(meta.get("lang", ""), meta.get("name", ""), meta.get("version", ""))
+
+    def get_many(self, sentences, nlp):
+        """
+            Looks up the Phrase of each sentence
+
+            Arguments:
+                sentences   (arr) : raw sentences, exactly as they would be passed to generate_phrase
+                nlp (spaCy model) : model the Phrases were built with
+
+            Returns:
+                arr : Phrase objects in the same order as sentences, None for sentences not in the cache
+        """
+        model = self.model_version(nlp)
+        hashes = [self.sentence_hash(sentence) for sentence in sentences]
+        rows = {}
+        unique_hashes = list(set(hashes))
+        for start in range(0, len(unique_hashes), self.MAX_QUERY_SIZE):
+            chunk = unique_hashes[start:start+self.MAX_QUERY_SIZE]
+            query = "SELECT sentence_hash, tokens, ners, subj_posi, obj_posi FROM phrases " \
+                    "WHERE model = ? AND sentence_hash IN ({})".format(",".join("?" * len(chunk)))
+            for sentence_hash, tokens, ners, subj_posi, obj_posi in self.connection.execute(query, [model] + chunk):
+                rows[sentence_hash] = (tokens, ners, subj_posi, obj_posi)
+
+        phrases = []
+        for sentence_hash in hashes:
+            if sentence_hash in rows:
+                tokens, ners, subj_posi, obj_posi = rows[sentence_hash]
+                phrases.append(util_classes.Phrase(json.loads(tokens), json.loads(ners), subj_posi, obj_posi))
+                self.hits += 1
+            else:
+                phrases.append(None)
+                self.misses += 1
+        return phrases
+
+    def put_many(self, sentences, phrases, nlp):
+        """
+            Stores the Phrase of each sentence, replacing any existing entry
+
+            Arguments:
+                sentences   (arr) : raw sentences
+                phrases     (arr) : Phrase objects, one per sentence
+                nlp (spaCy model) : model the Phrases were built with
+        """
+        model = self.model_version(nlp)
+        rows = [(self.sentence_hash(sentence), model, json.dumps(phrase.tokens), json.dumps(phrase.ners),
+                 phrase.subj_posi, phrase.obj_posi) for sentence, phrase in zip(sentences, phrases)]
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO phrases VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def get(self, sentence, nlp):
+        return self.get_many([sentence], nlp)[0]
+
+    def put(self, sentence, phrase, nlp):
+        self.put_many([sentence], [phrase], nlp)
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM phrases")
+
+    def close(self):
+        self.connection.close()
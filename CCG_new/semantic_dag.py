@@ -0,0 +1,161 @@
+"""
+    Common-subexpression elimination across strict labeling functions.
+
+    A strict labeling function is a conjunction of sentence level predicates (ex: "'of' is between ArgX and
+    ArgY"), and many explanations share some of them. SemanticDAG splits semantic representations into
+    these predicates and hash-conses them, so every distinct predicate is one node, no matter how many
+    labeling functions use it. Nodes are evaluated over a whole PhraseCorpus at once, callers evaluate a
+    node once per sentence and intersect the results of a function's nodes.
+
+    Splitting is exact: '.root' and '@Is' both apply all of their predicates, and a predicate that raises
+    an exception makes the whole labeling function not apply, the same as the node it becomes not applying.
+"""
+import numpy as np
+from CCG_new import utils
+from CCG_new import token_index
+from CCG_new.labeling_functions import LabelingFunction
+
+PREDICATE_OPS = ['@Is', '@In1', '@By', '@Left', '@Right', '@StartsWith', '@EndsWith']
+
+def _and_leaves(semantic_repr):
+    if isinstance(semantic_repr, tuple) and len(semantic_repr) == 3 and semantic_repr[0] == '@And':
+        return _and_leaves(semantic_repr[1]) + _and_leaves(semantic_repr[2])
+    return [semantic_repr]
+
+def conjuncts(semantic_repr):
+    """
+        Sentence level predicates a semantic representation applies all of
+
+        Arguments:
+            semantic_repr (tuple) : hierarchical tuple representation of a strict labeling function
+
+        Returns:
+            arr : semantic representations of the predicates, each wrapped in '.root' so it can be turned
+                  into a labeling function on its own. [semantic_repr] if it can't be split.
+    """
+    if not (isinstance(semantic_repr, tuple) and len(semantic_repr) == 2 and semantic_repr[0] == '.root'):
+        return [semantic_repr]
+    predicates = _and_leaves(semantic_repr[1])
+    if not all(isinstance(p, tuple) and len(p) > 0 and p[0] in PREDICATE_OPS for p in predicates):
+        return [semantic_repr]
+    split = []
+    for predicate in predicates:
+        if predicate[0] == '@Is' and len(predicate) == 3:
+            # @Is(words, p1 and p2) checks p1 and p2 one after the other
+            split.extend(('@Is', predicate[1], p) for p in _and_leaves(predicate[2]))
+        else:
+            split.append(predicate)
+    nodes = []
+    for predicate in split:
+        if ('.root', predicate) not in nodes:
+            nodes.append(('.root', predicate))
+    return nodes
+
+class SemanticDAG():
+    """
+        Hash-consed predicates of strict labeling functions
+
+        Attributes:
+            nodes           (dict) : key - semantic representation of a predicate, value - node id
+            node_reprs       (arr) : semantic representation of each node
+            functions       (dict) : key - semantic representation of a labeling function, value - tuple of
+                                     the ids of its nodes
+            node_functions   (arr) : number of labeling functions using each node
+            node_evaluations (arr) : number of sentences each node was evaluated on
+            node_hits        (arr) : number of sentences each node applied to
+    """
+    def __init__(self):
+        self.nodes = {}
+        self.node_reprs = []
+        self.functions = {}
+        self.node_functions = []
+        self.node_evaluations = []
+        self.node_hits = []
+        self._node_labeling_functions = []
+        self._candidates = {}
+
+    @classmethod
+    def from_semantic_reps(cls, semantic_reps):
+        """
+            Arguments:
+                semantic_reps (iterable) : semantic representations, ex: TrainedCCGParser.semantic_reps
+
+            Returns:
+                SemanticDAG : DAG of every predicate of every semantic representation
+        """
+        dag = cls()
+        for semantic_repr in semantic_reps:
+            dag.add(semantic_repr)
+        return dag
+
+    def intern(self, semantic_repr):
+        """
+            Returns:
+                int : id of the node of a predicate, created if it doesn't exist yet
+        """
+        if semantic_repr not in self.nodes:
+            self.nodes[semantic_repr] = len(self.node_reprs)
+            self.node_reprs.append(semantic_repr)
+            self.node_functions.append(0)
+            self.node_evaluations.append(0)
+            self.node_hits.append(0)
+            self._node_labeling_functions.append(None)
+        return self.nodes[semantic_repr]
+
+    def add(self, semantic_repr):
+        """
+            Returns:
+                tuple : ids of the nodes a labeling function applies all of
+        """
+        if semantic_repr not in self.functions:
+            node_ids = tuple(self.intern(node_repr) for node_repr in conjuncts(semantic_repr))
+            for node in node_ids:
+                self.node_functions[node] += 1
+            self.functions[semantic_repr] = node_ids
+        return self.functions[semantic_repr]
+
+    def evaluate(self, node, corpus, index=None, rows=None):
+        """
+            Evaluates a node on a PhraseCorpus
+
+            Arguments:
+                node              (int) : node id
+                corpus (PhraseCorpus) : sentences to evaluate the node on
+                index    (TokenIndex) : if given, index of corpus used to skip sentences the node can't apply to
+                rows         (np.array) : if given, sorted indices of the only sentences to evaluate the node on
+
+            Returns:
+                np.array : sorted indices of the sentences the node applies to
+        """
+        semantic_repr = self.node_reprs[node]
+        if self._node_labeling_functions[node] is None:
+            self._node_labeling_functions[node] = LabelingFunction.create(semantic_repr)
+        if index is not None:
+            # looked up once per node and index, callers evaluate a node on many sets of rows
+            key = (node, index.signature)
+            if key not in self._candidates:
+                self._candidates[key] = index.candidates(token_index.required_patterns(semantic_repr))
+            candidates = self._candidates[key]
+            if candidates is not None:
+                rows = candidates if rows is None else np.intersect1d(rows, candidates, assume_unique=True)
+        fired = utils.apply_labeling_function(self._node_labeling_functions[node], semantic_repr, corpus, None, rows)
+        hits = np.flatnonzero(fired).astype(np.int32)
+        self.node_evaluations[node] += len(corpus) if rows is None else len(rows)
+        self.node_hits[node] += len(hits)
+        return hits
+
+    def profile(self):
+        """
+            Returns:
+                arr : (semantic_repr, functions, evaluations, hits) of each node, see the attributes of SemanticDAG
+        """
+        return list(zip(self.node_reprs, self.node_functions, self.node_evaluations, self.node_hits))
+
+    def add_profile(self, profile):
+        """
+            Adds the evaluation and hit counts of another DAG's profile (ex: one built in a worker process)
+        """
+        for semantic_repr, _, evaluations, hits in profile:
+            node = self.intern(semantic_repr)
+            self.node_evaluations[node] += evaluations
+            self.node_hits[node] += hits
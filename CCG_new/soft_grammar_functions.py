@@ -5,18 +5,15 @@ if torch.cuda.is_available():
 else:
     device = torch.device("cpu")
 
-def gather_nd_mask(mask_mat,param):
-    param = param.tolist()
-    length = mask_mat.shape[2]
-    for e in param:
-        assert len(e)==2
-    rax = []
-    for e in param:
-        if e[0]<0 or e[1]<0 or e[0]>=length or e[1]>=length:
-            rax.append(torch.zeros([1,length],dtype=torch.float32).to(device))
-        else:
-            rax.append(mask_mat[e[0],e[1],:].view(1,-1))
-    return torch.cat(rax,dim=0)
+#positions: torch.arange(seq_length), 1 x seq_length or seq_length (see SoftBatchContext.positions)
+#param: B x 2 (start, end) -> B x seq_length, 1 for start <= i <= end, rows with a bound out of range are zeros
+def gather_nd_mask(positions,param):
+    length = positions.shape[-1]
+    positions = positions.view(1,-1)
+    start = param[:,0:1]
+    end = param[:,1:2]
+    valid = (start>=0)&(end>=0)&(start<length)&(end<length)
+    return ((positions>=start)&(positions<=end)&valid).long()
 
 unmatch_count_score = 0.5
 unmatch_count_dist = 7
@@ -39,68 +36,114 @@ compare_soft={                   #eq mt(more than) lt(less than) nmt(no more tha
     'nlt':lambda a,b:torch.max(torch.ge(a,b).to(torch.float32),other=torch.ge(a,b-unmatch_count_dist).to(torch.float32)*unmatch_count_score),
 }
 
-#c: Tensor [seqlen seqlen 2 2] : sentence,ner,subj_posi,obj_posi,subj,obj
-def get_mid(attr,mask_mat,c):
-    subj_posi = c[:,-4:-3]
-    obj_posi = c[:,-3:-2]
-    seqlen = (c.size()[1]-4)//2
-    tokens = c[:,0:seqlen]
-    ner = c[:,seqlen:seqlen*2]
-    st_posi = torch.min(subj_posi,obj_posi)
-    ed_posi = subj_posi+obj_posi-st_posi
-    mask = gather_nd_mask(mask_mat,torch.cat([st_posi+1,ed_posi-1],dim=1))
-    ner = ner*mask
-    tokens = tokens*mask
-    if attr=='NER':
-        res = ner
-    else:
-        res = tokens
-    return res
-
-def get_other_posi(POSI,attr,arg,mask_mat,c):
+class SoftBatchContext():
+    """
+        Batch the soft labeling functions are applied to, built once per batch from the output of
+        build_phrase_input and shared by every soft labeling function, so positions are sliced once and each
+        span mask is built the first time a function asks for it
+
+        Attributes:
+            label_mat    (tensor) : B x seq_len x Q, soft matching score of each token with each quoted word
+            keyword_dict   (dict) : quoted word -> index in the last dimension of label_mat
+            c            (tensor) : B x (2 * seq_len + 4), output of build_phrase_input
+            seqlen          (int) : seq_len
+            tokens       (tensor) : B x seq_len token ids
+            ner          (tensor) : B x seq_len NER ids
+            subj_posi    (tensor) : B x 1
+            obj_posi     (tensor) : B x 1
+            positions    (tensor) : 1 x seq_len, torch.arange(seq_len)
+    """
+    def __init__(self, label_mat, keyword_dict, c):
+        self.label_mat = label_mat
+        self.keyword_dict = keyword_dict
+        self.c = c
+        self.seqlen = (c.size()[1] - 4) // 2
+        self.tokens = c[:, 0:self.seqlen]
+        self.ner = c[:, self.seqlen:self.seqlen * 2]
+        self.subj_posi = c[:, -4:-3]
+        self.obj_posi = c[:, -3:-2]
+        self.positions = torch.arange(self.seqlen, device=c.device).view(1, -1)
+        self._cache = {}
+
+    def posi(self, arg):
+        if arg == 'ArgY':
+            return self.obj_posi
+        return self.subj_posi
+
+    def attr_view(self, attr):
+        if attr == 'NER':
+            return self.ner
+        return self.tokens
+
+    def mid(self):
+        """
+            Returns:
+                tuple : (B x 2 position, B x seq_len mask) of the tokens between SUBJ and OBJ
+        """
+        if 'mid' not in self._cache:
+            st_posi = torch.min(self.subj_posi, self.obj_posi)
+            ed_posi = self.subj_posi + self.obj_posi - st_posi
+            position = torch.cat([st_posi + 1, ed_posi - 1], dim=1)
+            self._cache['mid'] = (position, gather_nd_mask(self.positions, position))
+        return self._cache['mid']
+
+    def window(self, POSI, arg, range_):
+        """
+            Arguments:
+                POSI   (str) : 'Left', 'Right' or 'Range'
+                arg    (str) : 'ArgX' or 'ArgY'
+                range_ (int) : number of tokens, -1 for up to the start or end of the sentence
+
+            Returns:
+                tuple : (B x 2 position, B x seq_len mask, B x seq_len soft mask), the soft mask scores tokens
+                        up to unmatch_match_dist further away with unmatch_match_score
+        """
+        key = ('window', POSI, arg, range_)
+        if key not in self._cache:
+            posi = self.posi(arg)
+            last = self.seqlen - 1
+            if range_ == -1 and POSI != 'Range':
+                if POSI == 'Left':
+                    position = torch.cat([0 * posi, posi - 1], dim=1)
+                else:
+                    position = torch.cat([posi + 1, 0 * posi + last], dim=1)
+                unmatch_position = position
+            elif POSI == 'Left':
+                position = torch.cat([torch.clamp(posi - range_, min=0), posi - 1], dim=1)
+                unmatch_position = torch.cat([torch.clamp(posi - range_ - unmatch_match_dist, min=0), posi - 1], dim=1)
+            elif POSI == 'Right':
+                position = torch.cat([posi + 1, torch.clamp(posi + range_, max=last)], dim=1)
+                unmatch_position = torch.cat([posi + 1, torch.clamp(posi + range_ + unmatch_match_dist, max=last)], dim=1)
+            else:
+                st = torch.clamp(posi - range_, min=0)
+                position = torch.cat([st, torch.clamp(posi + range_, max=last)], dim=1)
+                unmatch_position = torch.cat([torch.clamp(posi - range_ - unmatch_match_dist, min=0),
+                                              torch.clamp(st + range_ + unmatch_match_dist, max=last)], dim=1)
+            mask = gather_nd_mask(self.positions, position)
+            soft_mask = mask.to(torch.float32)
+            if unmatch_position is not position:
+                soft_mask = soft_mask + (gather_nd_mask(self.positions, unmatch_position).to(torch.float32) - soft_mask) * unmatch_match_score
+            self._cache[key] = (position, mask, soft_mask)
+        return self._cache[key]
+
+    def masked(self, attr, key, mask):
+        key = ('masked', attr) + key
+        if key not in self._cache:
+            self._cache[key] = self.attr_view(attr) * mask
+        return self._cache[key]
+
+    def keyword_score(self, w, soft_mask):
+        return torch.max(self.label_mat[:, :, self.keyword_dict[w]] * soft_mask, dim=1)[0].view([1, -1])
+
+def get_mid(attr,ctx):
+    return ctx.masked(attr, ('mid',), ctx.mid()[1])
+
+def get_other_posi(POSI,attr,arg,ctx):
     assert POSI=='Left' or POSI=='Right'
-    batch_size = c.size()[0]
-    subj_posi = c[:, -4:-3]
-    obj_posi = c[:, -3:-2]
-    seqlen = (c.size()[1] - 4) // 2
-    tokens = c[:, 0:seqlen]
-    ner = c[:, seqlen:seqlen * 2]
-    if arg=='ArgY':
-        posi = obj_posi
-    else:
-        posi = subj_posi
-
-    if arg=='Left':
-        mask = gather_nd_mask(mask_mat,torch.cat([0*posi,posi-1],dim=1))
-    else:
-        mask = gather_nd_mask(mask_mat,torch.cat([posi+1,(0*posi+1)*(seqlen-1)],dim=1))
-
-    new_ner = mask*ner
-    new_tokens = mask*tokens
-    if attr=='NER':
-        res = new_ner
-    else:
-        res = new_tokens
-    return res
-
-def get_range(attr,arg,range_,mask_mat,c):
-    subj_posi = c[:, -4:-3]
-    obj_posi = c[:, -3:-2]
-    seqlen = (c.size()[1] - 4) // 2
-    tokens = c[:, 0:seqlen]
-    ner = c[:, seqlen:seqlen * 2]
-    if arg=='ArgY':
-        posi = obj_posi
-    else:
-        posi = subj_posi
-    if attr=='NER':
-        res = ner
-    else:
-        res = tokens
+    return ctx.masked(attr, (POSI, arg, -1), ctx.window(POSI, arg, -1)[1])
 
-    mask = gather_nd_mask(mask_mat,torch.cat([torch.max(torch.tensor(0).to(device),other=posi-range_),torch.min(torch.tensor(seqlen-1).to(device),posi+range_)],dim=1))
-    res = res*mask
-    return res
+def get_range(attr,arg,range_,ctx):
+    return ctx.masked(attr, ('Range', arg, range_), ctx.window('Range', arg, range_)[1])
 
 def In(w,seq):
     assert w in NER_LABEL_SPACE
@@ -120,48 +163,48 @@ def merge_soft(x,y):
     return tuple(x+y)
 
 #function for $Is
-def IsFunc_soft(ws,ps,label_mat,keyword_dict,mask_mat,c):
+def IsFunc_soft(ws,ps,ctx):
     if isinstance(ps,tuple):
         bool_list  = []
         for p in ps:
             if isinstance(ws, tuple):
                 if ws[0] in Selection:
-                    bool_list.append(p(ws)(label_mat,keyword_dict,mask_mat)(c))
+                    bool_list.append(p(ws)(ctx))
                 else:
-                    bool_list.append(torch.max(torch.tensor(sum([p(w)(label_mat,keyword_dict,mask_mat)(c) for w in ws])-len(ws)+1).to(device),torch.tensor(0.0).to(device)))
+                    bool_list.append(torch.max(torch.tensor(sum([p(w)(ctx) for w in ws])-len(ws)+1).to(device),torch.tensor(0.0).to(device)))
             else:
-                bool_list.append(p(ws)(label_mat,keyword_dict,mask_mat)(c))
+                bool_list.append(p(ws)(ctx))
         return torch.max(torch.tensor(sum(bool_list)-len(bool_list)+1).to(device),torch.tensor(0.0).to(device))
 
     if isinstance(ws,tuple):
         if ws[0] in Selection:
-            return ps(ws)(label_mat,keyword_dict,mask_mat)(c)
+            return ps(ws)(ctx)
         else:
-            return torch.max(torch.tensor(sum([ps(w)(label_mat,keyword_dict,mask_mat)(c) for w in ws])-len(ws)+1).to(device),torch.tensor(0.0).to(device))
+            return torch.max(torch.tensor(sum([ps(w)(ctx) for w in ws])-len(ws)+1).to(device),torch.tensor(0.0).to(device))
     else:
-        return ps(ws)(label_mat,keyword_dict,mask_mat)(c)
+        return ps(ws)(ctx)
 
 #function for @Left and @Right
-def at_POSI_soft(POSI,ws,arg,label_mat,keyword_dict,mask_mat,c,option=None):
+def at_POSI_soft(POSI,ws,arg,ctx,option=None):
     if isinstance(ws,tuple):
         if ws[0] in Selection:
             assert POSI=='Left' or POSI=='Right' or POSI=='Range'
             if POSI=='Left' or POSI=='Right':
-                score_raw = In(ws[1],get_other_posi(POSI,ws[0],arg,mask_mat,c)).to(torch.float32)
+                score_raw = In(ws[1],get_other_posi(POSI,ws[0],arg,ctx)).to(torch.float32)
                 return score_raw
             else:
-                score_raw =  In(ws[1], get_range(ws[0], arg, option['range'],mask_mat,c)).to(torch.float32)
+                score_raw =  In(ws[1], get_range(ws[0], arg, option['range'],ctx)).to(torch.float32)
                 return score_raw
         else:
             bool_list = []
             for w in ws:
-                bool_list.append(at_POSI_0_soft(POSI,arg,w,label_mat,keyword_dict,mask_mat,c,option))
+                bool_list.append(at_POSI_0_soft(POSI,arg,w,ctx,option))
             return torch.max(torch.tensor(sum(bool_list)-len(bool_list)+1).to(device),torch.tensor(0.0).to(device))
     else:
-        return at_POSI_0_soft(POSI,arg,ws,label_mat,keyword_dict,mask_mat,c,option)
+        return at_POSI_0_soft(POSI,arg,ws,ctx,option)
 
 #function for @Left0 and @Right0
-def at_POSI_0_soft(POSI,arg,w,label_mat,keyword_dict,mask_mat,c,option=None):
+def at_POSI_0_soft(POSI,arg,w,ctx,option=None):
     if arg not in ['ArgX','ArgY']:
         w,arg = arg,w
         if POSI == 'Left':
@@ -170,7 +213,7 @@ def at_POSI_0_soft(POSI,arg,w,label_mat,keyword_dict,mask_mat,c,option=None):
             POSI = 'Left'
 
     if isinstance(w,tuple) and w[0] not in Selection:
-        return torch.max(torch.tensor(sum([at_POSI_0_soft(POSI,arg,ww,label_mat,keyword_dict,mask_mat,c,option) for ww in w])-len(w)+1).to(device),torch.tensor(0.0).to(device))
+        return torch.max(torch.tensor(sum([at_POSI_0_soft(POSI,arg,ww,ctx,option) for ww in w])-len(w)+1).to(device),torch.tensor(0.0).to(device))
 
 
     if option==None:
@@ -178,45 +221,22 @@ def at_POSI_0_soft(POSI,arg,w,label_mat,keyword_dict,mask_mat,c,option=None):
     if isinstance(w,tuple):
         assert POSI == 'Left' or POSI == 'Right' or POSI == 'Range'
         if POSI == 'Left' or POSI == 'Right':
-            score_raw = In(ws[1], get_other_posi(POSI, ws[0], arg, mask_mat,c)).to(torch.float32)
+            score_raw = In(w[1], get_other_posi(POSI, w[0], arg, ctx)).to(torch.float32)
             return score_raw
         else:
-            score_raw = In(ws[1], get_range(ws[0], arg, option['range'], mask_mat,c)).to(torch.float32)
+            score_raw = In(w[1], get_range(w[0], arg, option['range'], ctx)).to(torch.float32)
             return score_raw
     else:                                                                                   #For now,option['attr']==tokens if and only if 'right before' is used or onlyCount==True, otherwise ==word
         if option == 'Direct':
-            w_split = w.split()
-            while '' in w_split:
-                w_split.remove('')
-            range_ = len(w_split)
-
-            subj_posi = c[:, -4:-3]
-            obj_posi = c[:, -3:-2]
-            seqlen = (c.size()[1] - 4) // 2
-
-            if arg=='ArgY':
-                arg_posi = obj_posi
-            else:
-                arg_posi = subj_posi
-
-            if POSI == 'Left':
-                st = torch.max(torch.tensor(0).to(device), arg_posi - range_)
-                position = torch.cat([st,arg_posi-1],dim=1)
-                unmatch_position = torch.cat([torch.max(torch.tensor(0).to(device),arg_posi - range_ - unmatch_match_dist), arg_posi - 1], dim=1)
-            elif POSI == 'Right':
-                st = arg_posi
-                ed = torch.min(torch.tensor(seqlen - 1).to(device), arg_posi+range_)
-                position = torch.cat([st+1,ed],dim=1)
-                unmatch_position = torch.cat([st + 1, torch.min(torch.tensor(seqlen - 1).to(device),st+range_+unmatch_match_dist)], dim=1)
-            else:
+            if POSI != 'Left' and POSI != 'Right':
                 raise ValueError
             if w in ['ArgX','ArgY']:
                 if w=='ArgX':
-                    tar = c[:,-4:-3]
-                    src = c[:,-3:-2]
+                    tar = ctx.subj_posi
+                    src = ctx.obj_posi
                 else:
-                    src = c[:,-4:-3]
-                    tar = c[:,-3:-2]
+                    src = ctx.subj_posi
+                    tar = ctx.obj_posi
                 if POSI=='Left':
                     score_raw = torch.eq(src-tar,1).to(torch.float32).view([1,-1])
                     return score_raw
@@ -224,53 +244,15 @@ def at_POSI_0_soft(POSI,arg,w,label_mat,keyword_dict,mask_mat,c,option=None):
                     score_raw = torch.eq(tar-src, 1).to(torch.float32).view([1,-1])
                     return score_raw
             else:
-                mask_raw = gather_nd_mask(mask_mat,position).to(torch.float32)
-                mask_raw = mask_raw+(gather_nd_mask(mask_mat,unmatch_position).to(torch.float32)-mask_raw)*unmatch_match_score
-                return torch.max(label_mat[:, :, keyword_dict[w]] * (mask_raw),dim=1)[0].view([1, -1])
+                w_split = w.split()
+                while '' in w_split:
+                    w_split.remove('')
+                _, _, soft_mask = ctx.window(POSI, arg, len(w_split))
+                return ctx.keyword_score(w, soft_mask)
 
         if option['range']==-1:
             assert POSI=='Left' or POSI=='Right'
-            batch_size = c.size()[0]
-            subj_posi = c[:, -4:-3]
-            obj_posi = c[:, -3:-2]
-            seqlen = (c.size()[1] - 4) // 2
-            if arg == 'ArgY':
-                arg_posi = obj_posi
-            else:
-                arg_posi = subj_posi
-
-            if POSI=='Left':
-                position = torch.cat([0*arg_posi, arg_posi - 1], dim=1)
-                unmatch_position = position
-            else:
-                position = torch.cat([arg_posi + 1, (0*arg_posi+1) * (seqlen - 1)],dim=1)
-                unmatch_position = position
-
-        else:                                                                               #For now, if range!=-1 then attr == 'tokens'
-            subj_posi = c[:, -4:-3]
-            obj_posi = c[:, -3:-2]
-            seqlen = (c.size()[1] - 4) // 2
-            if arg == 'ArgY':
-                arg_posi = obj_posi
-            else:
-                arg_posi = subj_posi
-
-            range_ = option['range']
-
-            if POSI == 'Left':
-                st = torch.max(torch.tensor(0).to(device), arg_posi - range_)
-                position = torch.cat([st, arg_posi-1],dim=1)
-                unmatch_position = torch.cat([torch.max(torch.tensor(0).to(device), arg_posi - range_ - unmatch_match_dist), arg_posi - 1],dim=1)
-            elif POSI=='Right':
-                st = arg_posi
-                ed = torch.min(torch.tensor(seqlen - 1).to(device), arg_posi+range_)
-                position = torch.cat([arg_posi+1, ed],dim=1)
-                unmatch_position = torch.cat([st + 1, torch.min(torch.tensor(seqlen - 1).to(device), st + range_ + unmatch_match_dist)],dim=1)
-            else:
-                st = torch.max(torch.tensor(0).to(device),arg_posi-range_)
-                ed = torch.min(torch.tensor(seqlen-1).to(device),arg_posi+range_)
-                position=torch.cat([st,ed],dim=1)
-                unmatch_position = torch.cat([torch.max(torch.tensor(0).to(device), arg_posi - range_ - unmatch_match_dist), torch.min(torch.tensor(seqlen - 1).to(device), st + range_ + unmatch_match_dist)], dim=1)
+        position, _, soft_mask = ctx.window(POSI, arg, option['range'])            #For now, if range!=-1 then attr == 'tokens'
 
         if option['onlyCount']:
             score_raw = compare_soft[option['cmp']](position[:,1]-position[:,0],option['numAppear']).to(torch.float32).view([1,-1])
@@ -279,108 +261,99 @@ def at_POSI_0_soft(POSI,arg,w,label_mat,keyword_dict,mask_mat,c,option=None):
             assert option['cmp']=='nlt' and option['numAppear']==1
             if w in ['ArgX','ArgY']:
                 if w=='ArgX':
-                    tar = c[:,-4]
+                    tar = ctx.subj_posi[:,0]
                 else:
-                    tar = c[:,-3]
+                    tar = ctx.obj_posi[:,0]
                 score_raw = ((tar>=position[:,0])*(tar<=position[:,1])).to(torch.float32).view([1,-1])
                 return score_raw
             else:
-                mask_raw = gather_nd_mask(mask_mat,position).to(torch.float32)
-                mask_raw = mask_raw+(gather_nd_mask(mask_mat,unmatch_position).to(torch.float32)-mask_raw)*unmatch_match_score
-                return torch.max(label_mat[:, :, keyword_dict[w]] * (mask_raw),dim=1)[0].view([1, -1])
+                return ctx.keyword_score(w, soft_mask)
 
 
 
 #function for @Between
 
-def at_between_soft(w,label_mat,keyword_dict,mask_mat,c,option=None):
+def at_between_soft(w,ctx,option=None):
     if option==None:
         option = {'attr': 'word', 'numAppear':1,'cmp':'nlt','onlyCount':False}                #For now, if onlyCount==True, then attr=='tokens'
     if isinstance(w,tuple):
-        score_raw = In(w[1],get_mid(w[0],mask_mat,c)).to(torch.float32)
+        score_raw = In(w[1],get_mid(w[0],ctx)).to(torch.float32)
         return score_raw
     else:                                                                                   #For now,option['attr']==tokens if and only if  onlyCount==True, otherwise ==word
         if option['onlyCount']:
-            score_raw =  compare_soft[option['cmp']](torch.abs(c[:,-4]-c[:,-3])-1,option['numAppear']).to(torch.float32).view([1,-1])
+            score_raw =  compare_soft[option['cmp']](torch.abs(ctx.subj_posi[:,0]-ctx.obj_posi[:,0])-1,option['numAppear']).to(torch.float32).view([1,-1])
             return score_raw
         else:
             assert option['cmp'] == 'nlt' and option['numAppear'] == 1
-            l_posi = torch.min(c[:,-4],c[:,-3])
-            g_posi = c[:,-4]+c[:,-3]-l_posi
             if w in ['ArgX','ArgY']:
+                l_posi = torch.min(ctx.subj_posi[:,0],ctx.obj_posi[:,0])
+                g_posi = ctx.subj_posi[:,0]+ctx.obj_posi[:,0]-l_posi
                 if w=='ArgX':
-                    tar = c[:,-4]
+                    tar = ctx.subj_posi[:,0]
                 else:
-                    tar = c[:,-3]
+                    tar = ctx.obj_posi[:,0]
                 score_raw = ((tar>l_posi)*(tar<g_posi)).to(torch.float32).view([1,-1])
                 return score_raw
             else:
-                l_posi = l_posi.view([-1,1])+1
-                g_posi = g_posi.view([-1, 1])-1
-                position = torch.cat([l_posi, g_posi],dim=1)
-                mask_raw = gather_nd_mask(mask_mat,position).to(torch.float32)
-                seqlen = (c.size()[1] - 4) // 2
-                return torch.max(label_mat[:, :, keyword_dict[w]] * (mask_raw),dim=1)[0].view([1, -1])
+                return ctx.keyword_score(w, ctx.mid()[1].to(torch.float32))
 
 
 
 #function for counting
-def at_lessthan_soft(funcx,nouny,w,label_mat,keyword_dict,mask_mat,c):
+def at_lessthan_soft(funcx,nouny,w,ctx):
     if w=='There':
         onlyCount=True
     else:
         onlyCount = False
     if onlyCount:
-        return funcx(w,{'attr':nouny['attr'],'range':-1,'numAppear':nouny['num'],'cmp':'lt','onlyCount':onlyCount})(label_mat,keyword_dict,mask_mat)(c)                #There are less than 3 words before OBJ
+        return funcx(w,{'attr':nouny['attr'],'range':-1,'numAppear':nouny['num'],'cmp':'lt','onlyCount':onlyCount})(ctx)                #There are less than 3 words before OBJ
     else:
-        return funcx(w, {'attr': nouny['attr'], 'range': nouny['num'], 'numAppear': 1, 'cmp': 'nlt','onlyCount': onlyCount})(label_mat,keyword_dict,mask_mat)(c)      #the word 'x' is less than 3 words before OBJ
+        return funcx(w, {'attr': nouny['attr'], 'range': nouny['num'], 'numAppear': 1, 'cmp': 'nlt','onlyCount': onlyCount})(ctx)      #the word 'x' is less than 3 words before OBJ
 
-def at_atmost_soft(funcx,nouny,w,label_mat,keyword_dict,mask_mat,c):
+def at_atmost_soft(funcx,nouny,w,ctx):
     if w=='There':
         onlyCount=True
     else:
         onlyCount = False
     if onlyCount:
-        return funcx(w,{'attr':nouny['attr'],'range':-1,'numAppear':nouny['num'],'cmp':'nmt','onlyCount':onlyCount})(label_mat,keyword_dict,mask_mat)(c)                #There are at most 3 words before OBJ
+        return funcx(w,{'attr':nouny['attr'],'range':-1,'numAppear':nouny['num'],'cmp':'nmt','onlyCount':onlyCount})(ctx)                #There are at most 3 words before OBJ
     else:
-        return funcx(w, {'attr': nouny['attr'], 'range': nouny['num'], 'numAppear': 1, 'cmp': 'nlt','onlyCount': onlyCount})(label_mat,keyword_dict,mask_mat)(c)      #the word 'x' is at most 3 words before OBJ
+        return funcx(w, {'attr': nouny['attr'], 'range': nouny['num'], 'numAppear': 1, 'cmp': 'nlt','onlyCount': onlyCount})(ctx)      #the word 'x' is at most 3 words before OBJ
 
-def at_atleast_soft(funcx,nouny,w,label_mat,keyword_dict,mask_mat,c):
+def at_atleast_soft(funcx,nouny,w,ctx):
     if w=='There':
         onlyCount=True
     else:
         onlyCount = False
     if onlyCount:
-        return funcx(w,{'attr':nouny['attr'],'range':-1,'numAppear':nouny['num'],'cmp':'nlt','onlyCount':onlyCount})(label_mat,keyword_dict,mask_mat)(c)             #There are at least 3 words before OBJ
+        return funcx(w,{'attr':nouny['attr'],'range':-1,'numAppear':nouny['num'],'cmp':'nlt','onlyCount':onlyCount})(ctx)             #There are at least 3 words before OBJ
     else:
-        return funcx(w,{'attr': nouny['attr'], 'range': nouny['num'], 'numAppear': 1, 'cmp': 'nlt','onlyCount': onlyCount})(label_mat,keyword_dict,mask_mat)(c)      #the word 'x' is no less than 3 words before OBJ
+        return funcx(w,{'attr': nouny['attr'], 'range': nouny['num'], 'numAppear': 1, 'cmp': 'nlt','onlyCount': onlyCount})(ctx)      #the word 'x' is no less than 3 words before OBJ
 
-def at_morethan_soft(funcx,nouny,w,label_mat,keyword_dict,mask_mat,c):
+def at_morethan_soft(funcx,nouny,w,ctx):
     if w=='There':
         onlyCount=True
     else:
         onlyCount = False
     if onlyCount:
-        return funcx(w,{'attr':nouny['attr'],'range':-1,'numAppear':nouny['num'],'cmp':'mt','onlyCount':onlyCount})(label_mat,keyword_dict,mask_mat)(c)                #There are more than 3 words before OBJ
+        return funcx(w,{'attr':nouny['attr'],'range':-1,'numAppear':nouny['num'],'cmp':'mt','onlyCount':onlyCount})(ctx)                #There are more than 3 words before OBJ
     else:
-        return funcx(w, {'attr': nouny['attr'], 'range': nouny['num'], 'numAppear': 1, 'cmp': 'nlt','onlyCount': onlyCount})(label_mat,keyword_dict,mask_mat)(c)    #the word 'x' is more than 3 words before OBJ
+        return funcx(w, {'attr': nouny['attr'], 'range': nouny['num'], 'numAppear': 1, 'cmp': 'nlt','onlyCount': onlyCount})(ctx)    #the word 'x' is more than 3 words before OBJ
 
 
 #function for @In0
 
-def at_In0_soft(arg,w,label_mat,keyword_dict,mask_mat,c):
+def at_In0_soft(arg,w,ctx):
     assert arg=='Sentence'                                                                                                          #Right?
     if isinstance(w,tuple):
-        seqlen = (c.size()[1] - 4) // 2
-        score_raw = In(w,c[:,seqlen:seqlen*2]).to(torch.float32)
+        score_raw = In(w,ctx.ner).to(torch.float32)
         return score_raw
     else:
-        seqlen = (c.size()[1] - 4) // 2
-        return torch.max(label_mat[:, :, keyword_dict[w]], dim=1)[0].view([1, -1])
+        return torch.max(ctx.label_mat[:, :, ctx.keyword_dict[w]], dim=1)[0].view([1, -1])
         # return w in c.sentence
 
-def at_WordCount_soft(nounNum,nouny,F,label_mat,keyword_dict,mask_mat,c):
+def at_WordCount_soft(nounNum,nouny,F,ctx):
     if isinstance(nouny,tuple):
-        return torch.max(torch.max(torch.tensor(sum([F(noun, option={'attr': 'word', 'range': -1, 'numAppear': 1, 'cmp': 'nlt', 'onlyCount': False})(label_mat,keyword_dict,mask_mat)(c) for noun in nouny])-len(nouny)+1).to(device),torch.tensor(0.0).to(device))+F(nouny[0],option={'attr': 'tokens','range': -1,'numAppear':sum([len(noun.split()) for noun in nouny]),'cmp': 'eq','onlyCount': True})(label_mat,keyword_dict,mask_mat)(c)-1,torch.tensor(0.0).to(device))
+        return torch.max(torch.max(torch.tensor(sum([F(noun, option={'attr': 'word', 'range': -1, 'numAppear': 1, 'cmp': 'nlt', 'onlyCount': False})(ctx) for noun in nouny])-len(nouny)+1).to(device),torch.tensor(0.0).to(device))+F(nouny[0],option={'attr': 'tokens','range': -1,'numAppear':sum([len(noun.split()) for noun in nouny]),'cmp': 'eq','onlyCount': True})(ctx)-1,torch.tensor(0.0).to(device))
     else:
-        return torch.max(torch.tensor(F(nouny, option={'attr':'word','range':-1,'numAppear':1,'cmp':'nlt','onlyCount':False})(label_mat,keyword_dict,mask_mat)(c)+F(nouny, option={'attr':'tokens','range':-1,'numAppear':len(nouny.split()),'cmp':'eq','onlyCount':True})(label_mat,keyword_dict,mask_mat)(c)-1).to(device),torch.tensor(0.0).to(device))
\ No newline at end of file
+        return torch.max(torch.tensor(F(nouny, option={'attr':'word','range':-1,'numAppear':1,'cmp':'nlt','onlyCount':False})(ctx)+F(nouny, option={'attr':'tokens','range':-1,'numAppear':len(nouny.split()),'cmp':'eq','onlyCount':True})(ctx)-1).to(device),torch.tensor(0.0).to(device))
\ No newline at end of file
@@ -0,0 +1,388 @@
+"""
+    Compiles soft labeling functions into one batched tensor program.
+
+    A soft labeling function built by utils.create_soft_labeling_function scores a batch with a tree of
+    curried closures (see constants.SOFT_MATCHING_OPS), one small tensor op at a time, so scoring a batch
+    takes a Python loop over every function and every node. Every soft labeling function is a fuzzy AND
+    (max(sum(scores) - n + 1, 0)) of a few kinds of atoms:
+
+        * keyword : soft score of a quoted word in a span (between SUBJ and OBJ, left of OBJ, ...)
+        * in      : whether a NER label is in a span
+        * count   : soft comparison of the width of a span with a number
+        * arg_in  : whether SUBJ or OBJ is in a span
+        * adjacent: whether SUBJ and OBJ are next to each other
+
+    As the fuzzy AND is associative on scores in [0, 1], nested ANDs flatten into one. The compiler runs
+    the soft ops once, at compile time, turning each function into its list of atoms. A SoftLabelingProgram
+    evaluates the atoms of all functions with one gathered tensor op per kind, and combines them with
+    one matrix product. Functions the compiler doesn't handle are called on the batch as they are.
+"""
+import torch
+from CCG_new import constants
+from CCG_new.soft_grammar_functions import merge_soft, compare_soft, Selection, NER_LABEL_SPACE
+
+COUNT_COMPARES = {'@LessThan' : 'lt', '@AtMost' : 'nmt', '@AtLeast' : 'nlt', '@MoreThan' : 'mt'}
+DEFAULT_OPTION = {'attr': 'word', 'range': -1, 'numAppear': 1, 'cmp': 'nlt', 'onlyCount': False}
+ATOM_KINDS = ['keyword', 'in', 'count', 'arg_in', 'adjacent']
+
+class _Unsupported(Exception):
+    pass
+
+class _Conjunction():
+    """
+        Compile time stand-in for the `lambda ctx: ...` a soft op returns, the fuzzy AND of atoms
+    """
+    def __init__(self, atoms):
+        self.atoms = tuple(atoms)
+
+def _and(conjunctions):
+    atoms = []
+    for conjunction in conjunctions:
+        if not isinstance(conjunction, _Conjunction):
+            raise _Unsupported("not a conjunction: {!r}".format(conjunction))
+        atoms.extend(conjunction.atoms)
+    return _Conjunction(atoms)
+
+def _call(function, *args):
+    if not callable(function) or isinstance(function, _Conjunction):
+        raise _Unsupported("not callable: {!r}".format(function))
+    conjunction = function(*args)
+    if not isinstance(conjunction, _Conjunction):
+        raise _Unsupported("not a conjunction: {!r}".format(conjunction))
+    return conjunction
+
+def _atom(*atom):
+    return _Conjunction([atom])
+
+class _SoftCompiler():
+    """
+        Mirrors constants.SOFT_MATCHING_OPS and soft_grammar_functions, collecting atoms instead of scoring a
+        batch. Spans are keyed as in SoftBatchContext: ('mid',), ('window', POSI, arg, range_) or ('sentence',)
+    """
+    def __init__(self):
+        self.ops = {
+            ".root"      : self.root,
+            "@Word"      : lambda x: x,
+            "@Is"        : lambda ws, p: self.is_func(ws, p),
+            "@between"   : lambda a: lambda w, option=None: self.at_between(w, option),
+            "@And"       : lambda x, y: merge_soft(x, y),
+            "@Num"       : lambda x, y: {'attr': y, 'num': int(x)},
+            "@WordCount" : lambda nounNum, nouny, F: lambda useless: self.at_WordCount(nouny, F),
+            "@NumberOf"  : lambda x, f: [x, f],
+            "@In0"       : lambda arg: lambda w: self.at_In0(arg, w),
+            "@In1"       : lambda arg, w: self.at_In0(arg, w),
+            "@By"        : lambda x, f, z: _call(f, x, {'attr': z['attr'], 'range': z['num'], 'numAppear': 1, 'cmp': 'nlt', 'onlyCount': False}),
+            "@Left0"     : lambda arg: lambda w, option=None: self.at_POSI_0('Left', arg, w, option),
+            "@Right0"    : lambda arg: lambda w, option=None: self.at_POSI_0('Right', arg, w, option),
+            "@Range0"    : lambda arg: lambda w, option=None: self.at_POSI_0('Range', arg, w, option),
+            "@Left"      : lambda arg, ws, option=None: self.at_POSI('Left', ws, arg),
+            "@Right"     : lambda arg, ws, option=None: self.at_POSI('Right', ws, arg),
+            "@Direct"    : lambda func: lambda w: _call(func, w, 'Direct'),
+        }
+        for op, cmp in COUNT_COMPARES.items():
+            self.ops[op] = self._count_op(cmp)
+            self.ops[op + "1"] = self._count_op_1(cmp)
+
+    def _count_op(self, cmp):
+        return lambda funcx, nouny: lambda w: self.at_count(cmp, funcx, nouny, w)
+
+    def _count_op_1(self, cmp):
+        return lambda nounynum: lambda x: self.at_count(cmp, x[1], {'attr': x[0], 'num': int(nounynum)}, 'There')
+
+    def value(self, semantic_repr):
+        if isinstance(semantic_repr, tuple):
+            if semantic_repr[0] not in self.ops or len(semantic_repr) == 1:
+                raise _Unsupported("op: {!r}".format(semantic_repr))
+            op = self.ops[semantic_repr[0]]
+            return op(*[self.value(arg) for arg in semantic_repr[1:]])
+        return constants.NER_TERMINAL_TO_EXECUTION_TUPLE.get(semantic_repr, semantic_repr)
+
+    def atoms(self, semantic_repr):
+        conjunction = self.value(semantic_repr)
+        if not isinstance(conjunction, _Conjunction):
+            raise _Unsupported("not a labeling function: {!r}".format(semantic_repr))
+        return conjunction.atoms
+
+    @staticmethod
+    def _arg(arg):
+        if arg not in ['ArgX', 'ArgY']:
+            raise _Unsupported("arg: {!r}".format(arg))
+        return arg
+
+    # ops
+
+    def root(self, xs):
+        if type(xs) == tuple:
+            return _and(xs)
+        return _and([xs])
+
+    def is_func(self, ws, ps):
+        if isinstance(ps, tuple):
+            conjunctions = []
+            for p in ps:
+                if isinstance(ws, tuple):
+                    if ws[0] in Selection:
+                        conjunctions.append(_call(p, ws))
+                    else:
+                        conjunctions.append(_and([_call(p, w) for w in ws]))
+                else:
+                    conjunctions.append(_call(p, ws))
+            return _and(conjunctions)
+
+        if isinstance(ws, tuple):
+            if ws[0] in Selection:
+                return _call(ps, ws)
+            else:
+                return _and([_call(ps, w) for w in ws])
+        else:
+            return _call(ps, ws)
+
+    def at_POSI(self, POSI, ws, arg):
+        if isinstance(ws, tuple):
+            if ws[0] in Selection:
+                return _atom('in', ws[1], ws[0], ('window', POSI, self._arg(arg), -1))
+            else:
+                return _and([self.at_POSI_0(POSI, arg, w, None) for w in ws])
+        else:
+            return self.at_POSI_0(POSI, arg, ws, None)
+
+    def at_POSI_0(self, POSI, arg, w, option):
+        if arg not in ['ArgX', 'ArgY']:
+            w, arg = arg, w
+            if POSI == 'Left':
+                POSI = 'Right'
+            elif POSI == 'Right':
+                POSI = 'Left'
+        arg = self._arg(arg)
+
+        if isinstance(w, tuple) and w[0] not in Selection:
+            return _and([self.at_POSI_0(POSI, arg, ww, option) for ww in w])
+
+        if option is None:
+            option = DEFAULT_OPTION
+        if isinstance(w, tuple):
+            range_ = -1 if POSI != 'Range' else option['range']
+            return _atom('in', w[1], w[0], ('window', POSI, arg, range_))
+        if not isinstance(w, str):
+            raise _Unsupported("word: {!r}".format(w))
+
+        if option == 'Direct':
+            if POSI != 'Left' and POSI != 'Right':
+                raise _Unsupported("Direct {}".format(POSI))
+            if w in ['ArgX', 'ArgY']:
+                other = 'ArgY' if w == 'ArgX' else 'ArgX'
+                if POSI == 'Left':
+                    return _atom('adjacent', other, w)
+                return _atom('adjacent', w, other)
+            return _atom('keyword', w, ('window', POSI, arg, len(w.split())))
+
+        if option['range'] == -1 and POSI != 'Left' and POSI != 'Right':
+            raise _Unsupported("range -1 for {}".format(POSI))
+        if not isinstance(option['range'], int):
+            raise _Unsupported("range: {!r}".format(option['range']))
+        span = ('window', POSI, arg, option['range'])
+        if option['onlyCount']:
+            return _atom('count', option['cmp'], option['numAppear'], span)
+        if option['cmp'] != 'nlt' or option['numAppear'] != 1:
+            raise _Unsupported("option: {!r}".format(option))
+        if w in ['ArgX', 'ArgY']:
+            return _atom('arg_in', w, span)
+        return _atom('keyword', w, span)
+
+    def at_between(self, w, option):
+        if option is None:
+            option = {'attr': 'word', 'numAppear': 1, 'cmp': 'nlt', 'onlyCount': False}
+        if isinstance(w, tuple):
+            return _atom('in', w[1], w[0], ('mid',))
+        if not isinstance(w, str):
+            raise _Unsupported("word: {!r}".format(w))
+        if option['onlyCount']:
+            # compared to the number of tokens between SUBJ and OBJ, not to the width of the mid span
+            return _atom('count', option['cmp'], option['numAppear'], ('between',))
+        if option['cmp'] != 'nlt' or option['numAppear'] != 1:
+            raise _Unsupported("option: {!r}".format(option))
+        if w in ['ArgX', 'ArgY']:
+            return _atom('arg_in', w, ('mid',))
+        return _atom('keyword', w, ('mid',))
+
+    def at_count(self, cmp, funcx, nouny, w):
+        if w == 'There':
+            return _call(funcx, w, {'attr': nouny['attr'], 'range': -1, 'numAppear': nouny['num'], 'cmp': cmp, 'onlyCount': True})
+        return _call(funcx, w, {'attr': nouny['attr'], 'range': nouny['num'], 'numAppear': 1, 'cmp': 'nlt', 'onlyCount': False})
+
+    def at_In0(self, arg, w):
+        if arg != 'Sentence' or not isinstance(w, str):
+            raise _Unsupported("In0 {!r} {!r}".format(arg, w))
+        return _atom('keyword', w, ('sentence',))
+
+    def at_WordCount(self, nouny, F):
+        word_option = {'attr': 'word', 'range': -1, 'numAppear': 1, 'cmp': 'nlt', 'onlyCount': False}
+        if isinstance(nouny, tuple):
+            count_option = {'attr': 'tokens', 'range': -1, 'numAppear': sum([len(noun.split()) for noun in nouny]), 'cmp': 'eq', 'onlyCount': True}
+            return _and([_and([_call(F, noun, word_option) for noun in nouny]), _call(F, nouny[0], count_option)])
+        count_option = {'attr': 'tokens', 'range': -1, 'numAppear': len(nouny.split()), 'cmp': 'eq', 'onlyCount': True}
+        return _and([_call(F, nouny, word_option), _call(F, nouny, count_option)])
+
+def soft_labeling_function_atoms(semantic_repr):
+    """
+        Arguments:
+            semantic_repr (tuple) : hierarchical tuple representation
+
+        Returns:
+            tuple | None : atoms the soft labeling function is the fuzzy AND of, None if the compiler doesn't
+                           support semantic_repr
+    """
+    try:
+        return _SoftCompiler().atoms(semantic_repr)
+    except Exception:
+        return None
+
+def _span(context, span):
+    """
+        Returns:
+            tuple : (B x 2 position, B x seq_len mask, B x seq_len soft mask) of span in context
+    """
+    if span[0] == 'mid':
+        position, mask = context.mid()
+        return position, mask, mask.to(torch.float32)
+    if span[0] == 'window':
+        return context.window(*span[1:])
+    return None, torch.ones_like(context.tokens), torch.ones_like(context.tokens, dtype=torch.float32)
+
+class SoftLabelingProgram():
+    """
+        Soft labeling functions compiled into one batched tensor program, called with a
+        soft_grammar_functions.SoftBatchContext
+
+        Attributes:
+            functions (arr) : soft labeling functions, in the order of the columns of the scores
+            atoms     (arr) : distinct atoms of the compiled functions
+            fallback  (arr) : indices of the functions that are called on the batch as they are
+    """
+    def __init__(self, soft_labeling_functions):
+        self.functions = list(soft_labeling_functions)
+        atom_index = {}
+        incidence = []
+        self.fallback = []
+        for i, function in enumerate(self.functions):
+            semantic_repr = getattr(function, 'semantic_repr', None)
+            atoms = soft_labeling_function_atoms(semantic_repr) if semantic_repr is not None else None
+            if atoms is None:
+                self.fallback.append(i)
+                continue
+            for atom in atoms:
+                incidence.append((i, atom_index.setdefault(atom, len(atom_index))))
+        self.atoms = list(atom_index)
+
+        # functions x atoms, a function can AND the same atom more than once
+        self.incidence = torch.zeros((len(self.functions), len(self.atoms)))
+        for i, j in incidence:
+            self.incidence[i, j] += 1
+
+        self.groups = {kind : [] for kind in ATOM_KINDS}
+        for j, atom in enumerate(self.atoms):
+            self.groups[atom[0]].append(j)
+        self.count_groups = {}
+        for j in self.groups['count']:
+            self.count_groups.setdefault(self.atoms[j][1], []).append(j)
+
+    def __len__(self):
+        return len(self.functions)
+
+    @staticmethod
+    def _index(keys):
+        """
+            Returns:
+                tuple : distinct keys, index of each key in the distinct keys
+        """
+        distinct = {}
+        index = [distinct.setdefault(key, len(distinct)) for key in keys]
+        return list(distinct), index
+
+    def _keyword_scores(self, context, rows):
+        spans, span_index = self._index([self.atoms[j][2] for j in rows])
+        soft_masks = torch.stack([_span(context, span)[2] for span in spans]) # S x B x seq_len
+        keywords = torch.tensor([context.keyword_dict[self.atoms[j][1]] for j in rows], device=context.c.device)
+        label_mat = context.label_mat[:, :, keywords].permute(2, 0, 1) # K x B x seq_len
+        span_index = torch.tensor(span_index, device=context.c.device)
+        return torch.max(label_mat * soft_masks[span_index], dim=2)[0]
+
+    def _in_scores(self, context, rows):
+        views, view_index = self._index([(self.atoms[j][2], self.atoms[j][3]) for j in rows])
+        masked = torch.stack([context.masked(attr, span, _span(context, span)[1]) for attr, span in views]) # V x B x seq_len
+        labels = []
+        for j in rows:
+            assert self.atoms[j][1] in NER_LABEL_SPACE
+            labels.append(NER_LABEL_SPACE[self.atoms[j][1]])
+        labels = torch.tensor(labels, device=context.c.device).view(-1, 1, 1)
+        view_index = torch.tensor(view_index, device=context.c.device)
+        return torch.any(torch.eq(masked[view_index], labels), dim=2).to(torch.float32)
+
+    def _count_values(self, context, value):
+        if value[0] == 'between':
+            return torch.abs(context.subj_posi[:, 0] - context.obj_posi[:, 0]) - 1
+        position = _span(context, value)[0]
+        return position[:, 1] - position[:, 0]
+
+    def _count_scores(self, context, rows):
+        values, value_index = self._index([self.atoms[j][3] for j in rows])
+        values = torch.stack([self._count_values(context, value) for value in values]) # C x B
+        nums = torch.tensor([self.atoms[j][2] for j in rows], device=context.c.device).view(-1, 1)
+        value_index = torch.tensor(value_index, device=context.c.device)
+        return compare_soft[self.atoms[rows[0]][1]](values[value_index], nums).to(torch.float32)
+
+    def _arg_in_scores(self, context, rows):
+        spans, span_index = self._index([self.atoms[j][2] for j in rows])
+        positions = torch.stack([_span(context, span)[0] for span in spans]) # S x B x 2
+        span_index = torch.tensor(span_index, device=context.c.device)
+        targets = torch.stack([context.posi(self.atoms[j][1])[:, 0] for j in rows]) # A x B
+        positions = positions[span_index]
+        return ((targets >= positions[:, :, 0]) & (targets <= positions[:, :, 1])).to(torch.float32)
+
+    def _adjacent_scores(self, context, rows):
+        first = torch.stack([context.posi(self.atoms[j][1])[:, 0] for j in rows])
+        second = torch.stack([context.posi(self.atoms[j][2])[:, 0] for j in rows])
+        return torch.eq(first - second, 1).to(torch.float32)
+
+    def atom_scores(self, context):
+        """
+            Returns:
+                tensor : len(atoms) x B scores of every atom on the batch
+        """
+        batch_size = context.c.size()[0]
+        scores = torch.zeros((len(self.atoms), batch_size), device=context.c.device)
+        groups = [(self.groups['keyword'], self._keyword_scores), (self.groups['in'], self._in_scores),
+                  (self.groups['arg_in'], self._arg_in_scores), (self.groups['adjacent'], self._adjacent_scores)]
+        groups.extend((rows, self._count_scores) for rows in self.count_groups.values())
+        for rows, score in groups:
+            if len(rows):
+                scores[torch.tensor(rows, device=context.c.device)] = score(context, rows)
+        return scores
+
+    def __call__(self, context):
+        """
+            Arguments:
+                context (SoftBatchContext) : batch to score
+
+            Returns:
+                tensor : B x len(functions) soft scores, column i is what functions[i](context) returns
+        """
+        incidence = self.incidence.to(context.c.device)
+        sizes = incidence.sum(dim=1).view(-1, 1)
+        scores = torch.clamp(torch.matmul(incidence, self.atom_scores(context)) - sizes + 1, min=0.0) # functions x B
+        if len(self.fallback):
+            scores[self.fallback] = torch.cat([torch.as_tensor(self.functions[i](context), dtype=torch.float32,
+                                                               device=context.c.device).view(1, -1)
+                                               for i in self.fallback])
+        return scores.permute(1, 0)
+
+def compile_soft_labeling_functions(soft_labeling_functions):
+    """
+        Arguments:
+            soft_labeling_functions (arr) : soft labeling functions (SoftLabelingFunction, or closures built by
+                                            utils.create_soft_labeling_function)
+
+        Returns:
+            SoftLabelingProgram : program returning a B x len(soft_labeling_functions) score matrix
+    """
+    return SoftLabelingProgram(soft_labeling_functions)
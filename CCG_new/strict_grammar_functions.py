@@ -28,6 +28,22 @@ def count_sublist(lis,sublis):
             cnt+=1
     return cnt
 
+def sub_span(span,st,ed):
+    # absolute span of lis[st:ed], lis being the tokens in span
+    start, stop = span
+    st, ed, _ = slice(st,ed).indices(stop-start)
+    return (start+st, start+max(st,ed))
+
+def posi_window(c,POSI,arg,length,range_):
+    # (st, ed) slice of the tokens of a window of the given length, which are within range_ of arg
+    if POSI == 'Left':
+        return (max(0, length - range_), None)
+    elif POSI == 'Right':
+        return (None, min(length - 1, range_-1) + 1)
+    else:
+        count_posi = c.get_other_posi(POSI, arg[-1])['POSI']
+        return (max(0,count_posi-range_), min(length,count_posi+1+range_) + 1)
+
 
 #function for $And
 def merge(x,y):
@@ -102,7 +118,7 @@ def at_POSI_0(POSI,arg,w,c,option=None):
             w_split.remove('')
         if option == 'Direct':
             range_ = len(w_split)
-            info = [token.lower() for token in c.get_other_posi(POSI, arg[-1])['tokens']]
+            info = c.get_lower_other_posi(POSI, arg[-1])
             if POSI == 'Left':
                 st = max(0, len(info) - range_)
                 info = info[st:]
@@ -117,25 +133,21 @@ def at_POSI_0(POSI,arg,w,c,option=None):
             else:
                 return False
         if option['range']==-1:
-            info = [token.lower() for token in c.get_other_posi(POSI, arg[-1])['tokens']]
-        else:                                                                               #For now, if range!=-1 then attr == 'tokens'
-            info = [token.lower() for token in c.get_other_posi(POSI, arg[-1])[option['attr']]]
-            range_ = option['range']
-            if POSI == 'Left':
-                st = max(0, len(info) - range_)
-                info = info[st:]
-            elif POSI=='Right':
-                ed = min(len(info) - 1, range_-1)
-                info = info[:ed + 1]
+            span = c.get_other_posi_span(POSI, arg[-1])
+        elif option['attr'] == 'tokens':                                                    #For now, if range!=-1 then attr == 'tokens'
+            span = c.get_other_posi_span(POSI, arg[-1])
+            span = sub_span(span, *posi_window(c, POSI, arg, span[1] - span[0], option['range']))
+        else:
+            info = c.get_lower_other_posi(POSI, arg[-1], option['attr'])
+            info = info[slice(*posi_window(c, POSI, arg, len(info), option['range']))]
+            if option['onlyCount']:
+                return compare[option['cmp']](len(info),option['numAppear'])
             else:
-                count_posi = c.get_other_posi(POSI, arg[-1])['POSI']
-                st = max(0,count_posi-range_)
-                ed = min(len(info),count_posi+1+range_)
-                info = info[st:ed+1]
+                return compare[option['cmp']](count_sublist(info,w_split),option['numAppear'])
         if option['onlyCount']:
-            return compare[option['cmp']](len(info),option['numAppear'])
+            return compare[option['cmp']](span[1] - span[0],option['numAppear'])
         else:
-            return compare[option['cmp']](count_sublist(info,w_split),option['numAppear'])
+            return compare[option['cmp']](c.count_ngram(tuple(w_split), *span),option['numAppear'])
 
 
 #function for @Between
@@ -154,12 +166,11 @@ def at_between(w,c,option=None,a=None):
         w_split = w.split()
         while '' in w_split:
             w_split.remove('')
-        info = [token.lower() for token in c.get_mid()['tokens']]
+        span = c.get_mid_span()
         if option['onlyCount']:
-            return compare[option['cmp']](len(info),option['numAppear'])
+            return compare[option['cmp']](span[1] - span[0],option['numAppear'])
         else:
-            # print(info, w,info.count(w),type(info.count(w)),option['numAppear'],option['eq'],compare[option['eq']](info.count(w),option['numAppear']))
-            return compare[option['cmp']](count_sublist(info,w_split),option['numAppear'])
+            return compare[option['cmp']](c.count_ngram(tuple(w_split), *span),option['numAppear'])
 
 
 #function for counting
@@ -211,8 +222,7 @@ def at_In0(arg,w,c):
         return w in c.ner
     else:
         w = w.lower().split()
-        info = [token.lower() for token in c.tokens]
-        return count_sublist(info,w)>0
+        return c.count_ngram(tuple(w))>0
 
 def at_WordCount(nounNum,nouny,F,c):
     if isinstance(nouny,tuple):
@@ -0,0 +1,231 @@
+"""
+    Inverted index over the tokens of a PhraseCorpus, used to skip sentences a strict labeling function
+    can't apply to.
+
+    Most strict labeling functions only apply to a sentence if a quoted word or phrase occurs somewhere in
+    it (ex: the word "was born" is between SUBJ and OBJ). required_patterns extracts those phrases from a
+    semantic representation, and TokenIndex.candidates intersects their postings, so the labeling function
+    only has to be evaluated on the sentences that contain all of them.
+"""
+import numpy as np
+import os
+from CCG_new import constants
+from CCG_new.strict_grammar_functions import merge, Selection
+
+ARGS = ['ArgX', 'ArgY']
+POSITION_MAKERS = ['@Left0', '@Right0', '@Range0']
+COUNT_MAKERS = ['@LessThan', '@AtMost', '@AtLeast', '@MoreThan']
+
+class TokenIndex():
+    """
+        Postings of every (lowercased) token of a PhraseCorpus
+
+        Attributes:
+            words         (arr) : token of each token id, same ids as PhraseCorpus.token_vocab
+            starts   (np.array) : postings of token id t are entries starts[t]:starts[t+1] of the arrays below
+            sentence_ids (np.array) : sentence of each posting
+            positions    (np.array) : position of each posting in its sentence
+            offsets  (np.array) : PhraseCorpus.offsets of the indexed corpus
+            signature     (str) : PhraseCorpus.signature of the indexed corpus
+    """
+    def __init__(self, words, starts, sentence_ids, positions, offsets, signature):
+        self.words = words
+        self.word_ids = {word : i for i, word in enumerate(words)}
+        self.starts = starts
+        self.sentence_ids = sentence_ids
+        self.positions = positions
+        self.offsets = offsets
+        self.signature = signature
+
+    @classmethod
+    def from_corpus(cls, corpus):
+        words = sorted(corpus.token_vocab, key=corpus.token_vocab.get)
+        # stable, so the postings of each token stay in corpus order
+        order = np.argsort(corpus.token_ids, kind="stable")
+        starts = np.zeros(len(words) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(corpus.token_ids, minlength=len(words)), out=starts[1:])
+        sentence_ids = np.searchsorted(corpus.offsets, order, side="right") - 1
+        positions = order - corpus.offsets[sentence_ids]
+        return cls(words, starts, sentence_ids, positions, corpus.offsets.copy(), corpus.signature())
+
+    def save(self, path):
+        np.savez(path, words=np.array(self.words, dtype=str), starts=self.starts, sentence_ids=self.sentence_ids,
+                 positions=self.positions, offsets=self.offsets, signature=np.array(self.signature))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays["words"].tolist(), arrays["starts"], arrays["sentence_ids"], arrays["positions"],
+                       arrays["offsets"], str(arrays["signature"]))
+
+    @classmethod
+    def load_or_build(cls, corpus, path):
+        """
+            Loads a previously saved index if it was built from the same corpus, else builds the index and
+            saves it to path.
+
+            Arguments:
+                corpus (PhraseCorpus) : corpus to index
+                path            (str) : file to load the index from / save the index to (.npz)
+
+            Returns:
+                TokenIndex : index of the corpus
+        """
+        if os.path.exists(path):
+            index = cls.load(path)
+            if index.signature == corpus.signature():
+                return index
+
+        index = cls.from_corpus(corpus)
+        index.save(path)
+        return index
+
+    def postings(self, word):
+        """
+            Returns:
+                np.array, np.array : sentence ids and positions where the (lowercased) word occurs
+        """
+        if word not in self.word_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        token_id = self.word_ids[word]
+        start, stop = self.starts[token_id], self.starts[token_id+1]
+        return self.sentence_ids[start:stop], self.positions[start:stop]
+
+    def pattern_sentences(self, pattern):
+        """
+            Sorted ids of the sentences that contain the lowercased words of pattern next to each other
+        """
+        sentence_ids, positions = self.postings(pattern[0])
+        global_positions = self.offsets[sentence_ids] + positions
+        for k, word in enumerate(pattern[1:], 1):
+            next_sentence_ids, next_positions = self.postings(word)
+            if len(next_sentence_ids) == 0:
+                return np.zeros(0, dtype=np.int64)
+            next_global_positions = self.offsets[next_sentence_ids] + next_positions
+            # both are sorted, since postings are in corpus order
+            found = np.minimum(np.searchsorted(next_global_positions, global_positions + k), len(next_global_positions) - 1)
+            # k positions further in the corpus may already be in the next sentence
+            keep = (next_global_positions[found] == global_positions + k) & (next_sentence_ids[found] == sentence_ids)
+            sentence_ids, global_positions = sentence_ids[keep], global_positions[keep]
+        return np.unique(sentence_ids)
+
+    def candidates(self, patterns):
+        """
+            Sentences containing every pattern
+
+            Arguments:
+                patterns (iterable) : tuples of lowercased words
+
+            Returns:
+                np.array | None : sorted sentence ids, None if there are no patterns (every sentence is a candidate)
+        """
+        pattern_rows = sorted((self.pattern_sentences(pattern) for pattern in patterns), key=len)
+        if len(pattern_rows) == 0:
+            return None
+        rows = pattern_rows[0]
+        for other_rows in pattern_rows[1:]:
+            if len(rows) == 0:
+                break
+            rows = np.intersect1d(rows, other_rows, assume_unique=True)
+        return rows
+
+def _value(semantic_repr):
+    """
+        What a word-level part of a semantic representation evaluates to in create_labeling_function
+        (a word, or a tuple of words and NER selections), None if it isn't word-level
+    """
+    if isinstance(semantic_repr, str):
+        return constants.NER_TERMINAL_TO_EXECUTION_TUPLE.get(semantic_repr, semantic_repr)
+    if isinstance(semantic_repr, tuple) and len(semantic_repr) == 2 and semantic_repr[0] == '@Word':
+        return _value(semantic_repr[1])
+    if isinstance(semantic_repr, tuple) and len(semantic_repr) == 3 and semantic_repr[0] == '@And':
+        x, y = _value(semantic_repr[1]), _value(semantic_repr[2])
+        if x is None or y is None:
+            return None
+        return merge(x, y)
+    return None
+
+def _words(value):
+    # words that IsFunc and at_POSI look up one at a time
+    if isinstance(value, tuple):
+        if len(value) == 0 or value[0] in Selection:
+            return []
+        return [w for w in value if isinstance(w, str)]
+    return [value] if isinstance(value, str) else []
+
+def _pattern(word):
+    return tuple(word.lower().split())
+
+def _counted_patterns(words, maker, attr):
+    """
+        Patterns required when each word is counted at least once by maker (with the default option, or a
+        range limited option over attr)
+    """
+    if not isinstance(maker, tuple) or len(maker) != 2:
+        return set()
+    # @between ignores the range of the option, a position maker only counts tokens if attr is tokens, and
+    # looks at the other side of its argument when the argument isn't ArgX or ArgY
+    counted = maker[0] == '@between' or (maker[0] in POSITION_MAKERS and _value(maker[1]) in ARGS and attr == 'tokens')
+    if not counted:
+        return set()
+    return set(_pattern(w) for w in words if w not in ARGS) - {()}
+
+def _is_patterns(words, predicate):
+    """
+        Patterns required by @Is(words, predicate)
+    """
+    if not isinstance(predicate, tuple) or len(predicate) == 0:
+        return set()
+    op = predicate[0]
+    if op == '@And' and len(predicate) == 3:
+        return _is_patterns(words, predicate[1]) | _is_patterns(words, predicate[2])
+    if op == '@between' or op in POSITION_MAKERS:
+        return _counted_patterns(words, predicate, 'tokens')
+    if op in COUNT_MAKERS and len(predicate) == 3:
+        nouny = predicate[2]
+        if not (isinstance(nouny, tuple) and len(nouny) == 3 and nouny[0] == '@Num'):
+            return set()
+        # 'There' counts the words of the window instead of looking one up
+        return _counted_patterns([w for w in words if w != 'There'], predicate[1], _value(nouny[2]))
+    if op == '@Direct' and len(predicate) == 2:
+        maker = predicate[1]
+        if isinstance(maker, tuple) and len(maker) == 2 and maker[0] in ['@Left0', '@Right0'] and _value(maker[1]) in ARGS:
+            return set(_pattern(w) for w in words if w not in ARGS) - {()}
+        return set()
+    if op == '@In0' and len(predicate) == 2 and predicate[1] == 'Sentence':
+        return set(_pattern(w) for w in words) - {()}
+    return set()
+
+def required_patterns(semantic_repr):
+    """
+        Phrases a sentence has to contain for the strict labeling function of semantic_repr to apply to it.
+        Only parts of the semantic representation whose outcome requires a phrase to occur are used, anything
+        else (ex: "There are at most 3 words ...") requires nothing, so the result may be empty.
+
+        Arguments:
+            semantic_repr (tuple) : hierarchical tuple representation
+
+        Returns:
+            set : tuples of lowercased words, each of which has to occur (words next to each other) in the sentence
+    """
+    if not isinstance(semantic_repr, tuple) or len(semantic_repr) == 0:
+        return set()
+    op = semantic_repr[0]
+    if op == '.root' and len(semantic_repr) == 2:
+        return required_patterns(semantic_repr[1])
+    if op == '@And' and len(semantic_repr) == 3:
+        # a tuple of predicates, all of them have to apply
+        return required_patterns(semantic_repr[1]) | required_patterns(semantic_repr[2])
+    if op == '@Is' and len(semantic_repr) == 3:
+        return _is_patterns(_words(_value(semantic_repr[1])), semantic_repr[2])
+    if op == '@In1' and len(semantic_repr) == 3 and semantic_repr[1] == 'Sentence':
+        return set(_pattern(w) for w in _words(_value(semantic_repr[2]))) - {()}
+    if op == '@By' and len(semantic_repr) == 4:
+        nouny = semantic_repr[3]
+        if not (isinstance(nouny, tuple) and len(nouny) == 3 and nouny[0] == '@Num'):
+            return set()
+        word = _value(semantic_repr[1])
+        return _counted_patterns([word] if isinstance(word, str) else [], semantic_repr[2], _value(nouny[2]))
+    if op in ['@Left', '@Right'] and len(semantic_repr) == 3 and _value(semantic_repr[1]) in ARGS:
+        return set(_pattern(w) for w in _words(_value(semantic_repr[2])) if w not in ARGS) - {()}
+    return set()
@@ -1,7 +1,15 @@
 import pdb
+import bisect
+import hashlib
+import numpy as np
 def tokens_to_string(tokens):
     return " ".join(tokens)
 
+def _span(st, ed, length):
+    # absolute (start, stop) of list[st:ed] in a list of the given length, start <= stop
+    st, ed, _ = slice(st, ed).indices(length)
+    return (st, max(st, ed))
+
 class DataPoint():
     """
         Class that ties together some useful properties we need to store about a datapoint (x)
@@ -15,12 +23,17 @@ class DataPoint():
             tokenized_explanations (list) : given a list of chunks, multiple possible token sequences 
                                             can be created. Each item in this list is itself a list, each 
                                             inner list is a list of tokens from our grammar
+            token_lattice          (list) : the same token sequences in compact form, one list of possible
+                                            tokens per position. The token sequences are the cartesian product
+                                            of these lists.
+            parse_cutoffs          (dict) : key - name of a parse budget limit that was hit while tokenizing or
+                                            parsing the explanation, value - number of times it was hit
             semantic_counts        (dict) : for each possible sequence of tokens we store the parsed semantic
                                             representation of the raw_explanation. We first convert possible token
                                             sequences into trees and extract the hierarchical semantics tied to each
                                             tree. We then store the unique semantics as keys and count how often each
                                             representation appears.
-            labeling_functions     (dict) : key - semantic representation, value - lambda function equivalent
+            labeling_functions     (dict) : key - semantic representation, value - LabelingFunction equivalent
     """
     def __init__(self, sentence, label, explanation=""):
         self.sentence = sentence
@@ -28,6 +41,8 @@ class DataPoint():
         self.raw_explanation = explanation
         self.chunked_explanation = None
         self.tokenized_explanations = None
+        self.token_lattice = None
+        self.parse_cutoffs = None
         self.semantic_counts = None
         self.labeling_functions = None
 
@@ -41,7 +56,15 @@ class Phrase():
 
         For now mostly untouched, other than guarding against the possability of no subj or obj
             - as is the case for Text Classification
+
+        The windows returned by get_mid and get_other_posi, and their lowercased tokens, are built the first
+        time they are asked for and cached, so evaluating many labeling functions on one Phrase only does the
+        slicing, joining and lowercasing once. The cached dicts and lists are shared between callers, don't
+        modify them.
     """
+    __slots__ = ['tokens', 'ners', 'subj_posi', 'obj_posi', 'sentence', 'subj', 'obj', '_lower_tokens', '_views', '_ngrams']
+    _state = ['tokens', 'ners', 'subj_posi', 'obj_posi', 'sentence', 'subj', 'obj']
+
     def __init__(self, tokens, ners, subj_posi, obj_posi):
         self.tokens = tokens
         self.ners = ners
@@ -56,8 +79,37 @@ class Phrase():
             self.obj = self.tokens[self.obj_posi]
         else:
             self.obj = ""
-    
+        self._clear_views()
+
+    def _clear_views(self):
+        self._lower_tokens = None
+        self._views = {}
+        self._ngrams = {}
+
+    def __getstate__(self):
+        return {name : getattr(self, name) for name in Phrase._state}
+
+    def __setstate__(self, state):
+        # state is also the __dict__ of Phrases pickled before Phrase had __slots__
+        for name in Phrase._state:
+            setattr(self, name, state[name])
+        self._clear_views()
+
+    @property
+    def lower_tokens(self):
+        """
+            Lowercased tokens, computed once
+        """
+        if self._lower_tokens is None:
+            self._lower_tokens = [token.lower() for token in self.tokens]
+        return self._lower_tokens
+
     def get_mid(self):
+        if 'mid' not in self._views:
+            self._views['mid'] = self._get_mid()
+        return self._views['mid']
+
+    def _get_mid(self):
         if self.subj_posi != None and self.obj_posi != None:
             st = min(self.subj_posi,self.obj_posi)+1
             ed = max(self.subj_posi,self.obj_posi)
@@ -67,8 +119,32 @@ class Phrase():
             return {'word':midphrase,'NER':midners,'tokens':self.tokens[st:ed],'position':(st,ed)}
 
         return {'word':tokens_to_string(self.tokens),'NER':self.ners,'tokens':self.tokens,'position':(0,len(self.tokens))}
-    
+
+    def get_lower_mid(self):
+        """
+            Lowercased version of get_mid()['tokens']
+        """
+        if 'lower_mid' not in self._views:
+            st, ed = self.get_mid()['position']
+            self._views['lower_mid'] = self.lower_tokens[st:ed]
+        return self._views['lower_mid']
+
+    def get_mid_span(self):
+        """
+            (start, stop) of get_mid()['tokens'] in tokens
+        """
+        if 'mid_span' not in self._views:
+            st, ed = self.get_mid()['position']
+            self._views['mid_span'] = _span(st, ed, len(self.tokens))
+        return self._views['mid_span']
+
     def get_other_posi(self,LoR,XoY):
+        key = (LoR, XoY)
+        if key not in self._views:
+            self._views[key] = self._get_other_posi(LoR, XoY)
+        return self._views[key]
+
+    def _get_other_posi(self,LoR,XoY):
         assert LoR == 'Left' or LoR == 'Right' or LoR=='Range'
         assert XoY == 'X' or XoY == 'Y'
 
@@ -98,6 +174,74 @@ class Phrase():
 
         return {'word':tokens_to_string(self.tokens),'NER':self.ners,'tokens':self.tokens,'position':(0,len(self.tokens))}
 
+    def get_lower_other_posi(self, LoR, XoY, attr='tokens'):
+        """
+            Lowercased version of get_other_posi(LoR, XoY)[attr], ex: the lowercased tokens left of SUBJ
+        """
+        key = (LoR, XoY, attr)
+        if key not in self._views:
+            other_posi = self.get_other_posi(LoR, XoY)
+            if attr == 'tokens':
+                st, ed = other_posi.get('position', (0, len(self.tokens)))
+                self._views[key] = self.lower_tokens[st:ed]
+            else:
+                self._views[key] = [item.lower() for item in other_posi[attr]]
+        return self._views[key]
+
+    def get_other_posi_span(self, LoR, XoY):
+        """
+            (start, stop) of get_other_posi(LoR, XoY)['tokens'] in tokens
+        """
+        key = ('span', LoR, XoY)
+        if key not in self._views:
+            st, ed = self.get_other_posi(LoR, XoY).get('position', (0, len(self.tokens)))
+            self._views[key] = _span(st, ed, len(self.tokens))
+        return self._views[key]
+
+    def ngram_positions(self, n):
+        """
+            Returns:
+                dict : key - tuple of n lowercased tokens, value - sorted positions the n-gram starts at
+        """
+        if n not in self._ngrams:
+            tokens = self.lower_tokens
+            positions = {}
+            for i, ngram in enumerate(zip(*[tokens[j:] for j in range(n)])):
+                if ngram in positions:
+                    positions[ngram].append(i)
+                else:
+                    positions[ngram] = [i]
+            self._ngrams[n] = positions
+        return self._ngrams[n]
+
+    def count_ngram(self, ngram, start=0, stop=None):
+        """
+            Number of times an n-gram appears in lower_tokens[start:stop], same as
+            strict_grammar_functions.count_sublist(lower_tokens[start:stop], list(ngram))
+
+            Arguments:
+                ngram (tuple) : lowercased tokens
+                start   (int) : absolute start of the window
+                stop    (int) : absolute stop of the window, the end of the sentence if None
+        """
+        if stop is None:
+            stop = len(self.tokens)
+        n = len(ngram)
+        if n == 0:
+            # every offset, including the one past the end, matches an empty list
+            return max(0, stop - start) + 1
+        if stop - start < n:
+            return 0
+        ngrams = self._ngrams.get(n)
+        if ngrams is None:
+            ngrams = self.ngram_positions(n)
+        positions = ngrams.get(ngram)
+        if positions is None:
+            return 0
+        if len(positions) == 1:
+            return 1 if start <= positions[0] <= stop - n else 0
+        return bisect.bisect_right(positions, stop - n) - bisect.bisect_left(positions, start)
+
     def with_(self,XoY,SoE,substring):
         assert XoY == 'X' or XoY == 'Y'
         assert SoE == 'starts' or SoE == 'ends'
@@ -117,8 +261,287 @@ class Phrase():
     def update_tokens_and_ners(self, tokens, ners):
         self.tokens = tokens
         self.ners = ners
+        self._clear_views()
         if self.subj_posi != None:
             self.subj = self.tokens[self.subj_posi]
         if self.obj_posi != None:
             self.obj = self.tokens[self.obj_posi]
     
+
+class NotVectorized(Exception):
+    """
+        Raised by PhraseCorpus methods and vector_grammar_functions for cases that aren't vectorized, callers
+        then evaluate the per-Phrase labeling function instead
+    """
+    pass
+
+class PhraseCorpus():
+    """
+        Columnar version of a list of Phrase objects, used to evaluate strict labeling functions on every
+        Phrase at once (see vector_grammar_functions).
+
+        Tokens are lowercased once and stored as one flat array of token ids, NER types as one flat array
+        of NER ids, sentence i owns positions offsets[i]:offsets[i+1] of both. Windows of a sentence
+        (ex: the tokens between SUBJ and OBJ) are pairs of start, stop arrays holding positions relative to
+        each sentence, computed with the same slicing rules Phrase uses.
+
+        Attributes:
+            phrases          (arr) : the Phrase objects, in order
+            token_vocab     (dict) : key - lowercased token, value - token id
+            ner_vocab       (dict) : key - NER type, value - NER id
+            token_ids   (np.array) : lowercased token ids of all sentences, concatenated
+            ner_ids     (np.array) : NER ids of all sentences, concatenated
+            offsets     (np.array) : start of each sentence in token_ids and ner_ids, plus the total length
+            lengths     (np.array) : number of tokens in each sentence
+            subj_posi   (np.array) : position of SUBJ in each sentence
+            obj_posi    (np.array) : position of OBJ in each sentence
+            subj_words       (arr) : Phrase.subj of each sentence
+            obj_words        (arr) : Phrase.obj of each sentence
+            subj_ner_types   (arr) : lowercased NER type of SUBJ in each sentence, None if there is no SUBJ
+            obj_ner_types    (arr) : lowercased NER type of OBJ in each sentence, None if there is no OBJ
+    """
+    def __init__(self, phrases):
+        self.phrases = phrases
+        self.token_vocab = {}
+        self.ner_vocab = {}
+        token_ids = []
+        ner_ids = []
+        lengths = []
+        # windows over NER types reuse token positions, so they need one NER type per token
+        self.aligned = True
+        for phrase in phrases:
+            token_ids.extend(self.token_vocab.setdefault(token.lower(), len(self.token_vocab)) for token in phrase.tokens)
+            ner_ids.extend(self.ner_vocab.setdefault(ner, len(self.ner_vocab)) for ner in phrase.ners)
+            lengths.append(len(phrase.tokens))
+            if len(phrase.ners) != len(phrase.tokens):
+                self.aligned = False
+        self.token_ids = np.array(token_ids, dtype=np.int64)
+        self.ner_ids = np.array(ner_ids, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.offsets = np.zeros(len(phrases) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=self.offsets[1:])
+        self.subj_posi = np.array([phrase.subj_posi for phrase in phrases], dtype=np.int64)
+        self.obj_posi = np.array([phrase.obj_posi for phrase in phrases], dtype=np.int64)
+        self.subj_words = [phrase.subj for phrase in phrases]
+        self.obj_words = [phrase.obj for phrase in phrases]
+        self.subj_ner_types = [self._ner_type(phrase, phrase.subj_posi) for phrase in phrases]
+        self.obj_ner_types = [self._ner_type(phrase, phrase.obj_posi) for phrase in phrases]
+        self._pattern_cumsums = {}
+        self._ner_cumsums = {}
+        self._word_groups = {}
+        self._ner_type_rows = None
+
+    def subset(self, rows):
+        """
+            PhraseCorpus of the sentences in rows (sorted sentence indices), sharing this corpus's vocabularies
+
+            Arguments:
+                rows (np.array) : indices of the sentences to keep
+
+            Returns:
+                PhraseCorpus : corpus of the selected sentences, in the order of rows
+        """
+        corpus = PhraseCorpus.__new__(PhraseCorpus)
+        corpus.phrases = [self.phrases[i] for i in rows]
+        corpus.token_vocab = self.token_vocab
+        corpus.ner_vocab = self.ner_vocab
+        corpus.aligned = self.aligned
+        corpus.lengths = self.lengths[rows]
+        corpus.offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(corpus.lengths, out=corpus.offsets[1:])
+        # position i of the new arrays comes from position i + (old offset - new offset) of its sentence
+        flat = np.arange(corpus.offsets[-1]) + np.repeat(self.offsets[:-1][rows] - corpus.offsets[:-1], corpus.lengths)
+        corpus.token_ids = self.token_ids[flat]
+        corpus.ner_ids = self.ner_ids[flat] if self.aligned else self.ner_ids
+        corpus.subj_posi = self.subj_posi[rows]
+        corpus.obj_posi = self.obj_posi[rows]
+        corpus.subj_words = [self.subj_words[i] for i in rows]
+        corpus.obj_words = [self.obj_words[i] for i in rows]
+        corpus.subj_ner_types = [self.subj_ner_types[i] for i in rows]
+        corpus.obj_ner_types = [self.obj_ner_types[i] for i in rows]
+        corpus._pattern_cumsums = {}
+        corpus._ner_cumsums = {}
+        corpus._word_groups = {}
+        corpus._ner_type_rows = None
+        return corpus
+
+    def signature(self):
+        """
+            Stable identifier for the tokens of the corpus, used to check that a saved TokenIndex belongs to it
+        """
+        hasher = hashlib.sha1()
+        words = sorted(self.token_vocab, key=self.token_vocab.get)
+        hasher.update("\0".join(words).encode("utf-8"))
+        hasher.update(self.token_ids.tobytes())
+        hasher.update(self.offsets.tobytes())
+        return hasher.hexdigest()
+
+    @staticmethod
+    def _ner_type(phrase, posi):
+        try:
+            return phrase.ners[posi].lower()
+        except IndexError:
+            return None
+
+    def __len__(self):
+        return len(self.phrases)
+
+    def _index(self, index, length):
+        # normalizes a slice index the way python does
+        return np.where(index < 0, np.maximum(index + length, 0), np.minimum(index, length))
+
+    def slice_window(self, start, stop, length=None):
+        """
+            Window of tokens[start:stop] in each sentence
+
+            Arguments:
+                start, stop (np.array) : slice indices, may be negative or past the end like python slice indices
+                length      (np.array) : length of the sequences being sliced, defaults to sentence lengths
+
+            Returns:
+                np.array, np.array : start and stop of the window, 0 <= start <= stop <= length
+        """
+        if length is None:
+            length = self.lengths
+        start = self._index(start, length)
+        stop = self._index(stop, length)
+        return start, np.maximum(start, stop)
+
+    def get_mid(self):
+        """
+            Window between SUBJ and OBJ, same as Phrase.get_mid
+        """
+        start = np.minimum(self.subj_posi, self.obj_posi) + 1
+        stop = np.maximum(self.subj_posi, self.obj_posi)
+        return self.slice_window(start, stop)
+
+    def get_other_posi(self, LoR, XoY):
+        """
+            Window to the left or right of SUBJ or OBJ (or the whole sentence for Range), same as
+            Phrase.get_other_posi
+
+            Returns:
+                np.array, np.array, np.array : start and stop of the window, position of SUBJ or OBJ
+        """
+        assert LoR == 'Left' or LoR == 'Right' or LoR=='Range'
+        assert XoY == 'X' or XoY == 'Y'
+
+        split_posi = self.subj_posi if XoY == 'X' else self.obj_posi
+        if LoR == 'Left':
+            start, stop = self.slice_window(np.zeros_like(split_posi), split_posi)
+        elif LoR == 'Right':
+            start, stop = self.slice_window(split_posi + 1, self.lengths)
+        else:
+            start, stop = np.zeros_like(self.lengths), self.lengths
+        return start, stop, split_posi
+
+    def word_groups(self, XoY):
+        """
+            Groups sentences by their SUBJ (or OBJ) word
+
+            Returns:
+                arr : (word, np.array of sentence indices) tuples
+        """
+        if XoY not in self._word_groups:
+            groups = {}
+            for i, word in enumerate(self.subj_words if XoY == 'X' else self.obj_words):
+                groups.setdefault(word, []).append(i)
+            self._word_groups[XoY] = [(word, np.array(rows, dtype=np.int64)) for word, rows in groups.items()]
+        return self._word_groups[XoY]
+
+    def _pattern_cumsum(self, pattern_ids):
+        # cumsum[p] - number of positions before p where the pattern starts
+        if pattern_ids not in self._pattern_cumsums:
+            total = len(self.token_ids)
+            span = max(total - len(pattern_ids) + 1, 0)
+            matches = np.ones(span, dtype=bool)
+            for k, token_id in enumerate(pattern_ids):
+                matches &= self.token_ids[k:k+span] == token_id
+            cumsum = np.zeros(total + 1, dtype=np.int64)
+            np.cumsum(matches, out=cumsum[1:span+1])
+            cumsum[span+1:] = cumsum[span]
+            self._pattern_cumsums[pattern_ids] = cumsum
+        return self._pattern_cumsums[pattern_ids]
+
+    def count_sublist(self, pattern, start, stop, rows=slice(None)):
+        """
+            Number of occurrences of pattern inside the window of each sentence, same as
+            strict_grammar_functions.count_sublist
+
+            Arguments:
+                pattern          (arr) : lowercased words
+                start, stop (np.array) : window of each sentence in rows
+                rows  (slice|np.array) : sentences the window arrays belong to
+
+            Returns:
+                np.array : count for each sentence in rows
+        """
+        if len(pattern) == 0:
+            return stop - start + 1
+        pattern_ids = tuple(self.token_vocab.get(word, -1) for word in pattern)
+        if -1 in pattern_ids:
+            return np.zeros(len(start), dtype=np.int64)
+        cumsum = self._pattern_cumsum(pattern_ids)
+        begin = self.offsets[:-1][rows] + start
+        end = np.maximum(self.offsets[:-1][rows] + stop - len(pattern) + 1, begin)
+        return cumsum[end] - cumsum[begin]
+
+    def contains(self, attr, value, start, stop, rows=slice(None)):
+        """
+            Whether value is inside the window of each sentence, only NER windows are supported
+
+            Returns:
+                np.array : boolean for each sentence in rows
+        """
+        if attr != 'NER' or not self.aligned:
+            raise NotVectorized("only NER windows can be searched for a value")
+        if value not in self.ner_vocab:
+            return np.zeros(len(start), dtype=bool)
+        ner_id = self.ner_vocab[value]
+        if ner_id not in self._ner_cumsums:
+            cumsum = np.zeros(len(self.ner_ids) + 1, dtype=np.int64)
+            np.cumsum(self.ner_ids == ner_id, out=cumsum[1:])
+            self._ner_cumsums[ner_id] = cumsum
+        cumsum = self._ner_cumsums[ner_id]
+        begin = self.offsets[:-1][rows] + start
+        return cumsum[self.offsets[:-1][rows] + stop] - cumsum[begin] > 0
+
+    def with_(self, XoY, SoE, substring):
+        """
+            Same as Phrase.with_ for every sentence
+        """
+        assert XoY == 'X' or XoY == 'Y'
+        assert SoE == 'starts' or SoE == 'ends'
+
+        result = np.zeros(len(self), dtype=bool)
+        for word, rows in self.word_groups(XoY):
+            try:
+                result[rows] = word.startswith(substring) if SoE == 'starts' else word.endswith(substring)
+            except TypeError:
+                # a tuple substring is only checked up to its first match, so whether Phrase.with_ raises on a
+                # non-string in it depends on the word, sentences it raises on don't fire
+                pass
+        return result
+
+    def ner_type_rows(self, subj_type, obj_type):
+        """
+            Sorted indices of the sentences whose SUBJ and OBJ have the given (lowercased) NER types
+        """
+        if self._ner_type_rows is None:
+            # sentences are bucketed by NER type pair once, every pair is then a lookup
+            buckets = {}
+            for i, ner_types in enumerate(zip(self.subj_ner_types, self.obj_ner_types)):
+                buckets.setdefault(ner_types, []).append(i)
+            self._ner_type_rows = {ner_types : np.array(rows, dtype=np.int64) for ner_types, rows in buckets.items()}
+        return self._ner_type_rows.get((subj_type, obj_type), np.zeros(0, dtype=np.int64))
+
+    def truth(self, value):
+        """
+            Turns the output of a vectorized labeling function into one boolean per sentence, values that
+            aren't per sentence are tested for truth the way the per-Phrase labeling function's output is
+        """
+        if isinstance(value, np.ndarray) and value.shape == (len(self),):
+            return value.astype(bool)
+        if isinstance(value, np.ndarray):
+            raise ValueError("expected one value per sentence, got shape {}".format(value.shape))
+        return np.full(len(self), bool(value), dtype=bool)
@@ -1,9 +1,11 @@
 import re
 import string
+import numpy as np
 from CCG_new import constants
 from CCG_new import util_classes
+from CCG_new import compiled_lexicon
+from CCG_new import token_index
 import pdb
-import copy
 from nltk.ccg import chart, lexicon
 
 def _find_quoted_phrases(explanation):
@@ -241,28 +243,86 @@ def add_rules_to_grammar(tokens, grammar_string):
         Returns:
             str : updated grammar_string
     """
-    grammar = grammar_string
+    # joined once at the end, repeatedly appending to the grammar is quadratic in the number of tokens
+    grammar = [grammar_string]
     for token in tokens:
         raw_token = token[1:len(token)-1]
         token = prepare_token_for_rule_addition(token)
         if raw_token.isdigit():
-            grammar = grammar + "\n\t\t" + token + " => NP/NP {\\x.'@Num'(" + token + ",x)}" + "\n\t\t" + token + " => N/N {\\x.'@Num'(" + token + ",x)}"+"\n"
-            grammar = grammar + "\n\t\t" + token + " => NP {" + token + "}" + "\n\t\t" + token + " => N {" + token + "}"+"\n"
-            grammar = grammar + "\n\t\t" + token + " => PP/PP/NP/NP {\\x y F.'@WordCount'('@Num'(" + token + ",x),y,F)}" + "\n\t\t" + token + " => PP/PP/N/N {\\x y F.'@WordCount'('@Num'(" + token + ",x),y,F)}"+"\n"
+            grammar.append("\n\t\t" + token + " => NP/NP {\\x.'@Num'(" + token + ",x)}" + "\n\t\t" + token + " => N/N {\\x.'@Num'(" + token + ",x)}"+"\n")
+            grammar.append("\n\t\t" + token + " => NP {" + token + "}" + "\n\t\t" + token + " => N {" + token + "}"+"\n")
+            grammar.append("\n\t\t" + token + " => PP/PP/NP/NP {\\x y F.'@WordCount'('@Num'(" + token + ",x),y,F)}" + "\n\t\t" + token + " => PP/PP/N/N {\\x y F.'@WordCount'('@Num'(" + token + ",x),y,F)}"+"\n")
         else:
-            grammar = grammar + "\n\t\t" + token + " => NP {"+token+"}"+"\n\t\t"+token+" => N {"+token+"}"
-    return grammar
+            grammar.append("\n\t\t" + token + " => NP {"+token+"}"+"\n\t\t"+token+" => N {"+token+"}")
+    return "".join(grammar)
 
-def generate_phrase(sentence, nlp):
+def generate_phrase(sentence, nlp, phrase_cache=None):
     """
         Generate a useful wrapper object for each sentence in the data
         Arguments:
-            sentence    (str) : sentence to generate wrapper for
-            nlp (spaCy model) : pre-loaded spaCy model to use for NER detection
+            sentence             (str) : sentence to generate wrapper for
+            nlp          (spaCy model) : pre-loaded spaCy model to use for NER detection
+            phrase_cache (PhraseCache) : if given, consulted before running spaCy and filled with new Phrases
         
         Returns:
             Phrase : useful wrapper object
     """
+    if phrase_cache is not None:
+        phrase = phrase_cache.get(sentence, nlp)
+        if phrase is not None:
+            return phrase
+    prepared_sentence, subj_type, obj_type = _prepare_sentence_for_phrase(sentence)
+    doc = nlp(prepared_sentence)
+    phrase = _phrase_from_doc(doc, subj_type, obj_type)
+    if phrase_cache is not None:
+        phrase_cache.put(sentence, phrase, nlp)
+    return phrase
+
+def generate_phrases(sentences, nlp, batch_size=1000, n_process=1, phrase_cache=None):
+    """
+        Batched version of generate_phrase, runs the sentences through spaCy with nlp.pipe. Only the text
+        and NER type of each token are read, so the pipeline components we don't need are disabled.
+
+        Arguments:
+            sentences            (arr) : sentences to generate wrappers for
+            nlp          (spaCy model) : pre-loaded spaCy model to use for NER detection
+            batch_size           (int) : number of sentences spaCy processes at a time
+            n_process            (int) : number of processes spaCy uses
+            phrase_cache (PhraseCache) : if given, only sentences missing from the cache are run through spaCy,
+                                         and their Phrases are added to it
+        
+        Returns:
+            arr : Phrase objects, in the same order as sentences
+    """
+    if phrase_cache is not None:
+        phrases = phrase_cache.get_many(sentences, nlp)
+    else:
+        phrases = [None] * len(sentences)
+    missing = [i for i, phrase in enumerate(phrases) if phrase is None]
+    if len(missing) == 0:
+        return phrases
+
+    prepared = [_prepare_sentence_for_phrase(sentences[i]) for i in missing]
+    disable = [name for name in constants.UNUSED_SPACY_COMPONENTS if name in nlp.pipe_names]
+    docs = nlp.pipe([entry[0] for entry in prepared], batch_size=batch_size, n_process=n_process, disable=disable)
+    for i, doc, (_, subj_type, obj_type) in zip(missing, docs, prepared):
+        phrases[i] = _phrase_from_doc(doc, subj_type, obj_type)
+
+    if phrase_cache is not None:
+        phrase_cache.put_many([sentences[i] for i in missing], [phrases[i] for i in missing], nlp)
+    return phrases
+
+def _prepare_sentence_for_phrase(sentence):
+    """
+        Pulls the NER types of SUBJ and OBJ out of a sentence (ex: SUBJ-PERSON), leaving just SUBJ and OBJ
+
+        Returns:
+            str : sentence with the NER types removed
+            str : NER type of SUBJ (None if the sentence doesn't have both SUBJ and OBJ)
+            str : NER type of OBJ (None if the sentence doesn't have both SUBJ and OBJ)
+    """
+    subj_type = None
+    obj_type = None
     if "SUBJ" in sentence and "OBJ" in sentence:
         subj_type = re.search(r"SUBJ-[A-Z_'s,]+", sentence).group(0).split("-")[1].strip()
         subj_type = subj_type.replace("'s", "")
@@ -277,7 +337,12 @@ def generate_phrase(sentence, nlp):
         sentence = re.sub(r"OBJ-[A-Z_'s]+", "OBJ's ", sentence)
         sentence = re.sub(r"OBJ-[A-Z_]+,", "OBJ,", sentence)
 
-    doc = nlp(sentence)
+    return sentence, subj_type, obj_type
+
+def _phrase_from_doc(doc, subj_type, obj_type):
+    """
+        Builds the Phrase of a sentence from its spaCy doc and the NER types of SUBJ and OBJ
+    """
     ners = [token.ent_type_ if token.text not in ["SUBJ", "OBJ"] else "" for token in doc]
     tokens = [token.text.lower() for token in doc]
     # soft matching functions depend on these values, so if no SUBJ or OBJ exist
@@ -319,25 +384,31 @@ def parse_tokens(one_sent_tokenize, raw_lexicon):
             * Each element in the row is string version of nltk.tree.Tree (sort of, we actually construct our
               own tree based on the tree provided by NLTK)
 
+        The entries created for each layer are added to a scope on top of the compiled lexicon, rather than
+        appended to the grammar string and re-parsed.
+
         Arguments:
-            one_sent_tokenize (arr) : array of string tokens representing a sentence
-            raw_lexicon       (str) : string representation of lexicon (grammar and vocabulary rep of a language)
+            one_sent_tokenize             (arr) : array of string tokens representing a sentence
+            raw_lexicon (str|CompiledLexicon) : string representation of lexicon (grammar and vocabulary rep
+                                                of a language) or an already compiled version of it (or a
+                                                LexiconScope of one)
         
         Returns:
             (arr) : list of possible parses, read comment above for more
     """
     try:
-        beam_lexicon = copy.deepcopy(raw_lexicon)
+        if isinstance(raw_lexicon, str):
+            raw_lexicon = compiled_lexicon.compile_lexicon(raw_lexicon)
+        beam_lexicon = raw_lexicon.scope()
+        parser = chart.CCGChartParser(beam_lexicon, chart.DefaultRuleSet)
         CYK_form = [[[token] for token in one_sent_tokenize]]
         CYK_sem = [[]]
         for layer in range(1,len(one_sent_tokenize)):
             layer_form = []
             layer_sem = []
-            lex = lexicon.fromstring(beam_lexicon, True)
-            parser = chart.CCGChartParser(lex, chart.DefaultRuleSet)
             for col in range(0,len(one_sent_tokenize)-layer):
                 form = []
-                sem_temp = []
+                sem_temp = set()
                 word_index = 0
                 st = col+0
                 ed = st+layer
@@ -353,17 +424,18 @@ def parse_tokens(one_sent_tokenize, raw_lexicon):
                                     sem = token.semantics()
                                     word_name = '$Layer{}_Horizon{}_{}'.format(str(layer), str(col),str(word_index))
                                     word_index+=1
-                                    entry = "\n\t\t"+word_name+' => '+str(categ)+" {"+str(sem)+"}"
                                     if str(sem)+'_'+str(categ) not in sem_temp:
-                                        form.append((parse,word_name,entry,str(sem)))
-                                        sem_temp.append(str(sem)+'_'+str(categ))
+                                        form.append((word_name,str(categ),str(sem)))
+                                        sem_temp.add(str(sem)+'_'+str(categ))
                             except:
                                 pass
                 add_form = []
                 for elem in form:
-                    parse, word_name, entry,sem_ = elem
+                    word_name, categ_, sem_ = elem
                     add_form.append(word_name)
-                    beam_lexicon = beam_lexicon+entry
+                    # entries of the final layer are never looked up, so they are never compiled
+                    if layer < len(one_sent_tokenize) - 1:
+                        beam_lexicon.add_entry(word_name, categ_, sem_)
                     layer_sem.append(sem_)
                 layer_form.append(add_form)
             CYK_form.append(layer_form)
@@ -386,59 +458,65 @@ def create_semantic_repr(semantic_rep):
         false. False here indicates that while a valid parse tree was attainable, the semantics of the
         parse do not make sense though.
 
+        The string is read by a recursive descent parser in a single pass, every application f(a,b) becomes
+        the tuple (f, a, b). Nothing in the string is ever evaluated, so explanation text is safe to parse.
+        Anything other than quoted constants and applications of them (ex: left over lambda variables)
+        makes the semantics invalid.
+
         Arguments:
             semantic_rep (str) :  tree representation of tree from our parse_tokens function
         
         Returns:
             tuple | false : if valid semantically, we output a tuple describing the semantics, else false
     """
-    clauses = re.split(',|(\\()',semantic_rep)
-    delete_index = []
-    for i in range(len(clauses)-1, -1, -1):
-        if clauses[i] == None:
-            delete_index.append(i)
-    for i in delete_index:
-        del clauses[i]
-        
-    # Switch poisition of ( and Word before it
-    switched_semantics = []
-    for i, token in enumerate(clauses):
-        if token=='(':
-            switched_semantics.insert(-1,'(')
-        else:
-            switched_semantics.append(token)
-    
-    # Converting semantic string into a multi-level tuple, ex: (item, tuple) would be a two level tuple
-    # This representation allows for the conversion from semantic representation to labeling function
-    hierarchical_semantics = ""
-    for i, clause in enumerate(switched_semantics):
-        prepped_clause = clause
-        if prepped_clause.startswith("\""):
-            prepped_clause = prepare_token_for_rule_addition(prepped_clause, reverse=True)
-            if prepped_clause.endswith(")"):
-                posi = len(prepped_clause)-1
-                while prepped_clause[posi]==")":
-                    posi-=1
-                assert prepped_clause[posi]=="\""
-            else:
-                posi = len(prepped_clause)-1
-                assert prepped_clause[posi] == "\""
-            prepped_clause = prepped_clause[0] + \
-                             prepped_clause[1:posi].replace('\'','\\\'') + \
-                             prepped_clause[posi:]
-
-        if switched_semantics[i-1] != "(" and len(hierarchical_semantics):
-            hierarchical_semantics += ","
-
-        hierarchical_semantics += prepped_clause
-    # if the ordering of the semantics in this semantic representation is acceptable per the functions
-    # the semantics map to, then we will be able to create the desired multi-label tuple
-    # else we return False
     try:
-        hierarchical_tuple = ('.root', eval(hierarchical_semantics))
-        return hierarchical_tuple
-    except:
+        hierarchical_semantics, end = _parse_semantic_term(semantic_rep, 0)
+    except (ValueError, RecursionError):
         return False
+    if end != len(semantic_rep):
+        return False
+    
+    return ('.root', hierarchical_semantics)
+
+def _parse_semantic_term(semantic_rep, start):
+    """
+        Parses the term (quoted constant, or application of one) starting at index start of semantic_rep
+
+        Returns:
+            str|tuple : the term, a tuple if it is an application
+            int       : index right after the term
+        
+        Raises:
+            ValueError : if no valid term starts at start
+    """
+    quote = semantic_rep[start:start+1]
+    if quote not in ("'", "\""):
+        raise ValueError("Expected a quoted constant at position " + str(start))
+    end = semantic_rep.find(quote, start + 1)
+    if end == -1:
+        raise ValueError("Unterminated constant at position " + str(start))
+    term = semantic_rep[start+1:end]
+    if quote == "\"":
+        # words from the explanation, normalized before being added to the grammar
+        term = prepare_token_for_rule_addition(term, reverse=True)
+    position = end + 1
+
+    if semantic_rep.startswith("(", position):
+        application = [term]
+        position += 1
+        while True:
+            argument, position = _parse_semantic_term(semantic_rep, position)
+            application.append(argument)
+            if semantic_rep.startswith(",", position):
+                position += 1
+            elif semantic_rep.startswith(")", position):
+                position += 1
+                break
+            else:
+                raise ValueError("Expected , or ) at position " + str(position))
+        term = tuple(application)
+    
+    return term, position
 
 def _detect_semantic_token(semantic_repr, token):
     """ Exists solely for documentation purposes """
@@ -523,6 +601,67 @@ def check_clauses_in_parse_filter(semantic_counts):
     
     return semantic_counts
 
+def _and_args(semantic_repr):
+    if isinstance(semantic_repr, tuple) and len(semantic_repr) == 3 and semantic_repr[0] == '@And':
+        return _and_args(semantic_repr[1]) + _and_args(semantic_repr[2])
+    return [semantic_repr]
+
+def _and_chain(args):
+    if len(args) == 1:
+        return args[0]
+    return ('@And', args[0], _and_chain(args[1:]))
+
+def _canonical_semantic_repr(semantic_repr, context=None):
+    if not isinstance(semantic_repr, tuple) or len(semantic_repr) == 0:
+        return semantic_repr
+    op = semantic_repr[0]
+    if op == '@Word' and len(semantic_repr) == 2:
+        return _canonical_semantic_repr(semantic_repr[1], context)
+    if op == '@And' and len(semantic_repr) == 3:
+        args = []
+        for arg in _and_args(semantic_repr):
+            arg = _canonical_semantic_repr(arg, context)
+            if context == 'predicates' and isinstance(arg, tuple) and len(arg) == 2 and arg[0] == '.root':
+                # a .root applies all of its predicates, the same as adding them to this one
+                arg = arg[1]
+            args.extend(_and_args(arg))
+        # words checked one at a time, unless a NER type makes @Is check the whole tuple as a Selection
+        if context in ['predicates', 'functions'] or \
+           (context == 'words' and all(isinstance(arg, str) and arg not in constants.NER_TERMINAL_TO_EXECUTION_TUPLE
+                                       and arg != 'NER' for arg in args)):
+            args = sorted(args, key=repr)
+        return _and_chain(args)
+    if op == '.root' and len(semantic_repr) == 2:
+        xs = _canonical_semantic_repr(semantic_repr[1], 'predicates')
+        if isinstance(xs, tuple) and len(xs) == 2 and xs[0] == '.root':
+            return xs
+        return ('.root', xs)
+    if op == '@Is' and len(semantic_repr) == 3:
+        return ('@Is', _canonical_semantic_repr(semantic_repr[1], 'words'), _canonical_semantic_repr(semantic_repr[2], 'functions'))
+    if op in ['@Left', '@Right'] and len(semantic_repr) == 3:
+        return (op, _canonical_semantic_repr(semantic_repr[1]), _canonical_semantic_repr(semantic_repr[2], 'words'))
+    return (op,) + tuple(_canonical_semantic_repr(arg) for arg in semantic_repr[1:])
+
+def canonical_semantic_repr(semantic_repr):
+    """
+        Rewrites a semantic representation into a canonical form, so parses that only differ in ways that don't
+        change what their labeling functions do get the same key:
+            - ('@Word', x) is replaced by x
+            - a '.root' directly in a '.root', or in the @And of its predicates, is inlined
+            - chains of @And (which just concatenates its args) are flattened and rebuilt right-nested
+            - the args of @And chains whose parts are all applied (predicates of a '.root', functions of an @Is,
+              and words @Is, @Left and @Right check one at a time) are sorted
+
+        Args are sorted but not deduplicated, soft labeling functions add up the scores of their parts.
+
+        Arguments:
+            semantic_repr (tuple) : hierarchical tuple representation
+        
+        Returns:
+            tuple : canonical semantic representation
+    """
+    return _canonical_semantic_repr(semantic_repr)
+
 def create_labeling_function(semantic_repr, level=0):
     """
         Creates a labeling function (lambda function) from a hierarchical tuple representation
@@ -549,11 +688,115 @@ def create_labeling_function(semantic_repr, level=0):
     except:
         return False
 
+def create_vectorized_labeling_function(semantic_repr, level=0):
+    """
+        Vectorized version of create_labeling_function, the labeling function takes in a PhraseCorpus
+        and evaluates whether it applies to each Phrase in it.
+        Arguments:
+            semantic_repr (tuple) : hierarchical tuple representation
+        
+        Returns:
+            function | false : if a function is creatable via the tuple, it is created, else false
+    """
+    try:
+        if isinstance(semantic_repr, tuple):
+            op = constants.VECTORIZED_MATCHING_OPS[semantic_repr[0]]
+            args = [create_vectorized_labeling_function(arg, level=level+1) for arg in semantic_repr[1:]]
+            if False in args:
+                return False
+            return op(*args) if args else op
+        else:
+            if semantic_repr in constants.NER_TERMINAL_TO_EXECUTION_TUPLE:
+                return constants.NER_TERMINAL_TO_EXECUTION_TUPLE[semantic_repr]
+            else:
+                return semantic_repr
+    except:
+        return False
+
+def _labeling_function_fires(labeling_function, phrase):
+    try:
+        return bool(labeling_function(phrase))
+    except:
+        return False
+
+def _labeling_function_executes(labeling_function, phrase):
+    try:
+        labeling_function(phrase)
+        return True
+    except:
+        return False
+
+def _apply_labeling_function(labeling_function, vectorized_function, corpus):
+    if vectorized_function:
+        try:
+            return corpus.truth(vectorized_function(corpus))
+        except util_classes.NotVectorized:
+            pass
+        except Exception:
+            # vectorized functions raise the same errors as per-Phrase ones for arguments that can't be executed
+            # (ex: a word where a predicate is expected), such a function doesn't fire on any sentence. If the
+            # per-Phrase function runs on some sentence, the error is a bug in the vectorized function.
+            if any(_labeling_function_executes(labeling_function, phrase) for phrase in corpus.phrases):
+                raise
+            return np.zeros(len(corpus), dtype=bool)
+    return np.array([_labeling_function_fires(labeling_function, phrase) for phrase in corpus.phrases], dtype=bool)
+
+def apply_labeling_function(labeling_function, semantic_repr, corpus, index=None, rows=None):
+    """
+        Evaluates one strict labeling function on every Phrase of a PhraseCorpus (see apply_labeling_functions)
+        Arguments:
+            labeling_function (function) : strict labeling function
+            semantic_repr        (tuple) : semantic_repr the function was created from, None if unknown
+            corpus        (PhraseCorpus) : phrases to label
+            index           (TokenIndex) : if given, the function is only evaluated on the phrases that contain
+                                           the phrases its semantic_repr requires
+            rows              (np.array) : if given, sorted indices of the only phrases to evaluate the function
+                                           on, it doesn't apply to the rest
+        
+        Returns:
+            np.array : one boolean per phrase, whether the function applies to it
+    """
+    vectorized_function = False
+    candidates = rows
+    if semantic_repr is not None:
+        vectorized_function = create_vectorized_labeling_function(semantic_repr)
+        if index is not None:
+            required = index.candidates(token_index.required_patterns(semantic_repr))
+            if required is not None:
+                candidates = required if rows is None else np.intersect1d(rows, required, assume_unique=True)
+    if candidates is None:
+        return _apply_labeling_function(labeling_function, vectorized_function, corpus)
+    fired = np.zeros(len(corpus), dtype=bool)
+    if len(candidates):
+        fired[candidates] = _apply_labeling_function(labeling_function, vectorized_function, corpus.subset(candidates))
+    return fired
+
+def apply_labeling_functions(labeling_functions, semantic_reps, corpus, index=None):
+    """
+        Evaluates strict labeling functions on every Phrase of a PhraseCorpus. Functions whose semantic_repr
+        can be vectorized run once over the whole corpus, the rest (and any vectorized function that raises)
+        run Phrase by Phrase.
+        Arguments:
+            labeling_functions (arr) : strict labeling functions
+            semantic_reps      (arr) : semantic_repr each function was created from, None if unknown
+            corpus  (PhraseCorpus) : phrases to label
+            index     (TokenIndex) : if given, functions are only evaluated on the phrases that contain
+                                     the phrases their semantic_repr requires (see token_index.required_patterns)
+        
+        Returns:
+            np.array : boolean matrix, rows - labeling functions, columns - phrases. A function that
+                       raises an exception on a phrase doesn't apply to it.
+    """
+    matrix = np.zeros((len(labeling_functions), len(corpus)), dtype=bool)
+    for i, (labeling_function, semantic_repr) in enumerate(zip(labeling_functions, semantic_reps)):
+        matrix[i] = apply_labeling_function(labeling_function, semantic_repr, corpus, index)
+    return matrix
+
 def create_soft_labeling_function(semantic_repr, level=0):
     """
         Creates a labeling function (lambda function) from a hierarchical tuple representation
-        of the semantics of a parse tree. The labeling function takes in a Phrase object and then
-        evaluates whether the labeling function applies to this Phrase object.
+        of the semantics of a parse tree. The labeling function takes in a SoftBatchContext
+        (soft_grammar_functions.py) and then scores how well the labeling function applies to each phrase of the batch.
         Arguments:
             semantic_repr (tuple) : hierarchical tuple representation
         
@@ -0,0 +1,163 @@
+"""
+    Vectorized versions of the functions in strict_grammar_functions.
+
+    Each function takes a PhraseCorpus (c) instead of a single Phrase and returns one boolean per sentence
+    (np.array) instead of a single boolean. Everything else, including the order in which arguments are
+    checked and the errors raised for arguments that can't be executed, mirrors the per-Phrase version, so
+    a labeling function built from these agrees with the strict labeling function on every sentence.
+
+    Cases that aren't vectorized (ex: counting characters instead of tokens) raise util_classes.NotVectorized,
+    callers then fall back to the per-Phrase labeling function.
+"""
+import numpy as np
+from CCG_new.strict_grammar_functions import compare, Selection
+from CCG_new.util_classes import NotVectorized
+
+def _all(bool_list, c):
+    result = np.ones(len(c), dtype=bool)
+    for value in bool_list:
+        result &= c.truth(value)
+    return result
+
+def _word_patterns(w, c):
+    """
+        The lowercased words of w for each sentence, ArgX and ArgY stand for the SUBJ and OBJ word of the
+        sentence, so sentences are grouped by that word
+
+        Returns:
+            arr : (rows, pattern) tuples, rows - sentences the pattern applies to
+    """
+    if w=='ArgY':
+        return [(rows, word.lower().split()) for word, rows in c.word_groups('Y')]
+    elif w=='ArgX':
+        return [(rows, word.lower().split()) for word, rows in c.word_groups('X')]
+    return [(slice(None), w.lower().split())]
+
+def _count(patterns, start, stop, c):
+    counts = np.zeros(len(c), dtype=np.int64)
+    for rows, pattern in patterns:
+        counts[rows] = c.count_sublist(pattern, start[rows], stop[rows], rows)
+    return counts
+
+#function for $Is
+def IsFunc(ws,ps,c):
+    if isinstance(ps,tuple):
+        bool_list  = []
+        for p in ps:
+            if isinstance(ws, tuple):
+                if ws[0] in Selection:
+                    bool_list.append(p(ws)(c))
+                else:
+                    bool_list.append(_all([p(w)(c) for w in ws], c))
+            else:
+                bool_list.append(p(ws)(c))
+        return _all(bool_list, c)
+
+    if isinstance(ws,tuple):
+        if ws[0] in Selection:
+            return ps(ws)(c)
+        else:
+            return _all([ps(w)(c) for w in ws], c)
+    else:
+        return ps(ws)(c)
+
+#function for @Left and @Right
+def at_POSI(POSI,ws,arg,c,option=None):
+    if isinstance(ws,tuple):
+        if ws[0] in Selection:
+            start, stop, _ = c.get_other_posi(POSI,arg[-1])
+            return c.contains(ws[0], ws[1], start, stop)
+        else:
+            return _all([at_POSI_0(POSI,arg,w,c,option) for w in ws], c)
+    else:
+        return at_POSI_0(POSI,arg,ws,c,option)
+
+#function for @Left0 and @Right0
+def at_POSI_0(POSI,arg,w,c,option=None):
+    if arg not in ['ArgX','ArgY']:
+        w,arg = arg,w
+        if POSI == 'Left':
+            POSI = 'Right'
+        elif POSI == 'Right':
+            POSI = 'Left'
+
+    if isinstance(w,tuple) and w[0] not in Selection:
+        return _all([at_POSI_0(POSI,arg,ww,c,option) for ww in w], c)
+
+    if option==None:
+        option = {'attr': 'word', 'range': -1, 'numAppear':1,'cmp':'nlt','onlyCount':False}
+    if isinstance(w,tuple):
+        start, stop, _ = c.get_other_posi(POSI, arg[-1])
+        return c.contains(w[0], w[1], start, stop)
+
+    patterns = _word_patterns(w, c)
+    if option == 'Direct':
+        start, stop, _ = c.get_other_posi(POSI, arg[-1])
+        if POSI not in ['Left', 'Right']:
+            raise ValueError
+        result = np.zeros(len(c), dtype=bool)
+        for rows, pattern in patterns:
+            st, ed = _limit_range(POSI, start[rows], stop[rows], None, len(pattern), c)
+            result[rows] = (ed - st == len(pattern)) & (c.count_sublist(pattern, st, ed, rows) > 0)
+        return result
+    if option['range']==-1:
+        start, stop, _ = c.get_other_posi(POSI, arg[-1])
+    else:
+        if option['attr'] != 'tokens':
+            raise NotVectorized("range windows are only vectorized over tokens")
+        start, stop, count_posi = c.get_other_posi(POSI, arg[-1])
+        start, stop = _limit_range(POSI, start, stop, count_posi, option['range'], c)
+    if option['onlyCount']:
+        return compare[option['cmp']](stop - start,option['numAppear'])
+    else:
+        return compare[option['cmp']](_count(patterns, start, stop, c),option['numAppear'])
+
+def _limit_range(POSI, start, stop, count_posi, range_, c):
+    """
+        Narrows a Left/Right window to the range_ tokens closest to the argument, or a Range window to the
+        tokens within range_ of the argument, the way at_POSI_0 slices info
+    """
+    length = stop - start
+    if POSI == 'Left':
+        st, ed = c.slice_window(np.maximum(0, length - range_), length, length)
+    elif POSI == 'Right':
+        st, ed = c.slice_window(np.zeros_like(length), np.minimum(length - 1, range_ - 1) + 1, length)
+    else:
+        st, ed = c.slice_window(np.maximum(0, count_posi - range_), np.minimum(length, count_posi + 1 + range_) + 1, length)
+    return start + st, start + ed
+
+
+#function for @Between
+
+def at_between(w,c,option=None,a=None):
+    patterns = None
+    if w=='ArgY' or w=='ArgX':
+        patterns = _word_patterns(w, c)
+    if option==None:
+        option = {'attr': 'word', 'numAppear':1,'cmp':'nlt','onlyCount':False}
+    start, stop = c.get_mid()
+    if isinstance(w,tuple):
+        return c.contains(w[0], w[1], start, stop)
+    else:
+        if patterns is None:
+            patterns = _word_patterns(w, c)
+        if option['onlyCount']:
+            return compare[option['cmp']](stop - start,option['numAppear'])
+        else:
+            return compare[option['cmp']](_count(patterns, start, stop, c),option['numAppear'])
+
+
+#function for @In0
+def at_In0(arg,w,c):
+    assert arg=='Sentence'
+    if isinstance(w,tuple):
+        return w in c.ner
+    else:
+        w = w.lower().split()
+        return c.count_sublist(w, np.zeros_like(c.lengths), c.lengths) > 0
+
+def at_WordCount(nounNum,nouny,F,c):
+    if isinstance(nouny,tuple):
+        return _all([F(noun, option={'attr': 'word', 'range': -1, 'numAppear': 1, 'cmp': 'nlt', 'onlyCount': False})(c) for noun in nouny], c) & c.truth(F(nouny[0],option={'attr': 'tokens','range': -1,'numAppear':sum([len(noun.split()) for noun in nouny]),'cmp': 'eq','onlyCount': True})(c))
+    else:
+        return c.truth(F(nouny,option={'attr':'word','range':-1,'numAppear':1,'cmp':'nlt','onlyCount':False})(c)) & c.truth(F(nouny,option={'attr':'tokens','range':-1,'numAppear':len(nouny.split()),'cmp':'eq','onlyCount':True})(c))
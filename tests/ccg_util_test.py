@@ -1,11 +1,29 @@
 import spacy
 import sys
+import hashlib
+import numpy as np
 import pickle
 import json
+import torch
+import pytest
 sys.path.append("../")
 sys.path.append("../CCG_new/")
 from CCG_new import utils
+from CCG_new import constants
+from CCG_new import util_classes
+from CCG_new import strict_grammar_functions
+from CCG_new import soft_grammar_functions
+from CCG_new.compiled_lexicon import CompiledLexicon
+from CCG_new.cyk_engine import CYKEngine, ParseBudget
 from CCG_new.parser import CCGParserTrainer, TrainedCCGParser
+from CCG_new.phrase_cache import PhraseCache
+from CCG_new import token_index
+from CCG_new.token_index import TokenIndex
+from CCG_new.firing_matrix import FiringMatrix, approximate_filter
+from CCG_new.semantic_dag import SemanticDAG, conjuncts
+from CCG_new.labeling_function_compiler import CompiledLabelingFunction, compile_labeling_function
+from CCG_new.labeling_functions import LabelingFunction, SoftLabelingFunction
+from CCG_new.soft_labeling_function_compiler import compile_soft_labeling_functions, soft_labeling_function_atoms
 
 nlp = spacy.load("en_core_web_sm")
 
@@ -185,6 +203,44 @@ def test_generate_phrase():
     assert phrase.subj_posi == phrase_subj_posi
     assert phrase.obj_posi == phrase_obj_posi
 
+def test_generate_phrases():
+    sentences = [
+        "His wife, OBJ-PERSON, often accompanied him on SUBJ-PERSON SUBJ-PERSON expeditions, as she did in 1947, when she became the first woman to climb Mount McKinley",
+        "SUBJ-PERSON's mother OBJ-PERSON was a singer in the dance group Soul II Soul, which had hits in the 1980s and 1990s.",
+        "GAMEDAY VS BUFORD TODAY AT 5:30 AT HOME ! ! ! NEVER BEEN SO EXCITED #revenge"
+    ]
+    phrases = utils.generate_phrases(sentences, nlp, batch_size=2)
+    assert len(phrases) == len(sentences)
+    for sentence, phrase in zip(sentences, phrases):
+        expected_phrase = utils.generate_phrase(sentence, nlp)
+        assert phrase.tokens == expected_phrase.tokens
+        assert phrase.ners == expected_phrase.ners
+        assert phrase.subj_posi == expected_phrase.subj_posi
+        assert phrase.obj_posi == expected_phrase.obj_posi
+
+def test_generate_phrases_phrase_cache(tmp_path):
+    sentences = [
+        "SUBJ-PERSON's mother OBJ-PERSON was a singer in the dance group Soul II Soul, which had hits in the 1980s and 1990s.",
+        "GAMEDAY VS BUFORD TODAY AT 5:30 AT HOME ! ! ! NEVER BEEN SO EXCITED #revenge",
+        "SUBJ-PERSON's mother OBJ-PERSON was a singer in the dance group Soul II Soul, which had hits in the 1980s and 1990s."
+    ]
+    cache_path = str(tmp_path / "phrase_cache.db")
+    phrase_cache = PhraseCache(cache_path)
+    cold_phrases = utils.generate_phrases(sentences, nlp, phrase_cache=phrase_cache)
+    assert phrase_cache.hits == 0
+    phrase_cache.close()
+
+    phrase_cache = PhraseCache(cache_path)
+    warm_phrases = utils.generate_phrases(sentences, nlp, phrase_cache=phrase_cache)
+    assert phrase_cache.hits == len(sentences)
+    assert utils.generate_phrase(sentences[1], nlp, phrase_cache=phrase_cache).tokens == cold_phrases[1].tokens
+    for cold_phrase, warm_phrase in zip(cold_phrases, warm_phrases):
+        assert warm_phrase.tokens == cold_phrase.tokens
+        assert warm_phrase.ners == cold_phrase.ners
+        assert warm_phrase.subj_posi == cold_phrase.subj_posi
+        assert warm_phrase.obj_posi == cold_phrase.obj_posi
+        assert warm_phrase.sentence == cold_phrase.sentence
+
 def test_parse_tokens_re():
     re_ccg_trainer = CCGParserTrainer(task="re", explanation_file="data/tacred_test_explanation_data.json",
                                       unlabeled_data_file="data/tacred_test_unlabeled_data.json")
@@ -283,6 +339,127 @@ def test_parse_tokens_ec():
     for i, c_parse in enumerate(correct_parses):
         assert c_parse in parses[i]
 
+def test_parse_tokens_compiled_lexicon(tmp_path):
+    grammar = utils.add_rules_to_grammar(['"PUNCT5sSPACEdaughter"', '"3"'], constants.RAW_GRAMMAR)
+    tokenization = ['$The', '$Word', '"PUNCT5sSPACEdaughter"', '$Link', '$ArgX', '$And', '$ArgY', '$And', '$There', '$Is', '$AtMost', '"3"', '$Word', '$Between', '$ArgX', '$And', '$ArgY']
+
+    # output of the original parse_tokens, which re-parsed the grammar string with NLTK's lexicon.fromstring
+    # and a CCGChartParser for every layer
+    nltk_parses = [
+        '\'@And\'(\'@Is\'(\'@And\'(\'There\',\'ArgY\'),\'@AtMost\'(\'@between\'(\'@And\'(\'ArgY\',\'ArgX\')),\'@Num\'("3",\'tokens\'))),\'@Is\'(\'@Word\'("PUNCT5sSPACEdaughter"),\'@between\'(\'ArgX\')))',
+        '\'@And\'(\'@Is\'(\'There\',\'@AtMost\'(\'@between\'(\'@And\'(\'ArgY\',\'ArgX\')),\'@Num\'("3",\'tokens\'))),\'@Is\'(\'@Word\'("PUNCT5sSPACEdaughter"),\'@between\'(\'@And\'(\'ArgY\',\'ArgX\'))))'
+    ]
+
+    compiled = CompiledLexicon(grammar)
+    parses = utils.parse_tokens(tokenization, compiled)
+    assert parses == nltk_parses
+    assert utils.parse_tokens(tokenization, grammar) == nltk_parses
+    assert len(compiled.compiled_entries) > 0
+
+    # parsing doesn't leak layer entries into the compiled lexicon
+    assert compiled.categories('$Layer1_Horizon0_0') == []
+
+    lexicon_path = str(tmp_path / "lexicon.p")
+    saved = CompiledLexicon.load_or_compile(grammar, lexicon_path)
+    loaded = CompiledLexicon.load_or_compile(grammar, lexicon_path)
+    assert loaded.signature == saved.signature
+    assert utils.parse_tokens(tokenization, loaded) == parses
+
+    other = CompiledLexicon.load_or_compile(constants.RAW_GRAMMAR, lexicon_path)
+    assert other.signature != saved.signature
+
+def test_lexicon_scope_add_rules():
+    tokens = ['"3"', '"wasSPACEborn"']
+    tokenization = ['$ArgX', '$And', '$ArgY', '$SandWich', '$The', '$Word', '"wasSPACEborn"', '$And', '$There', '$Is', '$AtMost', '"3"', '$Word', '$Between', '$ArgX', '$And', '$ArgY']
+    grammar = utils.add_rules_to_grammar(tokens, constants.RAW_GRAMMAR)
+
+    base_lexicon = CompiledLexicon(constants.RAW_GRAMMAR)
+    explanation_lexicon = base_lexicon.scope()
+    explanation_lexicon.add_rules(utils.add_rules_to_grammar(tokens, ""))
+    for token in tokens:
+        assert len(base_lexicon.categories(token)) == 0
+        assert [str(entry) for entry in explanation_lexicon.categories(token)] == [str(entry) for entry in CompiledLexicon(grammar).categories(token)]
+
+    engine = CYKEngine(base_lexicon)
+    assert engine.parse(tokenization) == []
+    assert engine.parse(tokenization, lexicon=explanation_lexicon) == utils.parse_tokens(tokenization, grammar)
+    assert utils.parse_tokens(tokenization, explanation_lexicon) == utils.parse_tokens(tokenization, grammar)
+
+def test_cyk_engine_parse():
+    grammar = utils.add_rules_to_grammar(['"PUNCT5sSPACEdaughter"', '"wasSPACEborn"', '"3"', '"5"'], constants.RAW_GRAMMAR)
+    tokenizations = [
+        ['$The', '$Word', '"PUNCT5sSPACEdaughter"', '$Link', '$ArgX', '$And', '$ArgY', '$And', '$There', '$Is', '$AtMost', '"3"', '$Word', '$Between', '$ArgX', '$And', '$ArgY'],
+        ['$ArgX', '$And', '$ArgY', '$SandWich', '$The', '$Word', '"wasSPACEborn"', '$And', '$There', '$Is', '$AtMost', '"3"', '$Word', '$Between', '$ArgX', '$And', '$ArgY'],
+        ['$There', '$Is', '$AtMost', '"5"', '$Word', '$Between', '$ArgX', '$And', '$ArgY'],
+        ['$The', '$Sentence', '$Contains', '$The', '$Word', '"wasSPACEborn"'],
+        ['$ArgX'],
+        ['$Unknown', '$ArgX'],
+        ['$The', '$Sentence', '$Contains', '$The', '$Word', [], '"wasSPACEborn"']
+    ]
+
+    engine = CYKEngine(CompiledLexicon(grammar))
+    for tokenization in tokenizations:
+        assert engine.parse(tokenization) == utils.parse_tokens(tokenization, grammar)
+
+    # combinations are cached, so parsing again gives the same result
+    assert engine.parse(tokenizations[0]) == utils.parse_tokens(tokenizations[0], grammar)
+
+def test_cyk_engine_parse_lattice():
+    grammar = utils.add_rules_to_grammar(['"wife"', '"of"', '"3"'], constants.RAW_GRAMMAR)
+    token_lattice = [['$The'], ['$Word'], ['"wife"'], ['$Is'], ['$Direct', '$Right'], ['$Left'], ['$ArgY'], ['$And'],
+                     ['$The'], ['$Word'], ['"of"'], ['$Is'], ['$AtMost', '$Within'], ['"3"'], ['$Word'], ['$Of'], ['$ArgX']]
+    tokenizations = [[]]
+    for terminals in token_lattice:
+        tokenizations = [tokenization + [terminal] for tokenization in tokenizations for terminal in terminals]
+
+    engine = CYKEngine(CompiledLexicon(grammar))
+    expected_counts = {}
+    for tokenization in tokenizations:
+        for parse in utils.parse_tokens(tokenization, grammar):
+            expected_counts[parse] = expected_counts.get(parse, 0) + 1
+
+    lattice_counts = {}
+    for parse, count in engine.parse_lattice(token_lattice):
+        lattice_counts[parse] = lattice_counts.get(parse, 0) + count
+
+    assert len(expected_counts) > 0
+    assert lattice_counts == expected_counts
+
+    assert engine.parse_lattice([['$ArgX']]) == []
+
+    # "," tokenizes to ['$Separator', []], the reading through [] has no parses
+    grammar = utils.add_rules_to_grammar(['"born"', '"in"'], constants.RAW_GRAMMAR)
+    tokenization = ['$The', '$Word', '"born"', '$Separator', '"in"', '$Is', '$Between', '$ArgX', '$And', '$ArgY']
+    token_lattice = [[token] for token in tokenization]
+    token_lattice[3].append([])
+    engine = CYKEngine(CompiledLexicon(grammar))
+    expected_counts = {}
+    for parse in utils.parse_tokens(tokenization, grammar):
+        expected_counts[parse] = expected_counts.get(parse, 0) + 1
+    assert len(expected_counts) > 0
+    assert dict(engine.parse_lattice(token_lattice)) == expected_counts
+
+def test_cyk_engine_parse_budget():
+    grammar = utils.add_rules_to_grammar(['"PUNCT5sSPACEdaughter"', '"3"'], constants.RAW_GRAMMAR)
+    tokenization = ['$The', '$Word', '"PUNCT5sSPACEdaughter"', '$Link', '$ArgX', '$And', '$ArgY', '$And', '$There', '$Is', '$AtMost', '"3"', '$Word', '$Between', '$ArgX', '$And', '$ArgY']
+    engine = CYKEngine(CompiledLexicon(grammar))
+    full_parse = engine.parse(tokenization)
+
+    limits = ParseBudget(max_cell_entries=1000).start()
+    assert engine.parse(tokenization, limits) == full_parse
+    assert limits.cutoffs == {}
+
+    limits = ParseBudget(max_cell_entries=2).start()
+    beam_parse = engine.parse(tokenization, limits)
+    assert limits.cutoffs["max_cell_entries"] > 0
+    assert set(beam_parse).issubset(set(full_parse))
+
+    # once the time budget is spent cells are cut down to the beam width
+    limits = ParseBudget(time_budget=0.0, beam_width=1).start()
+    engine.parse(tokenization, limits)
+    assert limits.cutoffs["time_budget"] > 0
+    assert "max_cell_entries" not in limits.cutoffs
+
 def test_create_semantic_repr():
     parsed_rep = '\'@And\'(\'@Is\'(\'There\',\'@AtMost\'(\'@between\'(\'@And\'(\'ArgY\',\'ArgX\')),\'@Num\'("3",\'tokens\'))),\'@Is\'(\'@Word\'("PUNCT5sSPACEdaughter"),\'@between\'(\'@And\'(\'ArgY\',\'ArgX\'))))'
     
@@ -297,6 +474,15 @@ def test_create_semantic_repr():
 
     assert semantic_rep == utils.create_semantic_repr(parsed_rep)
 
+    assert ('.root', 'ArgX') == utils.create_semantic_repr('\'ArgX\'')
+    # un-reduced lambda terms and malformed strings aren't valid semantics
+    assert utils.create_semantic_repr('\\x.\'@Num\'("3",x)') == False
+    assert utils.create_semantic_repr('\'@Word\'("born"') == False
+    assert utils.create_semantic_repr('\'@Word\'("born"))') == False
+    # quoted text is never evaluated
+    untrusted_rep = '\'@Word\'("" + __import__(PUNCT6osPUNCT6).getcwd() + "")'
+    assert utils.create_semantic_repr(untrusted_rep) == False
+
 def test_check_clauses_in_parse_filter():
     semantic_counts = {
         ('.root',
@@ -500,4 +686,417 @@ def test_create_labeling_function_re():
     ]
 
     for rep in semantic_reps:
-        assert utils.create_labeling_function(rep) != False
\ No newline at end of file
+        assert utils.create_labeling_function(rep) != False
+def test_apply_labeling_functions():
+    semantic_reps = [
+        ('.root',
+            ('@And',
+            ('@Is',
+                'There',
+                ('@AtMost',
+                ('@between', ('@And', 'ArgY', 'ArgX')),
+                ('@Num', '3', 'tokens'))),
+            ('@Is', ('@Word', 'was born'), ('@between', ('@And', 'ArgY', 'ArgX'))))),
+        ('.root', ('@Is', 'wife', ('@Left0', 'ArgX'))),
+        ('.root', ('@Is', 'born', ('@Direct', ('@Right0', 'ArgY')))),
+        ('.root', ('@Is', '@PER', ('@Right0', 'ArgX'))),
+        ('.root', ('@Is', 'was', ('@AtMost', ('@Left0', 'ArgY'), ('@Num', '2', 'tokens')))),
+        ('.root', ('@In1', 'Sentence', 'his wife')),
+        ('.root', ('@In1', 'Sentence', '@PER')), # can't be executed on any phrase, doesn't fire
+        ('.root', ('@Is', 'a', ('@AtMost', ('@Range0', 'ArgY'), ('@Num', '2', 'word')))), # not vectorized
+        ('.root', ('@StartsWith', 'ArgX', ('@And', 's', ('@Left0', 'ArgY')))), # raises on some phrases only
+    ]
+    phrases = [
+        util_classes.Phrase(["his", "wife", "subj", "was", "born", "in", "obj"], ["", "", "", "", "", "", ""], 2, 6),
+        util_classes.Phrase(["subj", "was", "born", "obj", "born"], ["", "", "", "", ""], 0, 3),
+        util_classes.Phrase(["Wife", "subj", "met", "obj", "a", "b"], ["", "", "PERSON", "", "", ""], 1, 3),
+        util_classes.Phrase(["no", "arguments", "here"], ["", "", ""], 6, 6),
+        util_classes.Phrase([], [], 0, 0)
+    ]
+    labeling_functions = [utils.create_labeling_function(rep) for rep in semantic_reps]
+    corpus = util_classes.PhraseCorpus(phrases)
+
+    matrix = utils.apply_labeling_functions(labeling_functions, semantic_reps, corpus)
+    assert matrix.shape == (len(semantic_reps), len(phrases))
+    for i, function in enumerate(labeling_functions):
+        assert list(matrix[i]) == [utils._labeling_function_fires(function, phrase) for phrase in phrases]
+    assert list(matrix[1]) == [True, False, True, False, False]
+    assert list(matrix[2]) == [False, True, False, False, False]
+    assert list(matrix[6]) == [False, False, False, False, False]
+    assert list(matrix[7]) == [False, True, False, False, False]
+    assert list(matrix[8]) == [True, True, True, False, False]
+
+    # without semantic reps every function is evaluated phrase by phrase
+    assert (utils.apply_labeling_functions(labeling_functions, [None] * len(semantic_reps), corpus) == matrix).all()
+
+    # errors of a vectorized function that the per-Phrase function doesn't raise aren't hidden by falling back
+    def broken(c):
+        raise IndexError("bad offset")
+    with pytest.raises(IndexError):
+        utils._apply_labeling_function(labeling_functions[1], broken, corpus)
+    def not_vectorized(c):
+        raise util_classes.NotVectorized("not vectorized")
+    assert list(utils._apply_labeling_function(labeling_functions[1], not_vectorized, corpus)) == list(matrix[1])
+
+def test_phrase_views():
+    phrase = util_classes.Phrase(["The", "Wife", "of", "SUBJ", "met", "OBJ", "Today"], [""] * 7, 3, 5)
+    assert phrase.lower_tokens == ["the", "wife", "of", "subj", "met", "obj", "today"]
+    assert phrase.get_lower_mid() == ["met"]
+    assert phrase.get_lower_other_posi('Left', 'X') == ["the", "wife", "of"]
+    assert phrase.get_lower_other_posi('Right', 'Y') == ["today"]
+    assert phrase.get_lower_other_posi('Range', 'Y') == phrase.lower_tokens
+    assert phrase.get_lower_other_posi('Left', 'X', 'word') == list("the wife of")
+    # views are built once
+    assert phrase.get_mid() is phrase.get_mid()
+    assert phrase.get_lower_other_posi('Left', 'X') is phrase.get_lower_other_posi('Left', 'X')
+
+    phrase.update_tokens_and_ners(["A", "B", "C", "SUBJ", "D", "OBJ", "E"], [""] * 7)
+    assert phrase.get_lower_mid() == ["d"]
+
+    loaded = pickle.loads(pickle.dumps(phrase))
+    assert loaded.tokens == phrase.tokens
+    assert loaded.get_lower_other_posi('Left', 'X') == ["a", "b", "c"]
+
+def test_phrase_count_ngram():
+    phrase = util_classes.Phrase(["The", "wife", "of", "the", "Wife", "of", "SUBJ", "OBJ"], [""] * 8, 6, 7)
+    lower_tokens = phrase.lower_tokens
+    for ngram in [(), ("of",), ("the", "wife"), ("wife", "of", "the"), ("the", "husband")]:
+        for start in range(len(lower_tokens) + 1):
+            for stop in range(start, len(lower_tokens) + 1):
+                expected = strict_grammar_functions.count_sublist(lower_tokens[start:stop], list(ngram))
+                assert phrase.count_ngram(ngram, start, stop) == expected
+    assert phrase.count_ngram(("the", "wife")) == 2
+    assert phrase.get_other_posi_span('Left', 'X') == (0, 6)
+    assert phrase.get_mid_span() == (7, 7)
+
+def test_token_index(tmp_path):
+    phrases = [
+        util_classes.Phrase(["his", "wife", "subj", "was", "born", "in", "obj"], [""] * 7, 2, 6),
+        util_classes.Phrase(["subj", "was", "obj", "born"], [""] * 4, 0, 2),
+        util_classes.Phrase(["Was", "born", "subj", "obj"], [""] * 4, 2, 3),
+        util_classes.Phrase(["subj", "was"], [""] * 2, 0, 1),
+        util_classes.Phrase(["born", "obj", "wife"], [""] * 3, 6, 1)
+    ]
+    corpus = util_classes.PhraseCorpus(phrases)
+    index_path = str(tmp_path / "token_index.npz")
+    index = TokenIndex.load_or_build(corpus, index_path)
+
+    sentence_ids, positions = index.postings("was")
+    assert list(zip(sentence_ids, positions)) == [(0, 3), (1, 1), (2, 0), (3, 1)]
+    # "was" ending sentence 3 is not followed by "born" starting sentence 4
+    assert list(index.pattern_sentences(("was", "born"))) == [0, 2]
+    assert list(index.candidates([("was", "born"), ("wife",)])) == [0]
+    assert index.candidates([]) is None
+    assert TokenIndex.load_or_build(corpus, index_path).words == index.words
+
+    semantic_reps = [
+        ('.root',
+            ('@And',
+            ('@Is',
+                'There',
+                ('@AtMost',
+                ('@between', ('@And', 'ArgY', 'ArgX')),
+                ('@Num', '3', 'tokens'))),
+            ('@Is', ('@Word', 'was born'), ('@between', ('@And', 'ArgY', 'ArgX'))))),
+        ('.root', ('@Is', ('@And', 'wife', 'ArgY'), ('@Left0', 'ArgX'))),
+        ('.root', ('@Is', 'There', ('@AtMost', ('@Left0', 'ArgX'), ('@Num', '3', 'tokens')))),
+    ]
+    assert token_index.required_patterns(semantic_reps[0]) == {("was", "born")}
+    assert token_index.required_patterns(semantic_reps[1]) == {("wife",)}
+    assert token_index.required_patterns(semantic_reps[2]) == set()
+
+    labeling_functions = [utils.create_labeling_function(rep) for rep in semantic_reps]
+    matrix = utils.apply_labeling_functions(labeling_functions, semantic_reps, corpus)
+    assert (utils.apply_labeling_functions(labeling_functions, semantic_reps, corpus, index) == matrix).all()
+
+def test_firing_matrix(tmp_path):
+    phrases = [
+        util_classes.Phrase(["subj", "was", "born", "in", "obj"], ["PERSON", "", "", "", "LOCATION"], 0, 4),
+        util_classes.Phrase(["subj", "was", "born", "in", "obj"], ["PERSON", "", "", "", "DATE"], 0, 4),
+        util_classes.Phrase(["obj", "is", "the", "wife", "of", "subj"], ["PERSON", "", "", "", "", "PERSON"], 5, 0),
+        util_classes.Phrase(["subj", "met", "obj"], ["PERSON", "", "LOCATION"], 0, 2)
+    ]
+    corpus = util_classes.PhraseCorpus(phrases)
+    semantic_reps = [
+        ('.root', ('@Is', ('@Word', 'was born'), ('@between', ('@And', 'ArgY', 'ArgX')))),
+        ('.root', ('@In1', 'Sentence', ('@Word', 'subj'))),
+        ('.root', ('@In1', 'Sentence', ('@Word', 'born'))),
+        ('.root', ('@Is', ('@Word', 'wife'), ('@between', ('@And', 'ArgY', 'ArgX'))))
+    ]
+    ner_types = [("person", "location"), ("person", "location"), None, ("person", "person")]
+    labeling_functions = [utils.create_labeling_function(rep) for rep in semantic_reps]
+    path = str(tmp_path / "firing_matrix.npz")
+    firing_matrix = FiringMatrix.load_or_build(path, labeling_functions, semantic_reps, corpus, ner_types=ner_types)
+
+    assert firing_matrix.matrix.toarray().tolist() == [[True, False, False, False],
+                                                       [True, False, False, True],
+                                                       [False, False, False, False],
+                                                       [False, False, True, False]]
+    assert list(firing_matrix.hit_counts()) == [1, 2, 0, 1]
+    assert list(firing_matrix.count_filter(1, 0.5)) == [0, 1, 3]
+    assert firing_matrix.unique_rows([0, 1, 2, 3]) == [0, 1, 2, 3]
+    assert list(firing_matrix.first_match()) == [0, -1, 3, 1]
+    assert firing_matrix.coverage() == {"sentences" : 4, "covered" : 3, "overlapping" : 1, "coverage" : 0.75, "hits" : 4}
+
+    # re-used from disk, in any order, as long as the corpus and every key match
+    loaded = FiringMatrix.load(path)
+    keys = list(zip(semantic_reps, ner_types))
+    selected = loaded.select([keys[3], keys[0]], corpus)
+    assert selected.matrix.toarray().tolist() == [[False, False, True, False], [True, False, False, False]]
+    assert loaded.select([(semantic_reps[0], ("person", "date"))], corpus) is None
+    assert loaded.select(keys, corpus.subset([0, 1])) is None
+
+    duplicate = FiringMatrix.build(labeling_functions[:1] * 2, semantic_reps[:1] * 2, corpus)
+    assert duplicate.unique_rows() == [0]
+
+    # functions are only called on the sentences of their NER type pair
+    assert list(corpus.ner_type_rows("person", "location")) == [0, 3]
+    called = []
+    def labeling_function(phrase):
+        called.append(phrase)
+        return True
+    bucketed = FiringMatrix.build([labeling_function] * 3, [None] * 3, corpus,
+                                  ner_types=[("person", "location"), ("person", "person"), ("date", "date")])
+    assert bucketed.matrix.toarray().tolist() == [[True, False, False, True], [False, False, True, False], [False] * 4]
+    assert called == [phrases[0], phrases[3], phrases[2]]
+
+def test_firing_matrix_workers():
+    phrases = [util_classes.Phrase(["subj", "was", "born", "in", "obj"][:n] + ["subj", "obj"], [""] * (n + 2), n, n + 1)
+               for n in range(6)] * 3
+    corpus = util_classes.PhraseCorpus(phrases)
+    semantic_reps = [('.root', ('@In1', 'Sentence', ('@Word', word))) for word in ["subj", "was", "born", "in", "obj", "died"]]
+    labeling_functions = [utils.create_labeling_function(rep) for rep in semantic_reps]
+    index = TokenIndex.from_corpus(corpus)
+
+    serial = FiringMatrix.build(labeling_functions, semantic_reps, corpus, index)
+    parallel = FiringMatrix.build(labeling_functions, semantic_reps, corpus, index, workers=2)
+    assert (serial.matrix != parallel.matrix).nnz == 0
+    dense = serial.matrix.toarray()
+    for i in range(len(semantic_reps)):
+        assert serial.row_digest(i) == hashlib.blake2b(np.packbits(dense[i]).tobytes(), digest_size=16).digest()
+    # "subj" and "obj" fire on every sentence
+    assert serial.unique_rows() == [0, 1, 2, 3, 5]
+    # LabelingFunctions without a semantic_repr are sent to the workers as they are
+    objects = FiringMatrix.build([LabelingFunction.create(rep) for rep in semantic_reps], [None] * len(semantic_reps),
+                                 corpus, index, workers=2)
+    assert (serial.matrix != objects.matrix).nnz == 0
+
+def test_approximate_filter():
+    phrases = [util_classes.Phrase(["subj", "was", "born", "in", "obj"][:n % 6] + ["subj", "obj"], [""] * (n % 6 + 2), n % 6, n % 6 + 1)
+               for n in range(300)]
+    corpus = util_classes.PhraseCorpus(phrases)
+    semantic_reps = [('.root', ('@In1', 'Sentence', ('@Word', word))) for word in ["subj", "was", "born", "in", "obj", "died"]]
+    semantic_reps.append(('.root', ('@Is', 'There', ('@AtMost', ('@Left0', 'ArgX'), ('@Num', '2', 'tokens')))))
+    semantic_reps.append(('.root', ('@In1', 'Sentence', ('@Word', 'in obj'))))
+    labeling_functions = [utils.create_labeling_function(rep) for rep in semantic_reps]
+    index = TokenIndex.from_corpus(corpus)
+
+    firing_matrix = FiringMatrix.build(labeling_functions, semantic_reps, corpus, index)
+    for low_end_filter_count, high_end_filter_pct in [(3, 0.2), (3, 0.9), (60, 0.7)]:
+        exact = firing_matrix.unique_rows(firing_matrix.count_filter(low_end_filter_count, high_end_filter_pct))
+        approximate = approximate_filter(labeling_functions, semantic_reps, corpus, low_end_filter_count, high_end_filter_pct,
+                                         index, error_rate=0.001, sample_size=20)
+        assert approximate == exact
+        # no error allowed, every function is decided exactly
+        assert approximate_filter(labeling_functions, semantic_reps, corpus, low_end_filter_count, high_end_filter_pct,
+                                  index, error_rate=0, sample_size=20) == exact
+
+    with pytest.raises(ValueError):
+        approximate_filter(labeling_functions, semantic_reps, corpus, 3, 0.2, index, error_rate=1)
+
+def test_semantic_dag():
+    of_between = ('@Is', ('@Word', 'of'), ('@between', ('@And', 'ArgY', 'ArgX')))
+    semantic_reps = [
+        ('.root', of_between),
+        ('.root', ('@And', of_between, ('@In1', 'Sentence', ('@Word', 'wife')))),
+        ('.root', ('@Is', ('@Word', 'of'), ('@And', ('@between', ('@And', 'ArgY', 'ArgX')), ('@Left0', 'ArgX')))),
+        ('.root', ('@Is', 'There', ('@AtLeast1', '2')))
+    ]
+    assert conjuncts(semantic_reps[1]) == [('.root', of_between), ('.root', ('@In1', 'Sentence', ('@Word', 'wife')))]
+    assert conjuncts(semantic_reps[2]) == [('.root', of_between), ('.root', ('@Is', ('@Word', 'of'), ('@Left0', 'ArgX')))]
+    # not a conjunction of predicates
+    assert conjuncts(semantic_reps[3]) == [semantic_reps[3]]
+
+    dag = SemanticDAG.from_semantic_reps(semantic_reps)
+    assert len(dag.node_reprs) == 4
+    assert dag.add(semantic_reps[1])[0] == dag.add(semantic_reps[2])[0] == dag.nodes[('.root', of_between)]
+    assert dag.node_functions[dag.nodes[('.root', of_between)]] == 3
+
+    phrases = [
+        util_classes.Phrase(["subj", "of", "obj", "wife"], [""] * 4, 0, 2),
+        util_classes.Phrase(["of", "subj", "of", "obj"], [""] * 4, 1, 3),
+        util_classes.Phrase(["subj", "the", "obj"], [""] * 3, 0, 2)
+    ]
+    corpus = util_classes.PhraseCorpus(phrases)
+    labeling_functions = [utils.create_labeling_function(rep) for rep in semantic_reps]
+    firing_matrix = FiringMatrix.build(labeling_functions, semantic_reps, corpus, dag=dag)
+    assert firing_matrix.matrix.toarray().tolist() == [[utils._labeling_function_fires(f, phrase) for phrase in phrases]
+                                                       for f in labeling_functions]
+    # the shared predicate was evaluated once, on every sentence
+    of_between_node = dag.nodes[('.root', of_between)]
+    assert dag.node_evaluations[of_between_node] == 3
+    assert dag.node_hits[of_between_node] == 2
+
+def test_compile_labeling_function():
+    semantic_reps = [
+        ('.root', ('@Is', 'of', ('@between', 'ArgX'))),
+        ('.root', ('@Is', 'the wife', ('@Left0', 'ArgY'))),
+        ('.root', ('@Is', 'There', ('@AtMost', ('@between', 'ArgX'), ('@Num', '1', 'tokens')))),
+        ('.root', ('@Is', 'wife', ('@AtMost', ('@Right0', 'ArgY'), ('@Num', '1', 'tokens')))),
+        ('.root', ('@Is', 'ArgY', ('@Right0', 'ArgX'))),
+        ('.root', ('@Is', 'of', ('@Direct', ('@Right0', 'ArgX')))),
+        ('.root', ('@And', ('@Is', '@PER', ('@Left0', 'ArgX')), ('@StartsWith', 'ArgY', 'o')))
+    ]
+    phrases = [
+        util_classes.Phrase(["subj", "of", "obj", "wife"], [""] * 4, 0, 2),
+        util_classes.Phrase(["John", "the", "Wife", "of", "subj", "of", "obj"], ["PERSON"] + [""] * 6, 4, 6),
+        util_classes.Phrase(["subj", "the", "obj", "subj"], [""] * 4, 0, 2)
+    ]
+    for rep in semantic_reps:
+        labeling_function = utils.create_labeling_function(rep)
+        compiled = compile_labeling_function(rep)
+        unpickled = pickle.loads(pickle.dumps(compiled))
+        for phrase in phrases:
+            expected = utils._labeling_function_fires(labeling_function, phrase)
+            assert utils._labeling_function_fires(compiled, phrase) == expected
+            assert utils._labeling_function_fires(unpickled, phrase) == expected
+
+    # quoted words are split and lowercased at compile time
+    compiled = compile_labeling_function(semantic_reps[1])
+    assert isinstance(compiled, CompiledLabelingFunction)
+    assert "('the', 'wife')" in compiled.source
+    assert compiled(phrases[1])
+    # ArgZ isn't a position of the sentence, the closure is kept
+    assert not isinstance(compile_labeling_function(('.root', ('@Is', 'wife', ('@Left0', 'ArgZ')))), CompiledLabelingFunction)
+    assert compile_labeling_function(('.root', ('@Unknown', 'of'))) == False
+
+def test_labeling_function_objects():
+    semantic_repr = ('.root', ('@Is', ('@Word', 'of'), ('@between', ('@And', 'ArgY', 'ArgX'))))
+    labeling_function = LabelingFunction.create(semantic_repr)
+    assert labeling_function.op == '.root'
+    assert labeling_function.args[0].op == '@Is'
+    assert labeling_function.semantic_repr == semantic_repr
+    assert labeling_function(util_classes.Phrase(["subj", "of", "obj"], [""] * 3, 0, 2))
+    assert not labeling_function(util_classes.Phrase(["subj", "in", "obj"], [""] * 3, 0, 2))
+
+    # equal and hashable by semantic_repr, picklable without dill
+    unpickled = pickle.loads(pickle.dumps(labeling_function))
+    assert unpickled == labeling_function
+    assert {labeling_function : "per:children"}[unpickled] == "per:children"
+    assert unpickled(util_classes.Phrase(["subj", "of", "obj"], [""] * 3, 0, 2))
+    try:
+        labeling_function.op = '@Is'
+        assert False
+    except AttributeError:
+        pass
+
+    soft_labeling_function = SoftLabelingFunction.create(semantic_repr)
+    assert soft_labeling_function != labeling_function
+    assert pickle.loads(pickle.dumps(soft_labeling_function)) == soft_labeling_function
+    assert LabelingFunction.create(('.root', ('@Unknown', 'of'))) == False
+
+def test_canonical_semantic_repr():
+    semantic_repr = ('.root', ('@Is', ('@And', ('@Word', 'of'), ('@Word', 'the')), ('@between', ('@And', 'ArgY', 'ArgX'))))
+    reordered = ('.root', ('@Is', ('@And', 'the', 'of'), ('@between', ('@And', 'ArgY', 'ArgX'))))
+    assert utils.canonical_semantic_repr(semantic_repr) == utils.canonical_semantic_repr(reordered)
+    assert utils.canonical_semantic_repr(semantic_repr) == ('.root', ('@Is', ('@And', 'of', 'the'), ('@between', ('@And', 'ArgY', 'ArgX'))))
+
+    # associative @And chains are flattened, nested roots collapse
+    nested = ('.root', ('@And', ('@In1', 'Sentence', 'b'), ('@And', ('@In1', 'Sentence', 'a'), ('.root', ('@In1', 'Sentence', 'c')))))
+    flat = ('.root', ('@And', ('@In1', 'Sentence', 'c'), ('@And', ('@In1', 'Sentence', 'b'), ('@In1', 'Sentence', 'a'))))
+    assert utils.canonical_semantic_repr(nested) == utils.canonical_semantic_repr(flat)
+    assert utils.canonical_semantic_repr(('.root', ('.root', ('@In1', 'Sentence', 'a')))) == ('.root', ('@In1', 'Sentence', 'a'))
+
+    # words are only reordered when none of them is a NER type
+    ner_words = ('.root', ('@Is', ('@And', 'of', '@PER'), ('@Left0', 'ArgX')))
+    assert utils.canonical_semantic_repr(ner_words) == ner_words
+
+    phrases = [util_classes.Phrase(["subj", "the", "of", "obj"], [""] * 4, 0, 3),
+               util_classes.Phrase(["subj", "of", "obj", "the"], [""] * 4, 0, 2),
+               util_classes.Phrase(["a", "subj", "c", "obj"], ["PERSON", "", "", ""], 1, 3)]
+    for rep in [semantic_repr, nested, ner_words]:
+        labeling_function = utils.create_labeling_function(rep)
+        canonical_function = utils.create_labeling_function(utils.canonical_semantic_repr(rep))
+        assert [utils._labeling_function_fires(labeling_function, phrase) for phrase in phrases] == \
+               [utils._labeling_function_fires(canonical_function, phrase) for phrase in phrases]
+
+    # functions with the same semantic_repr and NER types are evaluated once and share their row
+    corpus = util_classes.PhraseCorpus(phrases)
+    canonical_repr = utils.canonical_semantic_repr(semantic_repr)
+    labeling_functions = [LabelingFunction.create(canonical_repr)] * 3
+    firing_matrix = FiringMatrix.build(labeling_functions, [canonical_repr] * 3, corpus)
+    assert firing_matrix.matrix.toarray().tolist() == [[True, False, False]] * 3
+    assert firing_matrix.unique_rows() == [0]
+
+def test_gather_nd_mask():
+    positions = torch.arange(5)
+    ranges = torch.tensor([[1, 3], [0, 0], [3, 1], [-1, 2], [2, 5], [4, 4]])
+    assert soft_grammar_functions.gather_nd_mask(positions, ranges).tolist() == [[0, 1, 1, 1, 0],
+                                                                                 [1, 0, 0, 0, 0],
+                                                                                 [0, 0, 0, 0, 0],
+                                                                                 [0, 0, 0, 0, 0],
+                                                                                 [0, 0, 0, 0, 0],
+                                                                                 [0, 0, 0, 0, 1]]
+
+def test_soft_batch_context():
+    for i, ner in enumerate(["", "PERSON", "<PAD>"]):
+        soft_grammar_functions.NER_LABEL_SPACE.setdefault(ner, i)
+    person = soft_grammar_functions.NER_LABEL_SPACE["PERSON"]
+    no_ner = soft_grammar_functions.NER_LABEL_SPACE[""]
+    # tokens, ners, subj_posi, obj_posi, subj_ner, obj_ner
+    phrase_input = torch.tensor([[11, 12, 13, 14, 15, person, no_ner, no_ner, no_ner, person, 0, 4, person, person],
+                                 [11, 12, 13, 14, 15, no_ner, no_ner, person, no_ner, no_ner, 3, 1, no_ner, no_ner]])
+    label_mat = torch.zeros(2, 5, 2)
+    label_mat[0, 2, 0] = 1.0 # "wife" between SUBJ and OBJ
+    label_mat[1, 0, 1] = 1.0 # "the" left of OBJ
+    context = soft_grammar_functions.SoftBatchContext(label_mat, {"wife" : 0, "the" : 1}, phrase_input)
+    assert context.seqlen == 5
+    assert context.mid()[1].tolist() == [[0, 1, 1, 1, 0], [0, 0, 1, 0, 0]]
+
+    def scores(semantic_repr):
+        return SoftLabelingFunction.create(semantic_repr)(context).view(-1).tolist()
+
+    assert scores(('.root', ('@Is', 'wife', ('@between', ('@And', 'ArgY', 'ArgX'))))) == [1.0, 0.0]
+    assert scores(('.root', ('@Is', 'the', ('@Left0', 'ArgY')))) == [0.0, 1.0]
+    assert scores(('.root', ('@Is', '@PER', ('@Right0', 'ArgY')))) == [0.0, 1.0]
+    assert scores(('.root', ('@Is', '@PER', ('@Left0', 'ArgX')))) == [0.0, 1.0]
+    assert scores(('.root', ('@Is', 'There', ('@AtMost', ('@between', ('@And', 'ArgY', 'ArgX')), ('@Num', '1', 'tokens'))))) == [0.5, 1.0]
+
+    # span masks are built once per batch and shared across functions
+    window = context.window('Left', 'ArgY', -1)
+    assert context.window('Left', 'ArgY', -1) is window
+    assert window[1].tolist() == [[1, 1, 1, 1, 0], [1, 0, 0, 0, 0]]
+
+def test_compile_soft_labeling_functions():
+    for i, ner in enumerate(["", "PERSON", "<PAD>"]):
+        soft_grammar_functions.NER_LABEL_SPACE.setdefault(ner, i)
+    person = soft_grammar_functions.NER_LABEL_SPACE["PERSON"]
+    no_ner = soft_grammar_functions.NER_LABEL_SPACE[""]
+    phrase_input = torch.tensor([[11, 12, 13, 14, 15, person, no_ner, no_ner, no_ner, person, 0, 4, person, person],
+                                 [11, 12, 13, 14, 15, no_ner, no_ner, person, no_ner, no_ner, 3, 1, no_ner, no_ner],
+                                 [11, 12, 13, 14, 15, no_ner, person, no_ner, no_ner, no_ner, 1, 2, no_ner, no_ner]])
+    label_mat = torch.rand(3, 5, 2)
+    context = soft_grammar_functions.SoftBatchContext(label_mat, {"wife" : 0, "the" : 1}, phrase_input)
+
+    semantic_reps = [
+        ('.root', ('@Is', 'wife', ('@between', ('@And', 'ArgY', 'ArgX')))),
+        ('.root', ('@Is', ('@And', 'the', 'wife'), ('@AtMost', ('@Left0', 'ArgY'), ('@Num', '2', 'tokens')))),
+        ('.root', ('@Is', '@PER', ('@Right0', 'ArgY'))),
+        ('.root', ('@And', ('@Is', 'There', ('@AtMost', ('@between', ('@And', 'ArgY', 'ArgX')), ('@Num', '1', 'tokens'))),
+                           ('@In1', 'Sentence', 'the'))),
+        ('.root', ('@Is', 'ArgX', ('@Direct', ('@Left0', 'ArgY')))),
+        ('.root', ('@Is', ('@And', 'wife', 'the'), ('@WordCount', ('@Num', '2', 'tokens'), ('@And', 'wife', 'the'), ('@between', 'ArgX'))))
+    ]
+    soft_labeling_functions = [SoftLabelingFunction.create(semantic_repr) for semantic_repr in semantic_reps]
+    # closures without a semantic_repr are called as they are
+    soft_labeling_functions.append(utils.create_soft_labeling_function(semantic_reps[0]))
+
+    assert soft_labeling_function_atoms(semantic_reps[0]) == (('keyword', 'wife', ('mid',)),)
+    assert soft_labeling_function_atoms(('.root', ('@Unknown', 'wife'))) is None
+
+    program = compile_soft_labeling_functions(soft_labeling_functions)
+    assert program.fallback == [6]
+    scores = program(context)
+    assert scores.shape == (3, 7)
+    for i, soft_labeling_function in enumerate(soft_labeling_functions):
+        assert torch.allclose(scores[:, i], soft_labeling_function(context).view(-1))
@@ -5,7 +5,11 @@ import json
 import pdb
 import pickle
 from CCG_new.parser import CCGParserTrainer, TrainedCCGParser
+from CCG_new.parse_cache import ParseCache
+from CCG_new.cyk_engine import ParseBudget
 from CCG_new.utils import prepare_token_for_rule_addition, _find_quoted_phrases
+from CCG_new.util_classes import DataPoint, Phrase
+from CCG_new.labeling_functions import LabelingFunction
 
 ec_ccg_trainer = CCGParserTrainer(task="ec", explanation_file="data/ec_test_data.json",
                                   unlabeled_data_file="data/carer_test_data.json")
@@ -200,6 +204,160 @@ def test_parser_build_labeling_rules_re():
         for key in keys:
             assert key in datapoint.labeling_functions
 
+def test_parser_build_labeling_rules_parse_cache_re(tmp_path):
+    explanation_file = re_ccg_trainer.params["explanation_file"]
+    re_ccg_trainer.load_data(explanation_file)
+    parser = re_ccg_trainer.parser
+    parser.create_and_set_grammar()
+    parser.tokenize_explanations()
+    parser.build_labeling_rules()
+    expected_semantic_counts = [datapoint.semantic_counts for datapoint in parser.loaded_data]
+
+    parse_cache = ParseCache(str(tmp_path / "parse_cache"))
+    parser.set_parse_cache(parse_cache)
+    parser.build_labeling_rules()
+    assert parse_cache.hits == 0
+    assert parse_cache.size > 0
+
+    # a new cache over the same directory, every tokenization has been parsed before
+    parse_cache = ParseCache(str(tmp_path / "parse_cache"))
+    parser.set_parse_cache(parse_cache)
+    parser.build_labeling_rules()
+    assert parse_cache.misses == 0
+    assert parse_cache.hits == sum(len(datapoint.tokenized_explanations) for datapoint in parser.loaded_data)
+    for i, datapoint in enumerate(parser.loaded_data):
+        assert datapoint.semantic_counts == expected_semantic_counts[i]
+
+    parse_cache.max_size_bytes = 1
+    parse_cache.evict()
+    assert parse_cache.size == 0
+    parser.set_parse_cache(None)
+
+def test_parser_build_labeling_rules_parse_errors_re(tmp_path):
+    datapoint = DataPoint(Phrase(["subj", "born", "in", "obj"], ["PERSON", "", "", "LOCATION"], 0, 3), "per:origin",
+                          'The words "born" , "in" appear between SUBJ and OBJ')
+    parser = TrainedCCGParser()
+    parser.loaded_data = [datapoint]
+    parser.create_and_set_grammar()
+    parser.tokenize_explanations()
+    parse_cache = ParseCache(str(tmp_path / "parse_cache"))
+    parser.set_parse_cache(parse_cache)
+    engine_parse = parser.cyk_engine.parse
+
+    def failing_parse(error):
+        def parse(*args):
+            raise error
+        return parse
+
+    # semantics NLTK can't compose mean no parses, which aren't cached
+    parser.cyk_engine.parse = failing_parse(AssertionError())
+    parser.build_labeling_rules(verbose=False)
+    assert datapoint.semantic_counts == {}
+    assert parse_cache.size == 0
+
+    # any other error propagates
+    parser.cyk_engine.parse = failing_parse(KeyboardInterrupt())
+    try:
+        parser.build_labeling_rules(verbose=False)
+        assert False
+    except KeyboardInterrupt:
+        pass
+    assert parse_cache.size == 0
+
+    parser.cyk_engine.parse = engine_parse
+    parser.build_labeling_rules(verbose=False)
+    assert len(datapoint.semantic_counts) == 1
+    assert parse_cache.size > 0
+    parser.set_parse_cache(None)
+
+def test_parser_build_labeling_rules_workers_re():
+    explanation_file = re_ccg_trainer.params["explanation_file"]
+    re_ccg_trainer.load_data(explanation_file)
+    parser = re_ccg_trainer.parser
+    parser.create_and_set_grammar()
+    parser.tokenize_explanations()
+    parser.build_labeling_rules()
+    expected_semantic_counts = [datapoint.semantic_counts for datapoint in parser.loaded_data]
+    expected_keys = [list(datapoint.labeling_functions.keys()) for datapoint in parser.loaded_data]
+
+    parser.build_labeling_rules(workers=2)
+    for i, datapoint in enumerate(parser.loaded_data):
+        assert datapoint.semantic_counts == expected_semantic_counts[i]
+        assert list(datapoint.labeling_functions.keys()) == expected_keys[i]
+
+def test_parser_pickle_re():
+    explanation_file = re_ccg_trainer.params["explanation_file"]
+    re_ccg_trainer.load_data(explanation_file)
+    parser = re_ccg_trainer.parser
+    parser.create_and_set_grammar()
+    parser.tokenize_explanations()
+    parser.build_labeling_rules()
+    expected_semantic_counts = [datapoint.semantic_counts for datapoint in parser.loaded_data]
+
+    # the compiled lexicon and CYK engine aren't pickled, they get rebuilt when parsing again
+    unpickled_parser = pickle.loads(pickle.dumps(parser))
+    assert parser.lexicon is not None and parser.cyk_engine is not None
+    assert unpickled_parser.lexicon is None and unpickled_parser.cyk_engine is None
+    assert unpickled_parser.grammar == parser.grammar
+    unpickled_parser.build_labeling_rules()
+    assert unpickled_parser.lexicon is not None and unpickled_parser.cyk_engine is not None
+    for i, datapoint in enumerate(unpickled_parser.loaded_data):
+        assert datapoint.semantic_counts == expected_semantic_counts[i]
+
+def test_parser_build_labeling_rules_parse_budget_re():
+    explanation_file = re_ccg_trainer.params["explanation_file"]
+    re_ccg_trainer.load_data(explanation_file)
+    parser = re_ccg_trainer.parser
+    parser.create_and_set_grammar()
+    parser.tokenize_explanations()
+    parser.build_labeling_rules()
+    expected_semantic_counts = [datapoint.semantic_counts for datapoint in parser.loaded_data]
+
+    parser.set_parse_budget(ParseBudget(max_tokenizations=1, max_cell_entries=1000, time_budget=60.0))
+    parser.tokenize_explanations()
+    parser.build_labeling_rules()
+    for i, datapoint in enumerate(parser.loaded_data):
+        assert datapoint.semantic_counts == expected_semantic_counts[i]
+        assert datapoint.parse_cutoffs == {}
+
+    parser.set_parse_budget(ParseBudget(max_cell_entries=1))
+    parser.build_labeling_rules()
+    for datapoint in parser.loaded_data:
+        assert datapoint.parse_cutoffs["max_cell_entries"] > 0
+    parser.set_parse_budget(None)
+
+def test_parser_build_labeling_rules_separator_re():
+    # "," tokenizes to ['$Separator', []], so one tokenization holds an empty alternative
+    datapoint = DataPoint(Phrase(["subj", "born", "in", "obj"], ["PERSON", "", "", "LOCATION"], 0, 3), "per:origin",
+                          'The words "born" , "in" appear between SUBJ and OBJ')
+    parser = TrainedCCGParser()
+    parser.loaded_data = [datapoint]
+    parser.create_and_set_grammar()
+    parser.tokenize_explanations()
+    assert [] in datapoint.token_lattice[3]
+    for lattice in [False, True]:
+        parser.build_labeling_rules(verbose=False, lattice=lattice)
+        assert datapoint.semantic_counts == {('.root', ('@Is', ('@Word', ('@And', 'in', 'born')), ('@between', ('@And', 'ArgY', 'ArgX')))): 1}
+
+def test_parser_build_labeling_rules_separator_parse_cache_re(tmp_path):
+    datapoint = DataPoint(Phrase(["subj", "born", "in", "obj"], ["PERSON", "", "", "LOCATION"], 0, 3), "per:origin",
+                          'The words "born" , "in" appear between SUBJ and OBJ')
+    parser = TrainedCCGParser()
+    parser.loaded_data = [datapoint]
+    parser.create_and_set_grammar()
+    parser.tokenize_explanations()
+    parser.build_labeling_rules(verbose=False, lattice=True)
+    expected_semantic_counts = datapoint.semantic_counts
+    assert len(expected_semantic_counts) == 1
+
+    parse_cache = ParseCache(str(tmp_path / "parse_cache"))
+    parser.set_parse_cache(parse_cache)
+    for _ in range(2):
+        parser.build_labeling_rules(verbose=False, lattice=True)
+        assert datapoint.semantic_counts == expected_semantic_counts
+    assert parse_cache.hits == 1
+    parser.set_parse_cache(None)
+
 def test_filter_matrix_ec():
     explanation_file = ec_ccg_trainer.params["explanation_file"]
     ec_ccg_trainer.load_data(explanation_file)
@@ -442,3 +600,29 @@ def test_parser_build_soft_labeling_rules_re():
     
     assert set(actual_function_labels) == set(outputted_labels)
     assert set(actual_filtered_explanations) == set(list(parser.filtered_raw_explanations.values()))
+
+def test_parser_shared_labeling_function_labels():
+    # two explanations with different labels and NER types parse to the same labeling function
+    semantic_repr = ('.root', ('@Is', ('@Word', 'from'), ('@between', ('@And', 'ArgY', 'ArgX'))))
+    labeling_function = LabelingFunction.create(semantic_repr)
+    origin = DataPoint(Phrase(["subj", "is", "from", "obj"], ["PERSON", "", "", "LOCATION"], 0, 3), "per:origin",
+                       'The word "from" is between SUBJ and OBJ')
+    parents = DataPoint(Phrase(["subj", "from", "obj"], ["ORGANIZATION", "", "ORGANIZATION"], 0, 2), "org:parents",
+                        'The word "from" appears between SUBJ and OBJ')
+    for datapoint in [origin, parents]:
+        datapoint.labeling_functions = {semantic_repr : labeling_function}
+    unlabeled_data = [Phrase(["subj", "comes", "from", "obj"], ["PERSON", "", "", "LOCATION"], 0, 3),
+                      Phrase(["subj", "split", "from", "obj"], ["ORGANIZATION", "", "", "ORGANIZATION"], 0, 3),
+                      Phrase(["subj", "met", "obj"], ["PERSON", "", "PERSON"], 0, 2)]
+
+    parser = TrainedCCGParser(low_end_filter_count=0, high_end_filter_pct=1.0)
+    parser.loaded_data = [origin, parents]
+    for build in [lambda: parser.matrix_filter(unlabeled_data), lambda: parser.set_final_datastructures()]:
+        build()
+        labels = {(label, parser.ner_types[function]) for function, label in parser.labeling_functions.items()}
+        assert labels == {("per:origin", ("person", "location")), ("org:parents", ("organization", "organization"))}
+        for function in parser.labeling_functions:
+            assert function(unlabeled_data[0]) and not function(unlabeled_data[2])
+
+        parser.build_soft_labeling_functions()
+        assert sorted(label for _, label in parser.soft_labeling_functions) == ["org:parents", "per:origin"]
@@ -3,12 +3,14 @@ import torch
 import sys
 sys.path.append(".")
 sys.path.append("../")
-from training.train_util_functions import batch_type_restrict_re, build_phrase_input, build_mask_mat_for_batch,\
-                                          build_datasets_from_splits, evaluate_next_clf
+from training.train_util_functions import batch_type_restrict_re, build_phrase_input, build_datasets_from_splits,\
+                                          evaluate_next_clf
 from training.util_functions import similarity_loss_function, generate_save_string, build_custom_vocab,\
                                     set_re_dataset_ner_label_space
 from training.util_classes import BaseVariableLengthDataset
 from training.constants import TACRED_LABEL_MAP, FIND_MODULE_HIDDEN_DIM, TACRED_ENTITY_TYPES, TACRED_NERS
+from CCG_new.soft_grammar_functions import SoftBatchContext
+from CCG_new.soft_labeling_function_compiler import compile_soft_labeling_functions
 from models import BiLSTM_Att_Clf, Find_Module
 import pickle
 from tqdm import tqdm
@@ -18,7 +20,6 @@ import argparse
 import random
 import csv
 import pdb
-import dill
 
 def main():
     parser = argparse.ArgumentParser()
@@ -138,7 +139,7 @@ def main():
         vocab = pickle.load(f)
     
     with open("../data/training_data/labeling_functions_{}.p".format(save_string), "rb") as f:
-        soft_labeling_functions_dict = dill.load(f)
+        soft_labeling_functions_dict = pickle.load(f)
 
     with open("../data/training_data/query_tokens_{}.p".format(save_string), "rb") as f:
         tokenized_queries = pickle.load(f)
@@ -214,29 +215,27 @@ def main():
         find_module = find_module.to(device)
         find_module.eval()
 
-        function_scores = {}
+        # all soft labeling functions are scored at once, type restrictions are computed once per relation
+        soft_labeling_program = compile_soft_labeling_functions([pair[0] for pair in soft_labeling_functions])
+        relations = sorted(set([pair[1] for pair in soft_labeling_functions]))
+        relation_index = torch.tensor([relations.index(pair[1]) for pair in soft_labeling_functions]).to(device)
+
+        function_scores = []
         for i, batch in enumerate(tqdm(unlabeled_data.as_batches(batch_size=full_batch_size, shuffle=False))):
             unlabeled_tokens, unlabeled_token_lengths, phrases, _ = batch
             unlabeled_tokens = unlabeled_tokens.to(device)
             phrase_input = build_phrase_input(phrases, pad_idx, task).to(device).detach()
-            b_size, seq_length = unlabeled_tokens.shape
-            mask_mat = build_mask_mat_for_batch(seq_length).to(device).detach()
             with torch.no_grad():
                 lfind_output = find_module.soft_matching_forward(unlabeled_tokens.detach(), lfind_query_tokens, lower_bound).detach() # B x seq_len x Q
+                batch_context = SoftBatchContext(lfind_output, quoted_words_to_index, phrase_input)
+                batch_scores = soft_labeling_program(batch_context).detach() # B x number_of_explanations
 
-                for j, pair in enumerate(soft_labeling_functions):
-                    func, rel = pair
-                    batch_scores = func(lfind_output, quoted_words_to_index, mask_mat)(phrase_input).detach() # 1 x B
-
-                    type_restrict_multiplier = batch_type_restrict_re(rel, phrase_input, relation_ner_types).detach() # 1 x B
-                    final_scores = batch_scores * type_restrict_multiplier # 1 x B
-                    final_scores = final_scores.cpu()
-                    if j in function_scores:
-                        function_scores[j] = torch.cat([function_scores[j], final_scores], dim=1)
-                    else:
-                        function_scores[j] = final_scores
+                type_restrict_multiplier = torch.cat([batch_type_restrict_re(rel, phrase_input, relation_ner_types)
+                                                      for rel in relations]).detach() # number_of_relations x B
+                final_scores = batch_scores * type_restrict_multiplier[relation_index].permute(1, 0) # B x number_of_explanations
+                function_scores.append(final_scores.cpu())
         
-        soft_scores = torch.cat([function_scores[key] for key in function_scores]).permute(1, 0) # len(data) x number_of_explanations
+        soft_scores = torch.cat(function_scores) # len(data) x number_of_explanations
 
         with open("../data/training_data/soft_scores_{}.p".format(args.experiment_name), "wb") as f:
             pickle.dump(soft_scores, f)
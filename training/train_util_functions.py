@@ -11,14 +11,18 @@ import sys
 sys.path.append(".")
 sys.path.append("../")
 from CCG_new.parser import CCGParserTrainer
-from CCG_new.utils import generate_phrase
+from CCG_new.utils import generate_phrases
+from CCG_new.util_classes import PhraseCorpus
+from CCG_new.phrase_cache import PhraseCache
+from CCG_new.token_index import TokenIndex
+from CCG_new.firing_matrix import FiringMatrix
+from CCG_new.labeling_functions import LabelingFunction, LabeledFunction
 from CCG_new.soft_grammar_functions import NER_LABEL_SPACE
 import spacy
 import torch
 import torch.nn as nn
 from sklearn import metrics
 import numpy as np
-import dill
 import pdb
 from tqdm import tqdm
 import numpy as np
@@ -97,27 +101,6 @@ def build_phrase_input(phrases, pad_idx, task):
 
     return phrase_input
 
-def build_mask_mat_for_batch(seq_length):
-     """
-        Builds a datastructure that is used in the soft-labeling functions to allow the functions
-        to easily access any mask that will zero our tokens not within a certain (i, j) range.
-
-        Ex: i = 1, j = 3, seq_length = 5, mask_mat[i][j] = [0,1,1,1,0], where mask_mat is output of this function
-
-        Arguments:
-            seq_length (int) : length of a sequence(s)
-        
-        Returns:
-            tensor : as described above, will be of dimension seq_length x seq_length x seq_length
-    """
-    mask_mat = torch.zeros((seq_length, seq_length, seq_length))
-    for i in range(seq_length):
-        for j in range(seq_length):
-            mask_mat[i,j,i:j+1] = 1
-    mask_mat = mask_mat.long()
-
-    return mask_mat
-
 def _prepare_labels(labels, label_map):
     """
         Converts an array of labels into an array of label_ids
@@ -174,7 +157,8 @@ def _prepare_unlabeled_data(unlabeled_data_phrases, vocab, spacy_to_custom_ner={
     
     return seq_tokens, seq_phrases
 
-def create_parser(parser_training_data, explanation_path, task="re", explanation_data=None):
+def create_parser(parser_training_data, explanation_path, task="re", explanation_data=None,
+                  parse_cache_dir="../data/training_data/parse_cache", phrase_cache_path="../data/training_data/phrase_cache.db"):
     """
         Creates a TrainedCCGParser using a CCGParserTrainer. This step converts explanations into
         labeling functions.
@@ -185,6 +169,10 @@ def create_parser(parser_training_data, explanation_path, task="re", explanation
                                          is passed in
             task                 (str) : task
             explanation_data     (arr) : array of explanation triples
+            parse_cache_dir      (str) : directory of the on-disk parse cache, so explanations parsed by a
+                                         previous run aren't parsed again. None disables the cache
+            phrase_cache_path    (str) : path of the sqlite3 Phrase cache, so sentences seen by a previous
+                                         run aren't run through spaCy again. None disables the cache
         
         Returns:
             TrainedCCGParser : a custom object that holds many useful datastructures including labeling functions 
@@ -196,68 +184,97 @@ def create_parser(parser_training_data, explanation_path, task="re", explanation
     elif task == "sa":
         parser_trainer = CCGParserTrainer("sa", explanation_path, "", parser_training_data, explanation_data)
     
-    parser_trainer.train()
+    parser_trainer.train(parse_cache_dir=parse_cache_dir, phrase_cache_path=phrase_cache_path)
     parser = parser_trainer.get_parser()
 
     with open("../data/training_data/parser_debug.p", "wb") as f:
-        dill.dump(parser, f)
+        pickle.dump(parser, f)
 
     return parser
 
-def match_training_data(labeling_functions, train, task, function_ner_types={}):
-     """
+def match_training_data(labeling_functions, train, task, function_ner_types={}, phrase_cache=None, semantic_reps=None,
+                        token_index_path=None, firing_matrix_path=None, firing_matrix=None):
+    """
         Given a training sample, we apply strict_labebling functions to it to separate data into data that is:
             1. matched -- there exists at least one explanation that applies to the datapoint and we can thus 
                           assign the label of the explanation to the datapoint
             2. unlabeled -- else
         
         Arguments:
-            labeling_functions (dict) : key - strict_labeling function (lambda function), 
-                                        value - string label associated with function
+            labeling_functions (dict) : key - strict_labeling function (LabeledFunction, LabelingFunction or lambda
+                                        function), value - string label associated with function
             train               (arr) : array of strings
             task                (str) : task
             function_ner_types (dict) : key - strict_labeling function (lambda function)
                                         value - tuple, NER types that were found in the original sentence that
                                                 the explanation was written about
+            phrase_cache (PhraseCache) : if given, Phrases of sentences seen before are read from it instead
+                                         of being rebuilt with spaCy
+            semantic_reps      (dict) : key - semantic representation, value - strict labeling function 
+                                        (TrainedCCGParser.semantic_reps), functions found here are evaluated on
+                                        all sentences at once instead of one sentence at a time
+            token_index_path    (str) : if given, the TokenIndex of train used to skip sentences a function can't
+                                        apply to is saved here, and re-used by later calls on the same data
+            firing_matrix_path  (str) : if given, the FiringMatrix of the functions over train is saved here, and
+                                        re-used by later calls with the same functions on the same data
+            firing_matrix (FiringMatrix) : if given and it has a row for every function over train (ex:
+                                           TrainedCCGParser.firing_matrix), it is used instead of applying
+                                           the functions again
         Returns:
             arr, arr, arr: first array - matched_data_tuples, (sentence, label) tuples
                            second array - unlabeled_data_phrases, Phrase objects
                            third array - matched_indices, index in original data of each matched instance
     """
 
-    phrases = [generate_phrase(entry, nlp) for entry in train]
-
-    with open("../data/training_data/train_phrases_debug.p", "wb") as f:
-        pickle.dump(phrases, f)
-
-    # with open("../data/training_data/train_phrases_debug.p", "rb") as f:
-    #     phrases = pickle.load(f)
+    phrases = generate_phrases(train, nlp, phrase_cache=phrase_cache)
+
+    functions = list(labeling_functions)
+    function_semantic_reps = {}
+    if semantic_reps:
+        function_semantic_reps = {function : key for key, function in semantic_reps.items()}
+    # LabeledFunctions of explanations with the same semantic representation share their LabelingFunction
+    evaluated_functions = [function.labeling_function if isinstance(function, LabeledFunction) else function
+                           for function in functions]
+    # LabelingFunctions carry their own semantic representation
+    function_reps = [evaluated.semantic_repr if isinstance(evaluated, LabelingFunction) else function_semantic_reps.get(function)
+                     for function, evaluated in zip(functions, evaluated_functions)]
+    ner_types = None
+    if task == "re":
+        ner_types = [function_ner_types.get(function) for function in functions]
+    corpus = PhraseCorpus(phrases)
+    if firing_matrix is not None:
+        keys = list(zip(function_reps, ner_types if ner_types is not None else [None] * len(functions)))
+        firing_matrix = firing_matrix.select(keys, corpus)
+    if firing_matrix is None:
+        if token_index_path:
+            index = TokenIndex.load_or_build(corpus, token_index_path)
+        else:
+            index = TokenIndex.from_corpus(corpus)
+        if firing_matrix_path:
+            firing_matrix = FiringMatrix.load_or_build(firing_matrix_path, evaluated_functions, function_reps, corpus, index, ner_types)
+        else:
+            firing_matrix = FiringMatrix.build(evaluated_functions, function_reps, corpus, index, ner_types)
+
+    # each phrase is labeled by the first function that applies to it
+    first_fired = firing_matrix.first_match()
+
+    coverage = firing_matrix.coverage()
+    print("Matched {} of {} sentences ({} matched by more than one function)".format(coverage["covered"], coverage["sentences"], coverage["overlapping"]))
 
     matched_data_tuples = []
     unlabeled_data_phrases = []
 
-    for phrase in phrases:
-        not_matched = True
-        for function in labeling_functions:
-            try:
-                if function(phrase):
-                    if task == "re":
-                        subj_type = phrase.ners[phrase.subj_posi].lower()
-                        obj_type = phrase.ners[phrase.obj_posi].lower()
-                        if function_ner_types[function][0] == subj_type and function_ner_types[function][1] == obj_type:
-                            sentence = phrase.sentence.replace("subj", "SUBJ-{}".format(phrase.ners[phrase.subj_posi]))
-                            sentence = sentence.replace("obj", "OBJ-{}".format(phrase.ners[phrase.obj_posi]))
-                            matched_data_tuples.append((sentence, labeling_functions[function]))
-                            not_matched = False
-                            break
-                    else:
-                        matched_data_tuples.append((phrase.sentence, labeling_functions[function]))
-                        not_matched = False
-                        break
-            except:
-                continue
-        if not_matched:
+    for i, phrase in enumerate(phrases):
+        if first_fired[i] < 0:
             unlabeled_data_phrases.append(phrase)
+            continue
+        function = functions[first_fired[i]]
+        if task == "re":
+            sentence = phrase.sentence.replace("subj", "SUBJ-{}".format(phrase.ners[phrase.subj_posi]))
+            sentence = sentence.replace("obj", "OBJ-{}".format(phrase.ners[phrase.obj_posi]))
+            matched_data_tuples.append((sentence, labeling_functions[function]))
+        else:
+            matched_data_tuples.append((phrase.sentence, labeling_functions[function]))
     
     with open("../data/training_data/matched_data_tuples_debug.p", "wb") as f:
         pickle.dump(matched_data_tuples, f)
@@ -358,7 +375,7 @@ def build_word_to_idx(raw_explanations, vocab, save_string):
         pickle.dump(quoted_words_to_index, f)
     
 def build_datasets_from_text(text_data, vocab_, explanation_data, custom_vocab, save_string, label_map,
-                             sample_rate=-1.0, task="re", dataset="tacred"):
+                             sample_rate=-1.0, task="re", dataset="tacred", phrase_cache_path="../data/training_data/phrase_cache.db"):
     """
         Builds all required datastructures for training (except for soft_scores)
 
@@ -374,6 +391,7 @@ def build_datasets_from_text(text_data, vocab_, explanation_data, custom_vocab,
             sample_rate    (float) : percentage of unlabeled data to use when building datasets
             task             (str) : "re" or "sa"
             dataset          (str) : name of dataset
+            phrase_cache_path (str) : path of the sqlite3 Phrase cache, None disables the cache
     """
     if type(vocab_) == str:
         with open(vocab_, "rb") as f:
@@ -383,21 +401,26 @@ def build_datasets_from_text(text_data, vocab_, explanation_data, custom_vocab,
     
     parser_training_data = random.sample(text_data, min(PARSER_TRAIN_SAMPLE, len(train)))
     
-    parser = create_parser(parser_training_data, "", task, explanation_data)
+    parser = create_parser(parser_training_data, "", task, explanation_data, phrase_cache_path=phrase_cache_path)
 
     strict_labeling_functions = parser.labeling_functions
 
     function_ner_types = parser.ner_types
     
+    phrase_cache = PhraseCache(phrase_cache_path) if phrase_cache_path else None
+
     text_sample = None
     if sample_rate > 0:
         sample_number = int(len(text_data) * sample_rate)
         text_sample = random.sample(text_data, sample_number)
 
     if text_sample:
-        matched_data_tuples, unlabeled_data_phrases, _ = match_training_data(strict_labeling_functions, text_sample, task, function_ner_types)
+        matched_data_tuples, unlabeled_data_phrases, _ = match_training_data(strict_labeling_functions, text_sample, task, function_ner_types, phrase_cache, parser.semantic_reps,
+                                                                             firing_matrix=parser.firing_matrix)
     else:
-        matched_data_tuples, unlabeled_data_phrases, _ = match_training_data(strict_labeling_functions, text_data, task, function_ner_types)
+        matched_data_tuples, unlabeled_data_phrases, _ = match_training_data(strict_labeling_functions, text_data, task, function_ner_types, phrase_cache, parser.semantic_reps,
+                                                                             "../data/training_data/token_index_train.npz", "../data/training_data/firing_matrix_train.npz",
+                                                                             parser.firing_matrix)
     
     spacy_to_custom_ner_mapping = load_spacy_to_custom_dataset_ner_mapping(dataset)
 
@@ -417,11 +440,12 @@ def build_datasets_from_text(text_data, vocab_, explanation_data, custom_vocab,
 
     file_name = PATH_TO_PARENT + "../data/training_data/labeling_functions_{}.p".format(save_string)
     with open(file_name, "wb") as f:
-        dill.dump({"function_pairs" : soft_matching_functions,
+        pickle.dump({"function_pairs" : soft_matching_functions,
                      "labels" : function_labels}, f)
 
 def build_datasets_from_splits(train_path, dev_path, test_path, vocab_, explanation_path, save_string, label_map,
-                               label_filter=None, sample_rate=-1.0, task="re", dataset="tacred"):
+                               label_filter=None, sample_rate=-1.0, task="re", dataset="tacred",
+                               phrase_cache_path="../data/training_data/phrase_cache.db"):
     """
         Builds all required datastructures for training (except for soft_scores), as well as dev and eval evaluation
 
@@ -437,6 +461,7 @@ def build_datasets_from_splits(train_path, dev_path, test_path, vocab_, explanat
             sample_rate    (float) : percentage of unlabeled data to use when building datasets
             task             (str) : "re" or "sa"
             dataset          (str) : name of dataset
+            phrase_cache_path (str) : path of the sqlite3 Phrase cache, None disables the cache
     """
     with open(train_path) as f:
         train = json.load(f)
@@ -450,24 +475,29 @@ def build_datasets_from_splits(train_path, dev_path, test_path, vocab_, explanat
 
     parser_training_data = random.sample(train, min(PARSER_TRAIN_SAMPLE, len(train)))
     
-    parser = create_parser(parser_training_data, explanation_path, task)
+    parser = create_parser(parser_training_data, explanation_path, task, phrase_cache_path=phrase_cache_path)
 
     # with open("../data/training_data/parser_debug.p", "rb") as f:
-    #     parser = dill.load(f)
+    #     parser = pickle.load(f)
     
     strict_labeling_functions = parser.labeling_functions
 
     function_ner_types = parser.ner_types
     
+    phrase_cache = PhraseCache(phrase_cache_path) if phrase_cache_path else None
+
     train_sample = None
     if sample_rate > 0:
         sample_number = int(len(train) * sample_rate)
         train_sample = random.sample(train, sample_number)
 
     if train_sample:
-        matched_data_tuples, unlabeled_data_phrases = match_training_data(strict_labeling_functions, train_sample, task, function_ner_types)
+        matched_data_tuples, unlabeled_data_phrases = match_training_data(strict_labeling_functions, train_sample, task, function_ner_types, phrase_cache, parser.semantic_reps,
+                                                                          firing_matrix=parser.firing_matrix)
     else:
-        matched_data_tuples, unlabeled_data_phrases = match_training_data(strict_labeling_functions, train, task, function_ner_types)
+        matched_data_tuples, unlabeled_data_phrases = match_training_data(strict_labeling_functions, train, task, function_ner_types, phrase_cache, parser.semantic_reps,
+                                                                          "../data/training_data/token_index_train.npz", "../data/training_data/firing_matrix_train.npz",
+                                                                          parser.firing_matrix)
     
     # with open("../data/training_data/matched_data_tuples_debug.p", "rb") as f:
     #     matched_data_tuples = pickle.load(f)
@@ -508,11 +538,11 @@ def build_datasets_from_splits(train_path, dev_path, test_path, vocab_, explanat
 
     file_name = "../data/training_data/labeling_functions_{}.p".format(save_string)
     with open(file_name, "wb") as f:
-        dill.dump({"function_pairs" : soft_matching_functions,
+        pickle.dump({"function_pairs" : soft_matching_functions,
                      "labels" : function_labels}, f)
 
 def _apply_none_label(values, preds, none_label_id, threshold, entropy=True):
-     """
+    """
         As no explanation will ever be written about a label that depicts null/none/neutral, if a label_space
         does have such a label we apply a thresholding technique to the current label_space to determine
         when the output should be the null/none/neutral label.